@@ -0,0 +1,137 @@
+"""
+本地视频目录离线回填（python grid_main.py backfill <dir>）
+
+不需要 Bot / Telethon（不必设 BOT_TOKEN / API_ID / API_HASH），也不经过 grid_jobs：扫描目录下的视频，用渲染进程池（预设每个 CPU 一个 worker）
+生成网格与 pHash，结果按批写入 photo 与 bid_thumbnail（grid_main.write_backfill_batch）。
+
+- 文件名（去掉扩展名）就是视频的 file_unique_id，与 temp/ 下载、ZIP 备份里的命名一致
+- 网格还没上传到 Telegram：photo.file_unique_id 用 local_<file_unique_id>，files_drive 记下 JPEG 路径，
+  没有 file_extension；bid_thumbnail 指向这个 local_ 网格（bot_name、file_id 为 NULL），
+  thumbnail_states 判为 HASHED：收到这个视频时照常排任务，上传之后 bid_thumbnail 改指真正的缩图
+- 已经有可用缩图（缩图有 file_extension）的视频跳过，--force 时照样重做
+- Manifest：每批写入数据库之后才追加这批文件（JSON 行），中断后重跑最多重做一批；
+  大小与修改时间都没变的文件直接跳过，失败的要加 --retry-failed 才会重做
+"""
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional
+
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".mov", ".avi", ".webm", ".m4v", ".flv", ".wmv", ".ts")
+PHOTO_PREFIX = "local_"
+
+
+@dataclass
+class VideoFile:
+    path: str       # 绝对路径
+    rel: str        # 相对扫描目录的路径（manifest 的键）
+    size: int
+    mtime: float
+
+    @property
+    def file_unique_id(self) -> str:
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+
+def scan(root: str, extensions: Iterable[str] = VIDEO_EXTENSIONS) -> Iterator[VideoFile]:
+    """递归列出 root 下的视频（依路径排序，重跑时顺序一致）"""
+    extensions = tuple(e.lower() for e in extensions)
+    root = os.path.abspath(root)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if not name.lower().endswith(extensions):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield VideoFile(path, os.path.relpath(path, root), st.st_size, st.st_mtime)
+
+
+class Manifest:
+    """已处理文件的记录：{"rel", "size", "mtime", "ok", "error", ...} 一行一个，同一 rel 以最后一行为准"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue   # 写到一半被中断的最后一行
+                    self.entries[entry["rel"]] = entry
+        except FileNotFoundError:
+            pass
+
+    def done(self, video: VideoFile, retry_failed: bool = False) -> bool:
+        entry = self.entries.get(video.rel)
+        if not entry or entry["size"] != video.size or entry["mtime"] != video.mtime:
+            return False
+        return entry["ok"] or not retry_failed
+
+    def append(self, entries: List[dict]):
+        if not entries:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self.entries[entry["rel"]] = entry
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def manifest_entry(video: VideoFile, photo_unique_id: Optional[str] = None, phash: Optional[str] = None,
+                   error: Optional[str] = None) -> dict:
+    return {
+        "rel": video.rel,
+        "size": video.size,
+        "mtime": video.mtime,
+        "ok": error is None,
+        "file_unique_id": video.file_unique_id,
+        "photo": photo_unique_id,
+        "phash": phash,
+        "error": error,
+    }
+
+
+class Progress:
+    """每 interval 秒打印一次：完成数 / 总数、files/s（整体与最近区间）、预计剩余时间"""
+
+    def __init__(self, total: int, interval: float = 10):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self._last = (self.start, 0)
+
+    def add(self, ok: bool, nbytes: int):
+        self.done += 1
+        self.failed += 0 if ok else 1
+        self.bytes += nbytes
+        now = time.monotonic()
+        if now - self._last[0] >= self.interval:
+            self.report(now)
+
+    def report(self, now: Optional[float] = None):
+        now = now or time.monotonic()
+        elapsed = now - self.start
+        last_time, last_done = self._last
+        recent = (self.done - last_done) / (now - last_time) if now > last_time else 0.0
+        self._last = (now, self.done)
+        rate = self.done / elapsed if elapsed else 0.0
+        eta = (self.total - self.done) / rate if rate else 0
+        print(
+            f"📊 backfill {self.done}/{self.total} failed={self.failed} "
+            f"{rate:.2f} files/s（最近 {recent:.2f}） {self.bytes / elapsed / 1e6 if elapsed else 0:.1f} MB/s "
+            f"ETA {eta / 60:.1f} min",
+            flush=True
+        )
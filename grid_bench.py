@@ -0,0 +1,1038 @@
+"""
+离线基准测试
+
+    python grid_bench.py frames                      # 生成 1080p / 4K 长视频，比较抽帧后端
+    python grid_bench.py frames --video a.mp4 b.mp4  # 用现有的视频
+    python grid_bench.py intake                      # 本地 Bot API 替身，比较长轮询与 webhook 的接收延迟
+    python grid_bench.py render                      # 多种分辨率 / 时长：网格渲染、pHash、ZIP 打包
+    python grid_bench.py e2e                         # 入库 → 下载 → 渲染 → 上传整条链路（Telegram、MySQL 均为本地替身）
+    python grid_bench.py startup                     # 没有任务时一次完整启动 → 退出的耗时与 import 的模块
+
+render / e2e 按阶段汇报吞吐、p50 / p99 延迟与峰值 RSS（含 ffmpeg、渲染进程等子进程），不需要网络。
+startup 每次在新的解释器里跑，grid_render 等媒体模块只在用到的函数里 import，不污染被测进程。
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import re
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+
+BENCH_DIR = Path("bench_media")
+
+RESOLUTIONS = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+}
+
+
+def make_synthetic_video(resolution: str, duration: int, fps: int = 25, gop: int = 250) -> str:
+    """用 lavfi testsrc 生成 H.264 测试视频（已存在则直接复用）"""
+    from grid_render import ffmpeg_exe
+
+    width, height = RESOLUTIONS[resolution]
+    BENCH_DIR.mkdir(exist_ok=True)
+    path = BENCH_DIR / f"synthetic_{resolution}_{duration}s.mp4"
+    if path.exists():
+        return str(path)
+
+    print(f"🎬 生成测试视频 {path} …", flush=True)
+    tmp = path.with_suffix(".part.mp4")
+    subprocess.run([
+        ffmpeg_exe(), "-nostdin", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc=size={width}x{height}:rate={fps}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", str(gop), "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-shortest", str(tmp)
+    ], check=True)
+    tmp.rename(path)
+    return str(path)
+
+
+def bench_frames(videos: list[str], n: int, frame_width: int, repeat: int):
+    from grid_render import FRAME_BACKENDS, extract_keyframes, probe_video
+
+    print(f"{'video':<40} {'backend':<8} {'seconds':>8}", flush=True)
+    for video in videos:
+        duration, width, height = probe_video(video)
+        label = f"{Path(video).name} ({width}x{height}, {duration:.0f}s)"
+        results = {}
+        for backend in FRAME_BACKENDS:
+            best = None
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                extract_keyframes(video, n, frame_width=frame_width or None, backend=backend)
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            results[backend] = best
+            print(f"{label:<40} {backend:<8} {best:>8.2f}", flush=True)
+        print(f"  → ffmpeg seek 加速 {results['moviepy'] / results['ffmpeg']:.1f}x", flush=True)
+
+
+class FakeBotAPI:
+    """
+    本地 Bot API 替身（aiohttp）：getUpdates 长轮询、setWebhook 后改为主动推送（此时 getUpdates 回 409 Conflict）；
+    sendPhoto / sendDocument / sendMediaGroup / sendMessage 回传合法的 Message，getFile + /file/ 提供 add_file 登记的文件，
+    其余方法一律回 ok。用来测 update 从产生到交给处理函数的延迟，以及 e2e 的回复、缩图下载与上传。
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.created = {}
+        self.next_id = 1
+        self.next_message_id = 1
+        self.webhook = None
+        self.calls = {}
+        self.files = {}
+        self.uploaded_bytes = 0
+        self._arrived = asyncio.Condition()
+        self._session = None
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info["method"].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        if method == "getupdates":
+            if self.webhook:
+                return web.json_response({"ok": False, "error_code": 409, "description":
+                                          "Conflict: can't use getUpdates method while webhook is active"},
+                                         status=409)
+            result = await self.get_updates(
+                int(params.get("offset", 0)), int(params.get("limit", 100)), float(params.get("timeout", 0))
+            )
+        elif method == "setwebhook":
+            self.webhook = params.get("url")
+            result = True
+        elif method == "deletewebhook":
+            self.webhook = None
+            result = True
+        elif method == "getwebhookinfo":
+            result = {"url": self.webhook or "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "sendphoto":
+            result = self.message(params, photo=[self.photo_size(self.attachment(params, "photo"))])
+        elif method == "senddocument":
+            result = self.message(params, document=self.document(self.attachment(params, "document")))
+        elif method == "sendmediagroup":
+            # media 是 JSON 列表，每项的 media 为 attach://<字段名>
+            result = [self.message(params, document=self.document(self.attachment({**params, **item}, "media")))
+                      for item in json.loads(params["media"])]
+        elif method == "sendmessage":
+            result = self.message(params, text=params.get("text", ""))
+        elif method == "getfile":
+            file_id = params["file_id"]
+            if file_id not in self.files:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"})
+            result = {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": len(self.files[file_id]),
+                      "file_path": f"files/{file_id}"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def download(self, request):
+        from aiohttp import web
+
+        file_id = request.match_info["path"].rpartition("/")[2]
+        if file_id not in self.files:
+            return web.Response(status=404)
+        return web.Response(body=self.files[file_id])
+
+    def add_file(self, file_id: str, data: bytes):
+        self.files[file_id] = data
+
+    @staticmethod
+    def attachment(params: dict, key: str):
+        """aiogram 上传文件时参数值为 attach://<字段名>，文件本身在另一个 multipart 字段"""
+        value = params.get(key)
+        if isinstance(value, str) and value.startswith("attach://"):
+            return params.get(value[len("attach://"):])
+        return value
+
+    def upload_size(self, field) -> int:
+        """multipart 上传的文件（aiohttp FileField）计入 uploaded_bytes；传 file_id 字符串时为 0"""
+        if not hasattr(field, "file"):
+            return 0
+        field.file.seek(0, os.SEEK_END)
+        size = field.file.tell()
+        field.file.seek(0)
+        self.uploaded_bytes += size
+        return size
+
+    def photo_size(self, field) -> dict:
+        from PIL import Image
+
+        size = self.upload_size(field)
+        width, height = 1280, 720
+        if size:
+            with Image.open(field.file) as image:
+                width, height = image.size
+        n = self.next_message_id
+        return {"file_id": f"photo{n}", "file_unique_id": f"photou{n}", "width": width, "height": height,
+                "file_size": size}
+
+    def document(self, field) -> dict:
+        return {"file_id": f"doc{self.next_message_id}", "file_unique_id": f"docu{self.next_message_id}",
+                "file_size": self.upload_size(field)}
+
+    def message(self, params: dict, **content) -> dict:
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}, **content}
+
+    async def get_updates(self, offset: int, limit: int, timeout: float):
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            async with self._arrived:
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        return self.updates[:limit]
+
+    async def emit(self, n: int, chats: int = 1):
+        """产生 n 个视频消息 update，轮流来自 chats 个不同的 chat"""
+        for _ in range(n):
+            update_id = self.next_id
+            self.next_id += 1
+            chat_id = 1 + update_id % chats
+            update = {"update_id": update_id, "message": {
+                "message_id": update_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                "video": {"file_id": f"f{update_id}", "file_unique_id": f"u{update_id}",
+                          "width": 1280, "height": 720, "duration": 60}
+            }}
+            self.created[update_id] = time.perf_counter()
+            if self.webhook:
+                asyncio.ensure_future(self._session.post(self.webhook, data=json.dumps(update),
+                                                         headers={"Content-Type": "application/json"}))
+            else:
+                self.updates.append(update)
+        if not self.webhook:
+            async with self._arrived:
+                self._arrived.notify_all()
+
+    async def start(self, port: int) -> str:
+        from aiohttp import ClientSession, web
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.download)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        self._session = ClientSession()
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        # 客户端断线时 aiohttp 不会取消 handler：先叫醒还挂着的长轮询，cleanup 才不必等到它超时
+        async with self._arrived:
+            self._arrived.notify_all()
+        await self._session.close()
+        await self._runner.cleanup()
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def bench_intake_mode(mode: str, bursts: int, burst_size: int, interval: float, port: int,
+                            chats: int, handler_latency: float, concurrency: int):
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    import grid_intake
+
+    api = FakeBotAPI()
+    base = await api.start(port)
+    bot = Bot("123:bench", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    stop = asyncio.Event()
+    latencies = []
+    saves = []
+    last_seen = {}
+    total = bursts * burst_size
+
+    async def handle(updates):
+        # 模拟一次入库 + 回复的耗时，并检查同一 chat 内的顺序
+        await asyncio.sleep(handler_latency)
+        now = time.perf_counter()
+        for u in updates:
+            chat = u.message.chat.id
+            if last_seen.get(chat, 0) > u.update_id:
+                raise AssertionError(f"chat {chat} 乱序: {u.update_id}")
+            last_seen[chat] = u.update_id
+            latencies.append(now - api.created[u.update_id])
+        if len(latencies) >= total:
+            stop.set()
+
+    async def save(update_id):
+        saves.append(update_id)
+
+    checkpoint = grid_intake.ProgressCheckpoint(save, interval=1, every=500)
+    dispatcher = grid_intake.UpdateDispatcher(handle, checkpoint, concurrency=concurrency)
+    if mode == "webhook":
+        intake = grid_intake.serve_webhook(bot, dispatcher, stop, url=f"http://127.0.0.1:{port + 1}/webhook",
+                                           host="127.0.0.1", port=port + 1)
+    else:
+        intake = grid_intake.long_poll(bot, dispatcher, stop, timeout=50)
+    task = asyncio.create_task(intake)
+    await asyncio.sleep(0.3)
+
+    t0 = time.perf_counter()
+    for _ in range(bursts):
+        await api.emit(burst_size, chats)
+        await asyncio.sleep(interval)
+    await asyncio.wait_for(stop.wait(), 120)
+    elapsed = time.perf_counter() - t0
+    # webhook 收到 stop 会自行收尾；长轮询可能还挂在 GetUpdates 上，需要取消
+    await asyncio.wait([task], timeout=5)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert saves and saves[-1] == total, f"checkpoint 停在 {saves[-1:]}"
+    await bot.session.close()
+    await api.stop()
+
+    print(
+        f"{mode:<8} {concurrency:>4} {total:>6} {percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f} "
+        f"{total / elapsed:>10.0f} {len(saves):>11}",
+        flush=True
+    )
+
+
+def bench_intake(modes: list[str], bursts: int, burst_size: int, interval: float, port: int,
+                 chats: int, handler_latency: float, concurrency: list[int]):
+    print(f"{'mode':<8} {'conc':>4} {'updates':>6} {'p50 ms':>9} {'p99 ms':>9} {'updates/s':>10} {'checkpoints':>11}", flush=True)
+    for mode in modes:
+        for n in concurrency:
+            asyncio.run(bench_intake_mode(mode, bursts, burst_size, interval, port, chats, handler_latency, n))
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def tree_rss(pid: int) -> int:
+    """pid 及其所有子孙进程（ffmpeg、渲染进程池）的 RSS 总和（bytes），读 /proc"""
+    total = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+            # 子进程挂在启动它的线程下面（to_thread 里起的 ffmpeg 等），所以每个 task 都要看
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    stack.extend(int(c) for c in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+class RSSMonitor:
+    """
+    后台线程每 interval 秒采样一次进程树的 RSS，更新所有 watch() 中的窗口的峰值（窗口可以嵌套）。
+    没有 /proc 时退回 getrusage 的 ru_maxrss（只含本进程，且是整个进程生命周期的峰值）。
+    """
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.proc = os.path.exists(f"/proc/{os.getpid()}/statm")
+        self._windows = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def current(self) -> int:
+        if self.proc:
+            return tree_rss(os.getpid())
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    @contextlib.contextmanager
+    def watch(self):
+        """yield 一个 [peak]，离开时再采样一次"""
+        window = [self.current()]
+        self._windows.append(window)
+        try:
+            yield window
+        finally:
+            # 按身份移除：嵌套窗口的峰值可能相等
+            self._windows = [w for w in self._windows if w is not window]
+            window[0] = max(window[0], self.current())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = self.current()
+            for window in list(self._windows):
+                window[0] = max(window[0], rss)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class StageRecorder:
+    """按阶段记录每次耗时、处理的条数 / 字节数与期间的峰值 RSS"""
+
+    def __init__(self, monitor: RSSMonitor):
+        self.monitor = monitor
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage: str, items: int = 1, nbytes: int = 0):
+        with self.monitor.watch() as peak:
+            t0 = time.perf_counter()
+            try:
+                yield
+            finally:
+                elapsed = time.perf_counter() - t0
+        self.add(stage, elapsed, items, nbytes, peak[0])
+
+    def add(self, stage: str, seconds: float, items: int = 1, nbytes: int = 0, peak: int = 0):
+        """记一次已知耗时的阶段（例如渲染进程回传的子阶段）"""
+        s = self.stages.setdefault(stage, {"seconds": [], "items": 0, "bytes": 0, "peak": 0})
+        s["seconds"].append(seconds)
+        s["items"] += items
+        s["bytes"] += nbytes
+        s["peak"] = max(s["peak"], peak)
+
+    def report(self):
+        print(
+            f"{'stage':<28} {'runs':>5} {'p50 ms':>9} {'p99 ms':>9} {'items/s':>9} {'MB/s':>8} {'peak RSS MB':>12}",
+            flush=True
+        )
+        for stage, s in self.stages.items():
+            total = sum(s["seconds"]) or 1e-9
+            mbps = f"{s['bytes'] / total / 1e6:>8.1f}" if s["bytes"] else f"{'-':>8}"
+            print(
+                f"{stage:<28} {len(s['seconds']):>5} {percentile(s['seconds'], 0.5) * 1000:>9.1f} "
+                f"{percentile(s['seconds'], 0.99) * 1000:>9.1f} {s['items'] / total:>9.2f} {mbps} "
+                f"{s['peak'] / 1e6:>12.0f}",
+                flush=True
+            )
+
+
+def load_grid_main():
+    """grid_main 在 import 时读取设定并建立 Bot / TelegramClient：先补上替身用的凭证"""
+    os.environ.setdefault("BOT_TOKEN", "123:bench")
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "bench")
+    import grid_main
+    return grid_main
+
+
+def quiet(verbose: bool):
+    """grid_main 的逐步日志会淹没结果表：默认丢掉，--verbose 时保留"""
+    if verbose:
+        return contextlib.nullcontext()
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+
+def bench_videos(resolutions: list[str], durations: list[int]) -> list[str]:
+    return [make_synthetic_video(r, d) for r in resolutions for d in durations]
+
+
+async def bench_render_videos(gm, videos: list[str], repeat: int, rec: StageRecorder):
+    import imagehash
+    import numpy as np
+    from PIL import Image
+
+    import grid_zip
+    from grid_render import AnimationSpec, SpriteSpec, render_keyframe_grid, tile_phashes
+
+    # 第一次渲染包含进程池启动与字体载入、第一次 phash 包含 scipy 载入，不计入结果
+    warmup = await gm.make_keyframe_grid(videos[0], str(BENCH_DIR / "warmup"))
+    imagehash.phash(Image.open(warmup.path))
+    for video in videos:
+        label = Path(video).stem.replace("synthetic_", "")
+        base = str(BENCH_DIR / f"grid_{label}")
+        for _ in range(repeat):
+            with rec.measure(f"grid {label}"):
+                grid = await gm.make_keyframe_grid(video, base)
+
+        # 同一次抽帧再产出雪碧图与动画：多出来的应该只有 encode_sprite / encode_animation
+        for _ in range(repeat):
+            with rec.measure(f"grid+sprite+anim {label}"):
+                extras = await gm.run_render(
+                    render_keyframe_grid, video, f"{base}_x.jpg",
+                    canvas_width=gm.GRID_CANVAS_WIDTH, frame_width=gm.FRAME_WIDTH, backend=gm.FRAME_BACKEND,
+                    sprite=SpriteSpec(), sprite_path=f"{base}_sprite.jpg",
+                    animation=AnimationSpec(), animation_path=f"{base}.webp"
+                )
+            for name in ("encode_sprite", "encode_animation"):
+                rec.add(f"  {name} {label}", extras.timings[name])
+
+        canvas = np.asarray(Image.open(grid.path).convert("RGB"))
+        for _ in range(repeat):
+            with rec.measure(f"phash {label}"):
+                tile_phashes(canvas, 3, 3)
+                imagehash.phash(Image.fromarray(canvas))
+
+        paths = [video, grid.path]
+        nbytes = sum(os.path.getsize(p) for p in paths)
+        if shutil.which("zip"):
+            zip_path = base + ".zip"
+            for _ in range(repeat):
+                with rec.measure(f"zip-cmd {label}", nbytes=nbytes):
+                    await asyncio.to_thread(gm.fast_zip_with_password, paths, zip_path, "bench")
+            os.remove(zip_path)
+        if grid_zip.available():
+            for _ in range(repeat):
+                with rec.measure(f"zip-stream {label}", nbytes=nbytes):
+                    stream = grid_zip.EncryptedZipStream(paths, "bench")
+                    for _ in stream.iter_parts(gm.UPLOAD_PART_SIZE):
+                        pass
+
+
+def bench_render(videos: list[str], repeat: int, verbose: bool):
+    gm = load_grid_main()
+    if not shutil.which("zip"):
+        print("ℹ️ 没有 zip 命令，跳过 fast_zip_with_password", flush=True)
+
+    async def run():
+        try:
+            await bench_render_videos(gm, videos, repeat, rec)
+        finally:
+            if gm.render_pool is not None:
+                await asyncio.to_thread(gm.render_pool.shutdown)
+
+    with RSSMonitor() as monitor:
+        rec = StageRecorder(monitor)
+        with quiet(verbose):
+            asyncio.run(run())
+    rec.report()
+
+
+STANDIN_SCHEMA = """
+CREATE TABLE IF NOT EXISTS video (
+    file_unique_id TEXT PRIMARY KEY, file_size INTEGER, duration INTEGER, width INTEGER, height INTEGER,
+    mime_type TEXT, thumb_hash TEXT, create_time TEXT, update_time TEXT
+);
+CREATE TABLE IF NOT EXISTS document (
+    file_unique_id TEXT PRIMARY KEY, file_size INTEGER, file_name TEXT, mime_type TEXT, caption TEXT,
+    create_time TEXT
+);
+CREATE TABLE IF NOT EXISTS photo (
+    file_unique_id TEXT PRIMARY KEY, file_size INTEGER, width INTEGER, height INTEGER, file_name TEXT,
+    caption TEXT, root_unique_id TEXT, create_time TEXT, files_drive TEXT, hash TEXT, frame_hashes TEXT,
+    same_fuid TEXT
+);
+CREATE TABLE IF NOT EXISTS file_extension (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, file_type TEXT, file_unique_id TEXT, file_id TEXT, bot TEXT,
+    create_time TEXT, UNIQUE (file_unique_id, bot)
+);
+CREATE TABLE IF NOT EXISTS bid_thumbnail (
+    file_unique_id TEXT PRIMARY KEY, thumb_file_unique_id TEXT, bot_name TEXT, file_id TEXT,
+    confirm_status INTEGER, uploader_id INTEGER, status INTEGER, t_update INTEGER
+);
+CREATE TABLE IF NOT EXISTS sora_content (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, source_id TEXT UNIQUE, thumb_file_unique_id TEXT, stage TEXT
+);
+CREATE TABLE IF NOT EXISTS grid_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, file_id TEXT, file_unique_id TEXT UNIQUE, file_type TEXT,
+    bot_name TEXT, job_state TEXT, scheduled_at TEXT, started_at TEXT, finished_at TEXT,
+    retry_count INTEGER DEFAULT 0, source_chat_id INTEGER, source_message_id INTEGER, grid_file_id TEXT,
+    error_message TEXT, claim_token TEXT, stage_timings TEXT, file_size INTEGER, priority INTEGER DEFAULT 0,
+    lease_until TEXT
+);
+CREATE TABLE IF NOT EXISTS scrap_progress (
+    chat_id INTEGER, api_id INTEGER, message_id INTEGER, update_datetime TEXT, PRIMARY KEY (chat_id, api_id)
+);
+"""
+
+
+def mysql_to_sqlite(query: str) -> str:
+    """grid_main 用到的 MySQL 写法 → SQLite（3.35+ 的 upsert 可省略冲突目标）"""
+    query = query.replace("%s", "?")
+    query = re.sub(r"\bINSERT\s+IGNORE\b", "INSERT OR IGNORE", query, flags=re.I)
+    query = re.sub(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", "ON CONFLICT DO UPDATE SET", query, flags=re.I)
+    query = re.sub(r"\bNOW\(\)\s*\+\s*INTERVAL\s+(\?|\d+)\s+SECOND\b", r"datetime(NOW(), \1 || ' seconds')",
+                   query, flags=re.I)
+    return re.sub(r"\bVALUES\((\w+)\)", r"excluded.\1", query, flags=re.I)
+
+
+class _SQLiteCursor:
+    def __init__(self, conn: sqlite3.Connection, latency: float, observer=None):
+        self.cur = conn.cursor()
+        self.latency = latency
+        self.observer = observer
+
+    async def _run(self, query: str, run):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)  # 模拟一次往返
+            run(mysql_to_sqlite(query))
+            ok = True
+            return max(self.cur.rowcount, 0)
+        finally:
+            if self.observer:
+                self.observer(query, time.perf_counter() - t0, ok)
+
+    async def execute(self, query: str, args=()) -> int:
+        return await self._run(query, lambda q: self.cur.execute(q, tuple(args)))
+
+    async def executemany(self, query: str, param_list) -> int:
+        return await self._run(query, lambda q: self.cur.executemany(q, [tuple(p) for p in param_list]))
+
+    async def fetchone(self):
+        return self.cur.fetchone()
+
+    async def fetchall(self):
+        return self.cur.fetchall()
+
+    @property
+    def lastrowid(self) -> int:
+        return self.cur.lastrowid
+
+
+class SQLiteManager:
+    """
+    MySQLManager 的本地替身：同样的 init / connection / transaction / fetch* / execute 接口与 observer，
+    语句经 mysql_to_sqlite 转换后在 SQLite 上执行，每条语句先 sleep latency 秒模拟网络往返。
+    只有一条连线：transaction 之间互斥，期间其它协程的单条语句会并入该事务（基准测试可接受）。
+    """
+
+    def __init__(self, path: str = ":memory:", latency: float = 0.0, maxsize: int = 10):
+        self.path = path
+        self.latency = latency
+        self.config = {"minsize": 1, "maxsize": maxsize}
+        self.conn = None
+        self.observer = None
+        self.statements = 0
+        self._lock = asyncio.Lock()
+
+    async def init(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self.conn.create_function("NOW", 0, lambda: time.strftime("%Y-%m-%d %H:%M:%S"))
+            self.conn.executescript(STANDIN_SCHEMA)
+
+    def _cursor(self) -> _SQLiteCursor:
+        cur = _SQLiteCursor(self.conn, self.latency, self.observer)
+        execute = cur.execute
+
+        async def counted(query, args=()):
+            self.statements += 1
+            return await execute(query, args)
+
+        cur.execute = counted
+        return cur
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        await self.init()
+        yield self._cursor()
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        await self.init()
+        async with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                yield self._cursor()
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    async def fetchone(self, query: str, args=()):
+        async with self.connection() as cur:
+            await cur.execute(query, args)
+            return await cur.fetchone()
+
+    async def fetchall(self, query: str, args=()):
+        async with self.connection() as cur:
+            await cur.execute(query, args)
+            return await cur.fetchall()
+
+    async def execute(self, query: str, args=()) -> int:
+        async with self.connection() as cur:
+            return await cur.execute(query, args)
+
+    async def executemany(self, query: str, param_list) -> int:
+        async with self.connection() as cur:
+            return await cur.executemany(query, param_list)
+
+    async def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class FakeTelegramClient:
+    """
+    Telethon TelegramClient 的进程内替身：get_messages 回传指向本地文件的 document，
+    GetFileRequest 从文件读出对应区间，SaveFilePart / SaveBigFilePart 只计数，send_file 记录一次发送。
+    每个请求 sleep latency 秒；bandwidth（bytes/s，0 = 不限）模拟单条连线的传输时间。
+    """
+
+    DC_ID = 2
+
+    def __init__(self, latency: float = 0.0, bandwidth: float = 0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.session = SimpleNamespace(dc_id=self.DC_ID)
+        self._sender = object()
+        self.messages = {}
+        self.paths = {}
+        self.uploaded_bytes = 0
+        self.sent = []
+
+    def add_message(self, chat_id: int, message_id: int, path: str):
+        doc_id = len(self.paths) + 1
+        self.paths[doc_id] = path
+        self.messages[(chat_id, message_id)] = doc_id
+
+    def _message(self, chat_id: int, message_id: int):
+        doc_id = self.messages[(chat_id, message_id)]
+        path = self.paths[doc_id]
+        document = SimpleNamespace(id=doc_id, access_hash=0, file_reference=b"bench", size=os.path.getsize(path),
+                                   dc_id=self.DC_ID)
+
+        async def download_media(file: str):
+            await asyncio.to_thread(shutil.copyfile, path, file)
+            return file
+
+        return SimpleNamespace(id=message_id, chat_id=chat_id, media=SimpleNamespace(document=document),
+                               document=document, download_media=download_media)
+
+    async def _transfer(self, nbytes: int):
+        delay = self.latency + (nbytes / self.bandwidth if self.bandwidth else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def connect(self):
+        pass
+
+    async def start(self, **kwargs):
+        return self
+
+    async def restore(self) -> bool:
+        return False
+
+    async def persist(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def get_messages(self, chat_id: int, ids: int):
+        return self._message(chat_id, ids)
+
+    async def get_entity(self, entity_id: int):
+        return SimpleNamespace(id=entity_id)
+
+    async def _call(self, sender, request):
+        with open(self.paths[request.location.id], "rb") as f:
+            f.seek(request.offset)
+            data = f.read(request.limit)
+        await self._transfer(len(data))
+        return SimpleNamespace(bytes=data)
+
+    async def __call__(self, request):
+        self.uploaded_bytes += len(request.bytes)
+        await self._transfer(len(request.bytes))
+        return True
+
+    async def send_file(self, entity, file, caption: str = "", force_document: bool = False):
+        await self._transfer(0)
+        self.sent.append((entity.id, file, caption))
+
+
+def make_thumbnail(seed: int) -> bytes:
+    """各不相同的 320x180 噪声 JPEG：避免合成视频彼此被当成近似重复"""
+    import io
+
+    import numpy as np
+    from PIL import Image
+
+    pixels = np.random.default_rng(seed).integers(0, 256, (18, 32, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).resize((320, 180), Image.NEAREST).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+async def bench_e2e_run(gm, videos: list[str], copies: int, page_size: int, ingest: str, port: int,
+                        db_latency: float, mtproto_latency: float, bandwidth: float, rec: StageRecorder):
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+    from aiogram.types import Update
+
+    from grid_render import probe_video
+
+    api = FakeBotAPI()
+    base = await api.start(port)
+    bot = Bot("123:bench", session=AiohttpSession(api=TelegramAPIServer.from_base(base)),
+              default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    client = FakeTelegramClient(mtproto_latency, bandwidth)
+    db = SQLiteManager(str(BENCH_DIR / "e2e.sqlite3"), latency=db_latency)
+    db.observer = gm.db.observer
+    gm.bot, gm.tele_client, gm.db = bot, client, db
+    gm.job_leases.db = db
+    gm.BOT_NAME = (await bot.get_me()).username
+    if os.path.exists(db.path):
+        os.remove(db.path)
+
+    updates = []
+    for i, video in enumerate(videos * copies):
+        duration, width, height = probe_video(video)
+        chat_id, message_id = 1000 + i % 20, i + 1
+        client.add_message(chat_id, message_id, video)
+        api.add_file(f"thumb{i}", make_thumbnail(i))
+        with open(video, "rb") as f:
+            api.add_file(f"video{i}", f.read())
+        updates.append(Update.model_validate({"update_id": i + 1, "message": {
+            "message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+            "video": {"file_id": f"video{i}", "file_unique_id": f"bench{i}", "width": width, "height": height,
+                      "duration": int(duration), "file_size": os.path.getsize(video), "mime_type": "video/mp4",
+                      "thumbnail": {"file_id": f"thumb{i}", "file_unique_id": f"thumbu{i}", "width": 320,
+                                    "height": 180}}
+        }}, context={"bot": bot}))
+
+    handle = gm.handle_updates if ingest == "batch" else gm.ingest_updates_one_by_one
+    backends = {}
+    try:
+        for start in range(0, len(updates), page_size):
+            page = updates[start:start + page_size]
+            with rec.measure("ingest", items=len(page)):
+                await handle(page)
+
+        while (job := await gm.claim_grid_job()) is not None:
+            size = client._message(job.chat_id, job.message_id).document.size
+            with rec.measure("job", nbytes=size):
+                with rec.measure("download", nbytes=size):
+                    ok = await gm.download_stage(job)
+                backends[job.download_backend] = backends.get(job.download_backend, 0) + 1
+                if ok:
+                    with rec.measure("render"):
+                        ok = await gm.render_stage(job)
+                if ok:
+                    with rec.measure("upload", nbytes=size):
+                        await gm.upload_stage(job)
+            gm.release_job(job)
+
+        states = dict(await db.fetchall("SELECT job_state, COUNT(*) FROM grid_jobs GROUP BY job_state"))
+        failed = await db.fetchall("SELECT file_unique_id, error_message FROM grid_jobs WHERE job_state='failed'")
+    finally:
+        if gm.render_pool is not None:
+            await asyncio.to_thread(gm.render_pool.shutdown)
+        await bot.session.close()
+        await api.stop()
+        await db.close()
+
+    return {
+        "updates": len(updates),
+        "jobs": states,
+        "download_backends": backends,
+        "telethon_started": gm.telethon_ready,
+        "failed": failed,
+        "db_statements": db.statements,
+        "bot_api_calls": api.calls,
+        "bot_api_upload_bytes": api.uploaded_bytes,
+        "mtproto_upload_bytes": client.uploaded_bytes,
+        "archives_sent": len(client.sent),
+        "scratch_files_left": len(os.listdir(gm.scratch.root)),
+    }
+
+
+def bench_e2e(videos: list[str], copies: int, page_size: int, ingest: str, port: int, db_latency: float,
+              mtproto_latency: float, bandwidth: float, verbose: bool):
+    gm = load_grid_main()
+    with RSSMonitor() as monitor:
+        rec = StageRecorder(monitor)
+        with quiet(verbose):
+            summary = asyncio.run(bench_e2e_run(gm, videos, copies, page_size, ingest, port, db_latency,
+                                                mtproto_latency, bandwidth, rec))
+    rec.report()
+    for key, value in summary.items():
+        print(f"  {key}: {value}", flush=True)
+
+
+# 启动时不该载入的媒体库，以及启动本来就需要的 Bot / MTProto 客户端（对照用）
+STARTUP_MODULES = ("numpy", "imagehash", "moviepy", "grid_render", "grid_zip", "grid_mp4", "aiogram", "telethon")
+
+
+async def bench_startup_run(gm, port: int, db_latency: float, mtproto_latency: float) -> dict:
+    """替换掉 Bot / Telethon / MySQL 后跑一次真正的 main()：grid_jobs 是空的，认领不到任务就退出"""
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+
+    api = FakeBotAPI()
+    base = await api.start(port)
+    gm.bot = Bot("123:bench", session=AiohttpSession(api=TelegramAPIServer.from_base(base)),
+                 default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    gm.tele_client = FakeTelegramClient(mtproto_latency)
+    gm.db = SQLiteManager(latency=db_latency)
+    gm.job_leases.db = gm.db
+
+    timings = {}
+
+    def timed(name, fn):
+        async def run(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                timings[name] = time.perf_counter() - t0
+        return run
+
+    gm.startup = timed("ready", gm.startup)
+    gm.claim_grid_job = timed("claim", gm.claim_grid_job)
+    try:
+        await timed("main", gm.main)()
+    finally:
+        await api.stop()
+    return timings
+
+
+def bench_startup_child(port: int, db_latency: float, mtproto_latency: float, verbose: bool):
+    """在新的解释器里执行：最后一行 stdout 输出 JSON 结果给 bench_startup"""
+    t0 = time.perf_counter()
+    gm = load_grid_main()
+    result = {"import": time.perf_counter() - t0}
+    loaded = [m for m in STARTUP_MODULES if m in sys.modules]
+    with quiet(verbose):
+        result.update(asyncio.run(bench_startup_run(gm, port, db_latency, mtproto_latency)))
+    result["cpu"] = time.process_time()
+    result["loaded"] = loaded
+    result["loaded_after_run"] = [m for m in STARTUP_MODULES if m in sys.modules and m not in loaded]
+    print(json.dumps(result), flush=True)
+
+
+def bench_startup(runs: int, port: int, db_latency: float, mtproto_latency: float, verbose: bool):
+    """
+    每次启动一个新的 python 进程跑 startup --child，量整个进程的 wall time，
+    以及子进程回报的 import / 就绪 / 认领 / main 耗时与 CPU 时间（含解释器启动）
+    """
+    env = dict(os.environ, WORKER_MODE="once", ONCE_IDLE_WAIT="0", METRICS_PORT="0", METRICS_JSON="")
+    cmd = [sys.executable, os.path.abspath(__file__), "startup", "--child", "--port", str(port),
+           "--db-latency", str(db_latency), "--mtproto-latency", str(mtproto_latency)]
+    if verbose:
+        cmd.append("--verbose")
+
+    columns = ("wall", "import", "ready", "claim", "main", "cpu")
+    samples = {c: [] for c in columns}
+    result = {}
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, text=True, check=True)
+        wall = time.perf_counter() - t0
+        if verbose:
+            print(proc.stdout, end="", flush=True)
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result["wall"] = wall
+        for c in columns:
+            samples[c].append(result[c])
+
+    print(f"{'phase':<8} {'p50 ms':>9} {'max ms':>9}", flush=True)
+    for c in columns:
+        print(f"{c:<8} {percentile(samples[c], 0.5) * 1000:>9.0f} {max(samples[c]) * 1000:>9.0f}", flush=True)
+    print(f"  loaded at import: {', '.join(result['loaded']) or '-'}", flush=True)
+    print(f"  loaded by the no-job run: {', '.join(result['loaded_after_run']) or '-'}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="grid 离线基准测试")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("frames", help="比较 ffmpeg seek 与 moviepy 抽帧")
+    p.add_argument("--video", nargs="*", default=[], help="使用现有视频，不生成测试视频")
+    p.add_argument("--resolutions", default="1080p,4k")
+    p.add_argument("--duration", type=int, default=600, help="生成的测试视频长度（秒）")
+    p.add_argument("--frames", type=int, default=9)
+    p.add_argument("--frame-width", type=int, default=0)
+    p.add_argument("--repeat", type=int, default=1)
+
+    p = sub.add_parser("intake", help="本地 Bot API 替身：长轮询 vs webhook 的接收延迟")
+    p.add_argument("--modes", default="poll,webhook")
+    p.add_argument("--bursts", type=int, default=50)
+    p.add_argument("--burst-size", type=int, default=20)
+    p.add_argument("--interval", type=float, default=0.05, help="两批 update 之间的间隔（秒）")
+    p.add_argument("--port", type=int, default=18081)
+    p.add_argument("--chats", type=int, default=20, help="update 来自多少个不同的 chat")
+    p.add_argument("--handler-latency", type=float, default=0.02, help="每批模拟的入库+回复耗时（秒）")
+    p.add_argument("--concurrency", default="1,8", help="dispatcher 并发数，逗号分隔")
+
+    p = sub.add_parser("render", help="各分辨率 / 时长的网格渲染、pHash、ZIP 打包")
+    p.add_argument("--video", nargs="*", default=[], help="使用现有视频，不生成测试视频")
+    p.add_argument("--resolutions", default="720p,1080p,4k")
+    p.add_argument("--durations", default="30,300", help="生成的测试视频长度（秒），逗号分隔")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--verbose", action="store_true", help="保留 grid_main 的日志")
+
+    p = sub.add_parser("e2e", help="入库 → 下载 → 渲染 → 上传，Telegram 与 MySQL 都用本地替身")
+    p.add_argument("--video", nargs="*", default=[], help="使用现有视频，不生成测试视频")
+    p.add_argument("--resolutions", default="720p,1080p")
+    p.add_argument("--durations", default="30,120", help="生成的测试视频长度（秒），逗号分隔")
+    p.add_argument("--copies", type=int, default=2, help="每个视频以不同 file_unique_id 重复几次")
+    p.add_argument("--page-size", type=int, default=20, help="每次交给入库的 update 数")
+    p.add_argument("--ingest", choices=("batch", "single"), default="batch",
+                   help="batch = handle_updates 整页入库；single = 逐条 handle_video")
+    p.add_argument("--port", type=int, default=18091)
+    p.add_argument("--db-latency", type=float, default=0.001, help="每条 SQL 模拟的往返时间（秒）")
+    p.add_argument("--mtproto-latency", type=float, default=0.02, help="每个 MTProto 请求模拟的往返时间（秒）")
+    p.add_argument("--bandwidth", type=float, default=0, help="每条 MTProto 连线的带宽（MB/s，0 = 不限）")
+    p.add_argument("--verbose", action="store_true", help="保留 grid_main 的日志")
+
+    p = sub.add_parser("startup", help="没有任务时从启动到退出的耗时，以及启动时 import 了哪些模块")
+    p.add_argument("--runs", type=int, default=5, help="启动几个新进程")
+    p.add_argument("--port", type=int, default=18101)
+    p.add_argument("--db-latency", type=float, default=0.001, help="每条 SQL 模拟的往返时间（秒）")
+    p.add_argument("--mtproto-latency", type=float, default=0.02, help="每个 MTProto 请求模拟的往返时间（秒）")
+    p.add_argument("--verbose", action="store_true", help="保留 grid_main 的日志")
+    p.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.bench in ("render", "e2e"):
+        videos = args.video or bench_videos(args.resolutions.split(","),
+                                            [int(d) for d in args.durations.split(",")])
+    if args.bench == "render":
+        bench_render(videos, args.repeat, args.verbose)
+    elif args.bench == "e2e":
+        bench_e2e(videos, args.copies, args.page_size, args.ingest, args.port, args.db_latency,
+                  args.mtproto_latency, args.bandwidth * 1e6, args.verbose)
+    elif args.bench == "startup":
+        if args.child:
+            bench_startup_child(args.port, args.db_latency, args.mtproto_latency, args.verbose)
+        else:
+            bench_startup(args.runs, args.port, args.db_latency, args.mtproto_latency, args.verbose)
+    elif args.bench == "intake":
+        bench_intake(args.modes.split(","), args.bursts, args.burst_size, args.interval, args.port,
+                     args.chats, args.handler_latency, [int(n) for n in args.concurrency.split(",")])
+    elif args.bench == "frames":
+        videos = args.video or [
+            make_synthetic_video(r, args.duration) for r in args.resolutions.split(",")
+        ]
+        bench_frames(videos, args.frames, args.frame_width, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+缩图状态缓存（进程内，LRU + TTL）
+
+以视频的 file_unique_id 为键，记录“是否已有网格缩图、在哪个 BOT 名下”，
+转发/重发的视频不必每次都查 bid_thumbnail 与 file_extension。
+“缺少”状态的 TTL 较短：其它进程或 BOT 可能随时生成缩图。
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+
+MISSING = "missing"   # 没有 bid_thumbnail 记录
+ORPHAN = "orphan"     # 有 bid_thumbnail 记录，但缩图的 file_extension 不存在
+HASHED = "hashed"     # bid_thumbnail 指向离线回填的本地网格（photo 已有 pHash，还没上传到 Telegram）
+SELF = "self"         # 缩图在本 BOT 名下（file_id 可直接回传）
+OTHER = "other"       # 缩图在别的 BOT 名下
+
+
+@dataclass(frozen=True)
+class ThumbState:
+    status: str
+    file_id: Optional[str] = None
+
+
+class ThumbnailCache:
+    def __init__(self, maxsize: int = 50000, ttl: float = 3600, missing_ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key: str) -> Optional[ThumbState]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        state, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return state
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, ThumbState]:
+        """回传命中的部分；未命中的键不在结果里"""
+        found = {}
+        for key in keys:
+            state = self.get(key)
+            if state is not None:
+                found[key] = state
+        return found
+
+    def put(self, key: str, state: ThumbState):
+        if self.maxsize <= 0:
+            return
+        ttl = self.missing_ttl if state.status in (MISSING, ORPHAN, HASHED) else self.ttl
+        self._data[key] = (state, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+    def invalidate(self, key: str):
+        self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
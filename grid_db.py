@@ -1,5 +1,75 @@
+import asyncio
+import time
+
 from aiomysql import create_pool
-from typing import Any, List, Tuple, Optional
+from contextlib import asynccontextmanager
+from typing import Any, Callable, List, Sequence, Tuple, Optional
+
+
+# observer(query, seconds, ok)：每條語句執行完呼叫一次（用於指標）
+QueryObserver = Callable[[str, float, bool], None]
+
+
+def values_rows(template: str, rows: Sequence[Tuple]) -> Tuple[str, Tuple]:
+    """
+    多列 VALUES：template 為單列的佔位符，例如 "(%s, %s, NOW())"，
+    回傳 ("(%s, %s, NOW()), (%s, %s, NOW())", 攤平後的參數)
+    """
+    return ", ".join([template] * len(rows)), tuple(v for row in rows for v in row)
+
+
+def in_clause(values: Sequence[Any]) -> str:
+    """IN (...) 的佔位符"""
+    return ", ".join(["%s"] * len(values))
+
+
+class QueryTimeout(Exception):
+    """查詢超過 query_timeout；該連線已被關閉，不會回到連線池"""
+
+
+class _Cursor:
+    """包一層 aiomysql cursor：每條語句套用 query_timeout，並回報耗時給 observer"""
+
+    def __init__(self, conn, cur, timeout: Optional[float], observer: Optional[QueryObserver] = None):
+        self.conn = conn
+        self.cur = cur
+        self.timeout = timeout
+        self.observer = observer
+
+    async def _run(self, query: str, coro):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            if not self.timeout:
+                result = await coro
+            else:
+                result = await asyncio.wait_for(coro, self.timeout)
+            ok = True
+            return result
+        except asyncio.TimeoutError:
+            # 協定狀態已不可知，關掉連線讓連線池丟棄它
+            self.conn.close()
+            raise QueryTimeout(f"查詢超過 {self.timeout}s")
+        finally:
+            if self.observer:
+                self.observer(query, time.perf_counter() - t0, ok)
+
+    async def execute(self, query: str, args: Tuple = ()) -> int:
+        return await self._run(query, self.cur.execute(query, args))
+
+    async def executemany(self, query: str, param_list: List[Tuple]) -> int:
+        return await self._run(query, self.cur.executemany(query, param_list))
+
+    async def fetchone(self) -> Optional[Tuple[Any]]:
+        return await self.cur.fetchone()
+
+    async def fetchall(self) -> List[Tuple[Any]]:
+        return await self.cur.fetchall()
+
+    @property
+    def lastrowid(self) -> int:
+        return self.cur.lastrowid
+
 
 class MySQLManager:
     def __init__(self, config: dict):
@@ -11,59 +81,102 @@ class MySQLManager:
             "user": "root",
             "password": "pass",
             "db": "your_db",
-            "autocommit": True
+            "autocommit": True,
+            "minsize": 1,          # 連線池大小（aiomysql 參數）
+            "maxsize": 10,
+            "prewarm": False,      # init() 時先把 minsize 條連線都 ping 一次
+            "query_timeout": 30    # 每條語句的逾時秒數，0 表示不限
         }
         """
+        config = dict(config)
+        self.prewarm = bool(config.pop("prewarm", False))
+        self.query_timeout = float(config.pop("query_timeout", 0) or 0) or None
         self.config = config
         self.pool = None
+        self.observer: Optional[QueryObserver] = None
+        self._init_lock = asyncio.Lock()
 
     async def init(self):
-        """建立連線池"""
-        if self.pool is None:
-            self.pool = await create_pool(**self.config)
+        """建立連線池（啟動時與其他初始化並行呼叫，加鎖確保只建一個池）"""
+        if self.pool is not None:
+            return
+        async with self._init_lock:
+            if self.pool is None:
+                pool = await create_pool(**self.config)
+                if self.prewarm:
+                    await self._prewarm(pool)
+                self.pool = pool
 
-    async def close(self):
-        """优雅地关闭 aiomysql 连接池"""
-        if getattr(self, "pool", None) is not None:
-            self.pool.close()
-            await self.pool.wait_closed()
+    async def _prewarm(self, pool):
+        """同時借出 minsize 條連線並 ping，第一批查詢不必等 TCP / 認證握手"""
+        conns = [await pool.acquire() for _ in range(pool.minsize)]
+        try:
+            await asyncio.gather(*(conn.ping() for conn in conns))
+        finally:
+            for conn in conns:
+                pool.release(conn)
 
-    async def fetchone(self, query: str, args: Tuple = ()) -> Optional[Tuple[Any]]:
-        """執行查詢並回傳第一筆資料"""
+    @asynccontextmanager
+    async def connection(self):
+        """
+        取得一條連線，區塊內的語句都在這條連線上執行（依 autocommit 設定各自提交），
+        yield 套用 query_timeout 的 cursor
+        """
         await self.init()
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(query, args)
-                return await cur.fetchone()
+                yield _Cursor(conn, cur, self.query_timeout, self.observer)
 
-    async def fetchall(self, query: str, args: Tuple = ()) -> List[Tuple[Any]]:
-        """執行查詢並回傳所有結果"""
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        取得一條連線並開啟交易，yield cursor；
+        區塊正常結束時 commit（只提交一次），發生例外時 rollback
+        """
         await self.init()
         async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query, args)
-                return await cur.fetchall()
+            await conn.begin()
+            try:
+                async with conn.cursor() as cur:
+                    yield _Cursor(conn, cur, self.query_timeout, self.observer)
+                t0 = time.perf_counter()
+                await conn.commit()
+                if self.observer:
+                    self.observer("COMMIT", time.perf_counter() - t0, True)
+            except BaseException:
+                if not conn.closed:
+                    await conn.rollback()
+                raise
+
+    async def fetchone(self, query: str, args: Tuple = ()) -> Optional[Tuple[Any]]:
+        """執行查詢並回傳第一筆資料"""
+        async with self.connection() as cur:
+            await cur.execute(query, args)
+            return await cur.fetchone()
+
+    async def fetchall(self, query: str, args: Tuple = ()) -> List[Tuple[Any]]:
+        """執行查詢並回傳所有結果"""
+        async with self.connection() as cur:
+            await cur.execute(query, args)
+            return await cur.fetchall()
 
     async def execute(self, query: str, args: Tuple = ()) -> int:
-        """執行 INSERT/UPDATE/DELETE，並回傳受影響列數"""
-        await self.init()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                rows = await cur.execute(query, args)
-                await conn.commit()
-                return rows
+        """執行 INSERT/UPDATE/DELETE，並回傳受影響列數（單條語句不必 BEGIN，直接提交）"""
+        async with self.connection() as cur:
+            rows = await cur.execute(query, args)
+            await cur.conn.commit()
+            return rows
 
     async def executemany(self, query: str, param_list: List[Tuple]) -> int:
         """批次執行多筆 INSERT/UPDATE"""
-        await self.init()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                rows = await cur.executemany(query, param_list)
-                await conn.commit()
-                return rows
+        async with self.connection() as cur:
+            rows = await cur.executemany(query, param_list)
+            await cur.conn.commit()
+            return rows
 
     async def close(self):
-        """關閉連線池"""
+        """优雅地关闭 aiomysql 连接池"""
         if self.pool is not None:
             self.pool.close()
             await self.pool.wait_closed()
+            self.pool = None
@@ -0,0 +1,89 @@
+"""
+近似重复视频索引（多索引哈希，Hamming 距离）
+
+以视频缩图（Telegram 附在 message.video 上的 thumbnail）的 64 位 pHash 为键。
+把 64 位切成 max_distance + 1 段：距离不超过 max_distance 的两个哈希，至少有一段完全相同
+（鸽笼原理），所以查询只需查每段的字典取候选，再逐个验证真实距离。
+
+同时比较时长与长宽比，避免同一片头 / 纯色缩图的不同视频被误判为重复。
+"""
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+HASH_BITS = 64
+
+
+@dataclass(frozen=True)
+class IndexedVideo:
+    file_unique_id: str
+    thumb_hash: int
+    duration: int
+    aspect: float
+
+
+def thumb_phash(image: "Image.Image") -> str:
+    """缩图的 pHash（16 位十六进制，与 photo.hash 同格式）；imagehash 第一次用到时才载入"""
+    import imagehash
+
+    return str(imagehash.phash(image))
+
+
+def _segments(bits: int, parts: int) -> List[Tuple[int, int]]:
+    """把 bits 个位元尽量平均切成 parts 段：[(shift, mask)]"""
+    sizes = [bits // parts + (1 if i < bits % parts else 0) for i in range(parts)]
+    segments = []
+    shift = 0
+    for size in sizes:
+        segments.append((shift, (1 << size) - 1))
+        shift += size
+    return segments
+
+
+class DuplicateIndex:
+    def __init__(self, max_distance: int = 4, duration_tolerance: int = 1, aspect_tolerance: float = 0.02):
+        self.max_distance = max_distance
+        self.duration_tolerance = duration_tolerance
+        self.aspect_tolerance = aspect_tolerance
+        self._segments = _segments(HASH_BITS, max_distance + 1)
+        self._tables: List[Dict[int, List[IndexedVideo]]] = [{} for _ in self._segments]
+        self._keys = set()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, file_unique_id: str, thumb_hash: str, duration: Optional[int], width: Optional[int],
+            height: Optional[int]):
+        if file_unique_id in self._keys or not thumb_hash:
+            return
+        entry = IndexedVideo(file_unique_id, int(thumb_hash, 16), duration or 0,
+                             (width / height) if width and height else 0.0)
+        for table, (shift, mask) in zip(self._tables, self._segments):
+            table.setdefault((entry.thumb_hash >> shift) & mask, []).append(entry)
+        self._keys.add(file_unique_id)
+
+    def query(self, thumb_hash: str, duration: Optional[int], width: Optional[int],
+              height: Optional[int]) -> Optional[Tuple[int, IndexedVideo]]:
+        """最接近且时长、长宽比都相符的已处理视频：(距离, 条目)，找不到回传 None"""
+        value = int(thumb_hash, 16)
+        aspect = (width / height) if width and height else 0.0
+        best = None
+        seen = set()
+        for table, (shift, mask) in zip(self._tables, self._segments):
+            for entry in table.get((value >> shift) & mask, ()):
+                if entry.file_unique_id in seen:
+                    continue
+                seen.add(entry.file_unique_id)
+                distance = bin(entry.thumb_hash ^ value).count("1")
+                if distance > self.max_distance:
+                    continue
+                if abs(entry.duration - (duration or 0)) > self.duration_tolerance:
+                    continue
+                if aspect and entry.aspect and abs(entry.aspect - aspect) > self.aspect_tolerance:
+                    continue
+                if best is None or distance < best[0]:
+                    best = (distance, entry)
+        return best
@@ -0,0 +1,52 @@
+"""
+视频下载后端
+
+- botapi：getFile 取得 file_path，再从 Bot API 文件服务器串流下载（走 aiogram 的 aiohttp 连线池）。
+  不需要 MTProto 登录、get_messages 或切换 DC；只能下载 limit 以内的文件
+  （官方 Bot API 为 20 MB，自建 Bot API server 可调大）。
+- mtproto：Telethon 分块并行下载 / 部分下载（在 grid_main），没有大小限制。
+
+select_backends 依 video.file_size 决定尝试顺序：大小已知且在上限内先走 botapi，失败再退回 mtproto；
+大小未知或超过上限直接走 mtproto。
+"""
+import os
+from typing import List, Optional, Sequence
+
+from aiogram import Bot
+
+
+BOT_API_FILE_LIMIT = 20 * 1024 * 1024
+
+
+class FileTooBig(Exception):
+    """getFile 回报的大小超过 Bot API 可下载的上限"""
+
+
+def select_backends(file_size: Optional[int], backends: Sequence[str], limit: int = BOT_API_FILE_LIMIT) -> List[str]:
+    """按设定的顺序过滤掉这个大小用不了的后端（botapi 需要已知且不超过 limit 的大小）"""
+    return [b for b in backends if b != "botapi" or (file_size and file_size <= limit)]
+
+
+async def bot_api_download(
+    bot: Bot,
+    file_id: str,
+    save_path: str,
+    limit: int = BOT_API_FILE_LIMIT,
+    timeout: int = 120,
+    chunk_size: int = 256 * 1024
+) -> int:
+    """
+    先写到 <save_path>.part，完整下载后才改名，中断时不会留下看似完整的文件。
+    回传下载的字节数。
+    """
+    file = await bot.get_file(file_id)
+    if file.file_size and file.file_size > limit:
+        raise FileTooBig(f"{file.file_size} bytes > {limit}")
+    tmp_path = f"{save_path}.part"
+    try:
+        await bot.download_file(file.file_path, destination=tmp_path, timeout=timeout, chunk_size=chunk_size)
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return os.path.getsize(save_path)
@@ -0,0 +1,283 @@
+"""
+Bot API update 接收
+
+- long_poll：GetUpdates 带服务端 timeout 长轮询，有 update 立即返回，处理完马上发下一次请求，
+  不再固定 sleep。
+- serve_webhook：aiohttp 接收 Telegram 推送，立即回 200，后台按小批次（最多 batch_size 个、
+  或等待 batch_window 秒）提交。
+
+两种方式都把 update 列表交给 UpdateDispatcher：按 chat 分组，不同 chat 并发处理（上限 concurrency），
+同一 chat 内严格按顺序。scrap_progress 由 ProgressCheckpoint 按时间/数量批量写入，
+只推进到“之前所有 update 都已处理完”的位置。长轮询的 offset 推进到已提交的 update 之后，
+在途的 update 由 dispatcher 跟踪（上限 max_pending），处理到哪里以 scrap_progress 为准。
+"""
+import asyncio
+import hmac
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramConflictError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import GetUpdates
+from aiogram.types import Update
+
+
+HandleUpdates = Callable[[List[Update]], Awaitable[None]]
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+SEEN_LIMIT = 10000
+
+
+class ProgressCheckpoint:
+    """记住已完成的 update_id，每 interval 秒或每 every 个 update 才真正写一次"""
+
+    def __init__(self, save: Callable[[int], Awaitable[None]], last_saved: int = 0,
+                 interval: float = 30, every: int = 500):
+        self.save = save
+        self.interval = interval
+        self.every = every
+        self.last_saved = last_saved
+        self.update_id = last_saved
+        self._since_save = 0
+        self._saved_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def advance_to(self, update_id: int, count: int = 1):
+        self.update_id = max(self.update_id, update_id)
+        self._since_save += count
+
+    async def maybe_flush(self, force: bool = False):
+        # 加锁：并发的 worker 不会把较旧的 update_id 写在较新的之后
+        async with self._lock:
+            if self.update_id == self.last_saved:
+                return
+            if not force and self._since_save < self.every and time.monotonic() - self._saved_at < self.interval:
+                return
+            update_id = self.update_id
+            try:
+                await self.save(update_id)
+            except Exception as e:
+                # 写入失败不影响处理：last_saved 不变，下一个间隔再写
+                print(f"⚠️ scrap_progress 写入失败，稍后重试：{e}", flush=True)
+            else:
+                self.last_saved = update_id
+            self._since_save = 0
+            self._saved_at = time.monotonic()
+
+
+def chat_key(update: Update) -> int:
+    return update.message.chat.id if update.message else 0
+
+
+class UpdateDispatcher:
+    """
+    submit 把一批 update 按 chat 切开，每个 chat 一个 worker 依序处理自己的切片，
+    同时处理的切片数受 concurrency 限制。已提交未完成的 update 超过 max_pending 时 submit 等待。
+    """
+
+    def __init__(self, handle: HandleUpdates, checkpoint: ProgressCheckpoint,
+                 concurrency: int = 8, max_pending: int = 1000):
+        self.handle = handle
+        self.checkpoint = checkpoint
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._chats: Dict[int, Deque[List[Update]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._pending: Set[int] = set()
+        self._highest = checkpoint.update_id
+        # 最近提交过的 update_id：webhook 可能重送，也可能乱序到达，不能只和最大值比较
+        self._seen: Set[int] = set()
+        self._seen_order: Deque[int] = deque()
+        self._room = asyncio.Event()
+        self._room.set()
+
+    @property
+    def highest(self) -> int:
+        """已提交的最大 update_id（长轮询用它决定下一次的 offset）"""
+        return self._highest
+
+    async def submit(self, updates: List[Update]):
+        await self._room.wait()
+        slices: Dict[int, List[Update]] = {}
+        for update in sorted(updates, key=lambda u: u.update_id):
+            if update.update_id in self._seen or update.update_id <= self.checkpoint.last_saved:
+                continue  # 重送
+            self._remember(update.update_id)
+            self._pending.add(update.update_id)
+            self._highest = max(self._highest, update.update_id)
+            slices.setdefault(chat_key(update), []).append(update)
+        for chat, items in slices.items():
+            self._chats.setdefault(chat, deque()).append(items)
+            if chat not in self._workers:
+                self._workers[chat] = asyncio.create_task(self._run_chat(chat))
+        if len(self._pending) >= self.max_pending:
+            self._room.clear()
+
+    def _remember(self, update_id: int):
+        self._seen.add(update_id)
+        self._seen_order.append(update_id)
+        while len(self._seen_order) > SEEN_LIMIT:
+            self._seen.discard(self._seen_order.popleft())
+
+    async def _run_chat(self, chat: int):
+        queue = self._chats[chat]
+        try:
+            while queue:
+                items = queue.popleft()
+                async with self._slots:
+                    try:
+                        await self.handle(items)
+                    except Exception as e:
+                        print(f"❌ chat {chat} 的 update 处理失败：{e}", flush=True)
+                self._complete(items)
+                await self.checkpoint.maybe_flush()
+        finally:
+            del self._workers[chat]
+            if not queue:
+                del self._chats[chat]
+
+    def _complete(self, items: List[Update]):
+        for update in items:
+            self._pending.discard(update.update_id)
+        # 只推进到最早一个未完成的 update 之前
+        done_through = min(self._pending) - 1 if self._pending else self._highest
+        self.checkpoint.advance_to(done_through, len(items))
+        if len(self._pending) < self.max_pending:
+            self._room.set()
+
+    async def drain(self):
+        """等所有已提交的 update 处理完，再强制写一次 checkpoint"""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+        await self.checkpoint.maybe_flush(force=True)
+
+
+async def long_poll(
+    bot: Bot,
+    dispatcher: UpdateDispatcher,
+    stop: asyncio.Event,
+    timeout: int = 50,
+    limit: int = 100
+):
+    """
+    offset 从 checkpoint 之后开始，之后推进到已提交的最大 update_id + 1：提交过的 update 交给 dispatcher
+    处理，不必等慢的 chat 处理完才拉下一页；在途的 update 达到 max_pending 时 submit 等待，这里跟着暂停。
+    GetUpdates 第一次 Conflict 时查一次 getWebhookInfo：设着 webhook（从 webhook 模式切回来）就 deleteWebhook
+    （保留待推送的 update）后继续；没有 webhook（另一个实例在轮询）则把 TelegramConflictError 抛给调用方。
+    """
+    offset = dispatcher.highest + 1
+    print(f"📥 Long polling from offset={offset} (timeout={timeout}s)", flush=True)
+    failures = 0
+    webhook_checked = False
+    try:
+        while not stop.is_set():
+            try:
+                updates: List[Update] = await bot(
+                    GetUpdates(offset=offset, limit=limit, timeout=timeout),
+                    request_timeout=timeout + 10
+                )
+                failures = 0
+            except TelegramConflictError:
+                if webhook_checked or not (await bot.get_webhook_info()).url:
+                    raise
+                webhook_checked = True
+                print("⚠️ 仍设着 webhook，删除后改为长轮询", flush=True)
+                await bot.delete_webhook(drop_pending_updates=False)
+                continue
+            except TelegramRetryAfter as e:
+                print(f"⚠️ GetUpdates 被限流 {e.retry_after}s", flush=True)
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (TelegramNetworkError, TelegramServerError) as e:
+                failures += 1
+                delay = min(60, 2 ** failures)
+                print(f"⚠️ GetUpdates 失败，{delay}s 后重试：{e}", flush=True)
+                await asyncio.sleep(delay)
+                continue
+
+            if updates:
+                await dispatcher.submit(updates)
+                offset = dispatcher.highest + 1
+            await dispatcher.checkpoint.maybe_flush()
+    finally:
+        await dispatcher.drain()
+
+
+async def serve_webhook(
+    bot: Bot,
+    dispatcher: UpdateDispatcher,
+    stop: asyncio.Event,
+    url: Optional[str],
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    path: str = "/webhook",
+    secret: Optional[str] = None,
+    batch_size: int = 100,
+    batch_window: float = 0.2,
+    queue_size: int = 1000
+):
+    """
+    url 不为空时先 setWebhook（Telegram 推送到 url，url 应转发到本机 host:port/path）。
+    secret 用于校验 X-Telegram-Bot-Api-Secret-Token。
+    """
+    from aiohttp import web
+
+    queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+    async def receive(request: web.Request) -> web.Response:
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=403)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except ValueError as e:
+            print(f"⚠️ 无法解析 webhook update：{e}", flush=True)
+            return web.Response(status=400)
+        # 队列满时这里会等待，Telegram 看到响应变慢会自动放缓推送
+        await queue.put(update)
+        return web.Response()
+
+    async def consume():
+        """None 表示停止：处理完手上的批次后返回"""
+        closing = False
+        while not closing:
+            first = await queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + batch_window
+            while len(batch) < batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    update = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if update is None:
+                    closing = True
+                    break
+                batch.append(update)
+            await dispatcher.submit(batch)
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"🌐 Webhook listening on {host}:{port}{path}", flush=True)
+
+    if url:
+        await bot.set_webhook(url=url, secret_token=secret or None)
+        print(f"🌐 setWebhook → {url}", flush=True)
+
+    consumer = asyncio.create_task(consume())
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        # 已经回了 200 的 update 不能丢：处理完队列里剩余的再退出
+        await queue.put(None)
+        await asyncio.gather(consumer, return_exceptions=True)
+        await dispatcher.drain()
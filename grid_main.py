@@ -3,29 +3,45 @@ import asyncio
 from dotenv import load_dotenv
 from aiogram import Bot
 from aiogram.enums import ParseMode
-from aiogram.methods import GetUpdates
 
-from aiogram.types import Update, Message, FSInputFile
+from aiogram.types import Update, Message, FSInputFile, InputFile, InputMediaDocument
 from aiogram.client.default import DefaultBotProperties
 from aiogram.exceptions import TelegramConflictError
-from grid_db import MySQLManager
+from grid_db import MySQLManager, in_clause, values_rows
 from pathlib import Path
-from moviepy import VideoFileClip
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
 import json
-from PIL import Image, ImageDraw, ImageFont
-import imagehash
+import time
+import uuid
+from grid_pool import RecyclingProcessPool
+from grid_transfer import (
+    PartDownloader, PartUploader, discard_part_state, iter_file_parts, sidecar_path, upload_sidecar_path
+)
+import grid_cache
+import grid_intake
+import grid_dedup
+import grid_metrics
+import grid_scratch
+import grid_download
+import grid_scheduler
+import grid_backfill
 
 import shutil
 import subprocess
+import sys
 
 
-from telethon import TelegramClient
-from telethon.sessions import StringSession
-from telethon.errors import FloodWaitError
-from telethon.errors import FileMigrateError
-from telethon.tl.functions.upload import GetFileRequest
+from grid_session import FileSessionStore, MySQLSessionStore, PersistentTelegramClient, session_name
+from telethon.errors import FilePartMissingError, FloodWaitError
 from telethon.tl.types import InputDocumentFileLocation, InputPeerChannel
 
+# 媒体库（numpy / Pillow / imagehash / moviepy）在任务真正需要时才载入：
+# 没有任务的启动不必为它们付出 import 时间
+if TYPE_CHECKING:
+    import grid_zip
+    from grid_render import RenderedGrid
+
 load_dotenv()
 
 current_job_id = None
@@ -39,15 +55,138 @@ try:
 except Exception as e:
     print(f"⚠️ 無法解析 CONFIGURATION：{e}")
 
+def config_flag(key: str, env: str, default: bool) -> bool:
+    """布尔开关：CONFIGURATION 中的 true/false 或环境变量中的 1/0、true/false"""
+    value = config.get(key, os.getenv(env))
+    if value is None:
+        return default
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
 BOT_TOKEN =  config.get('bot_token', os.getenv('BOT_TOKEN'))
 API_ID = int(config.get('api_id', os.getenv('API_ID', 0)))
 API_HASH = config.get('api_hash', os.getenv('API_HASH', ''))
 TELEGROUP_THUMB = int(config.get('telegroup_thumb', os.getenv('TELEGROUP_THUMB', 0)))
 TELEGROUP_ARCHIVE = int(config.get('telegroup_archive', os.getenv('TELEGROUP_ARCHIVE', 0)))
 TELEGROUP_RELY_BOT = int(config.get('telegroup_rely_bot', os.getenv('TELEGROUP_RELY_BOT', 0)))
-
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-tele_client = TelegramClient(StringSession(), API_ID, API_HASH)
+# 雪碧图 / 动画预览发送到的 chat（完整 chat id，0 = 与 ZIP 备份同一个群；TELEGROUP_ARCHIVE 不含 -100 前缀）
+TELEGROUP_PREVIEW = int(config.get('telegroup_preview', os.getenv('TELEGROUP_PREVIEW', 0))) or (
+    int(f"-100{TELEGROUP_ARCHIVE}") if TELEGROUP_ARCHIVE else 0
+)
+
+# 抽帧后端：ffmpeg（关键帧 seek）或 moviepy；FRAME_WIDTH>0 时在解码端缩小到该宽度
+FRAME_BACKEND = config.get('frame_backend', os.getenv('FRAME_BACKEND', 'ffmpeg'))
+FRAME_WIDTH = int(config.get('frame_width', os.getenv('FRAME_WIDTH', 0))) or None
+# 网格画布总宽度（优先于 FRAME_WIDTH），0 表示按原始分辨率拼接；JPEG 编码质量
+GRID_CANVAS_WIDTH = int(config.get('grid_canvas_width', os.getenv('GRID_CANVAS_WIDTH', 0))) or None
+GRID_JPEG_QUALITY = int(config.get('grid_jpeg_quality', os.getenv('GRID_JPEG_QUALITY', 75)))
+# 与网格共用一次抽帧的额外预览：拖动预览雪碧图（rows x cols、单格宽度、JPEG 质量，附 WebVTT 索引）
+RENDER_SPRITE = config_flag('render_sprite', 'RENDER_SPRITE', False)
+SPRITE_ROWS = int(config.get('sprite_rows', os.getenv('SPRITE_ROWS', 5)))
+SPRITE_COLS = int(config.get('sprite_cols', os.getenv('SPRITE_COLS', 5)))
+SPRITE_TILE_WIDTH = int(config.get('sprite_tile_width', os.getenv('SPRITE_TILE_WIDTH', 160)))
+SPRITE_JPEG_QUALITY = int(config.get('sprite_jpeg_quality', os.getenv('SPRITE_JPEG_QUALITY', 70)))
+# 动画预览（webp / gif）：帧数（从已解码的时间点中挑选）、宽度、每帧毫秒数、质量
+RENDER_ANIMATION = config_flag('render_animation', 'RENDER_ANIMATION', False)
+ANIMATION_FORMAT = config.get('animation_format', os.getenv('ANIMATION_FORMAT', 'webp'))
+ANIMATION_FRAMES = int(config.get('animation_frames', os.getenv('ANIMATION_FRAMES', 10)))
+ANIMATION_WIDTH = int(config.get('animation_width', os.getenv('ANIMATION_WIDTH', 320)))
+ANIMATION_FRAME_MS = int(config.get('animation_frame_ms', os.getenv('ANIMATION_FRAME_MS', 400)))
+ANIMATION_QUALITY = int(config.get('animation_quality', os.getenv('ANIMATION_QUALITY', 60)))
+
+# 渲染进程池：worker 数（0 = 在线程里渲染）、每个 worker 处理多少个任务后回收
+RENDER_WORKERS = int(config.get('render_workers', os.getenv('RENDER_WORKERS', 1)))
+RENDER_JOBS_PER_WORKER = int(config.get('render_jobs_per_worker', os.getenv('RENDER_JOBS_PER_WORKER', 20)))
+FONT_PATH = "fonts/Roboto_Condensed-Regular.ttf"
+
+# MTProto 分块下载：分块大小（512 KiB / 1 MiB）与同时在途的请求数
+DOWNLOAD_PART_SIZE = int(config.get('download_part_size', os.getenv('DOWNLOAD_PART_SIZE', 512 * 1024)))
+DOWNLOAD_PARALLEL = int(config.get('download_parallel', os.getenv('DOWNLOAD_PARALLEL', 4)))
+
+# 视频下载后端的尝试顺序：botapi 只用于大小已知且不超过 BOT_API_FILE_LIMIT 的文件，其余走 mtproto
+DOWNLOAD_BACKENDS = [b.strip() for b in config.get('download_backends', os.getenv('DOWNLOAD_BACKENDS', 'botapi,mtproto')).split(',') if b.strip()]
+BOT_API_FILE_LIMIT = int(config.get('bot_api_file_limit', os.getenv('BOT_API_FILE_LIMIT', grid_download.BOT_API_FILE_LIMIT)))
+BOT_API_DOWNLOAD_TIMEOUT = int(config.get('bot_api_download_timeout', os.getenv('BOT_API_DOWNLOAD_TIMEOUT', 120)))
+
+# 部分下载：先只取 moov 与采样关键帧所在的分块出网格，完整视频到打包 ZIP 时才补齐
+PARTIAL_FETCH = config_flag('partial_fetch', 'PARTIAL_FETCH', True)
+PARTIAL_FETCH_MIN_SIZE = int(config.get('partial_fetch_min_size', os.getenv('PARTIAL_FETCH_MIN_SIZE', 32 * 1024 * 1024)))
+# 是否打包加密 ZIP 上传到归档群（关闭时部分下载的任务不再需要完整视频）
+ARCHIVE_ENABLED = config_flag('archive_enabled', 'ARCHIVE_ENABLED', True)
+# 流式 AES ZIP 直接分块上传（需要 cryptography）。AES 归档只有 7-Zip / WinZip / WinRAR 能解，
+# 所以默认关闭，仍用 zip -0 -P（ZipCrypto）写临时文件；流无法建立时也退回 zip 命令
+ARCHIVE_STREAM = config_flag('archive_stream', 'ARCHIVE_STREAM', False)
+# MTProto 分块上传：分块大小（最大 512 KiB）、同时在途的分块数、整体续传次数
+UPLOAD_PART_SIZE = int(config.get('upload_part_size', os.getenv('UPLOAD_PART_SIZE', 512 * 1024)))
+UPLOAD_PARALLEL = int(config.get('upload_parallel', os.getenv('UPLOAD_PARALLEL', 8)))
+ARCHIVE_UPLOAD_ATTEMPTS = int(config.get('archive_upload_attempts', os.getenv('ARCHIVE_UPLOAD_ATTEMPTS', 3)))
+
+# 暂存空间：目录、总预算（MB，0 = 只看磁盘剩余）、磁盘至少保留的空间（MB）、
+# 每个任务在视频之外预留的空间（MB，预览图与 sidecar）、启动时清理多少小时前的残留文件
+SCRATCH_DIR = config.get('scratch_dir', os.getenv('SCRATCH_DIR', 'temp'))
+SCRATCH_BUDGET_MB = int(config.get('scratch_budget_mb', os.getenv('SCRATCH_BUDGET_MB', 0)))
+SCRATCH_MIN_FREE_MB = int(config.get('scratch_min_free_mb', os.getenv('SCRATCH_MIN_FREE_MB', 512)))
+SCRATCH_JOB_OVERHEAD_MB = int(config.get('scratch_job_overhead_mb', os.getenv('SCRATCH_JOB_OVERHEAD_MB', 16)))
+SCRATCH_STALE_HOURS = float(config.get('scratch_stale_hours', os.getenv('SCRATCH_STALE_HOURS', 24)))
+
+# 任务模式：once = 处理一个任务后退出（cron）；loop = 常驻流水线消费 grid_jobs
+WORKER_MODE = config.get('worker_mode', os.getenv('WORKER_MODE', 'once'))
+GRID_IDLE_SLEEP = int(config.get('grid_idle_sleep', os.getenv('GRID_IDLE_SLEEP', 30)))
+# 单次模式没有任务时，继续轮询入库多少秒再结束
+ONCE_IDLE_WAIT = float(config.get('once_idle_wait', os.getenv('ONCE_IDLE_WAIT', 60)))
+# 流水线各阶段并发数（下载并发 = 同时认领的任务数）、阶段间队列长度、队列深度汇报间隔（秒）
+PIPELINE_DOWNLOADS = int(config.get('pipeline_downloads', os.getenv('PIPELINE_DOWNLOADS', 2)))
+PIPELINE_RENDERS = int(config.get('pipeline_renders', os.getenv('PIPELINE_RENDERS', 1)))
+PIPELINE_UPLOADS = int(config.get('pipeline_uploads', os.getenv('PIPELINE_UPLOADS', 2)))
+PIPELINE_QUEUE_SIZE = int(config.get('pipeline_queue_size', os.getenv('PIPELINE_QUEUE_SIZE', 2)))
+PIPELINE_REPORT_INTERVAL = int(config.get('pipeline_report_interval', os.getenv('PIPELINE_REPORT_INTERVAL', 60)))
+# 调度：认领顺序 fifo / smallest / priority（见 grid_scheduler）、本 BOT 新任务的 priority
+JOB_POLICY = config.get('job_policy', os.getenv('JOB_POLICY', 'fifo'))
+JOB_PRIORITY = int(config.get('job_priority', os.getenv('JOB_PRIORITY', 0)))
+# 租约（秒）：处理中的任务每 JOB_HEARTBEAT_INTERVAL 秒续约一次，超过 JOB_LEASE_SECONDS 没续约就被收回
+JOB_LEASE_SECONDS = int(config.get('job_lease_seconds', os.getenv('JOB_LEASE_SECONDS', 600)))
+JOB_HEARTBEAT_INTERVAL = int(config.get('job_heartbeat_interval', os.getenv('JOB_HEARTBEAT_INTERVAL', 60)))
+# 失败重试：最多 JOB_MAX_ATTEMPTS 次，第 n 次失败后等 JOB_RETRY_BASE * 2^(n-1) 秒（上限 JOB_RETRY_MAX）
+JOB_MAX_ATTEMPTS = int(config.get('job_max_attempts', os.getenv('JOB_MAX_ATTEMPTS', 5)))
+JOB_RETRY_BASE = int(config.get('job_retry_base', os.getenv('JOB_RETRY_BASE', 60)))
+JOB_RETRY_MAX = int(config.get('job_retry_max', os.getenv('JOB_RETRY_MAX', 3600)))
+JOB_ORDER = grid_scheduler.order_by(JOB_POLICY)
+
+# update 接收：poll = GetUpdates 长轮询（POLL_TIMEOUT 为服务端等待秒数）；webhook = aiohttp 接收推送
+UPDATE_MODE = config.get('update_mode', os.getenv('UPDATE_MODE', 'poll'))
+POLL_TIMEOUT = int(config.get('poll_timeout', os.getenv('POLL_TIMEOUT', 50)))
+WEBHOOK_URL = config.get('webhook_url', os.getenv('WEBHOOK_URL', ''))
+WEBHOOK_HOST = config.get('webhook_host', os.getenv('WEBHOOK_HOST', '0.0.0.0'))
+WEBHOOK_PORT = int(config.get('webhook_port', os.getenv('WEBHOOK_PORT', 8080)))
+WEBHOOK_PATH = config.get('webhook_path', os.getenv('WEBHOOK_PATH', '/webhook'))
+WEBHOOK_SECRET = config.get('webhook_secret', os.getenv('WEBHOOK_SECRET', ''))
+WEBHOOK_BATCH_WINDOW = float(config.get('webhook_batch_window', os.getenv('WEBHOOK_BATCH_WINDOW', 0.2)))
+# scrap_progress 批量写入：每隔多少秒或累计多少个 update 写一次
+PROGRESS_CHECKPOINT_INTERVAL = int(config.get('progress_checkpoint_interval', os.getenv('PROGRESS_CHECKPOINT_INTERVAL', 30)))
+PROGRESS_CHECKPOINT_UPDATES = int(config.get('progress_checkpoint_updates', os.getenv('PROGRESS_CHECKPOINT_UPDATES', 500)))
+
+# 近似重复：用视频缩图的 pHash 找已处理过的视频（距离上限、时长容差秒数）
+DEDUP_ENABLED = config_flag('dedup_enabled', 'DEDUP_ENABLED', True)
+DEDUP_MAX_DISTANCE = int(config.get('dedup_max_distance', os.getenv('DEDUP_MAX_DISTANCE', 4)))
+DEDUP_DURATION_TOLERANCE = int(config.get('dedup_duration_tolerance', os.getenv('DEDUP_DURATION_TOLERANCE', 1)))
+
+# Telethon 会话保存位置：mysql（telethon_session 表）、file（TELETHON_SESSION_FILE）或 memory（不保存）
+TELETHON_SESSION_STORE = config.get('telethon_session_store', os.getenv('TELETHON_SESSION_STORE', 'mysql'))
+TELETHON_SESSION_FILE = config.get('telethon_session_file', os.getenv('TELETHON_SESSION_FILE', 'telethon_session.json'))
+
+# 指标：JSON 行输出路径（"-" = stdout，空 = 关闭）、Prometheus /metrics 端口（0 = 关闭）；
+# 下载/上传进度最多每 PROGRESS_INTERVAL 秒打印一次
+METRICS_JSON = config.get('metrics_json', os.getenv('METRICS_JSON', ''))
+METRICS_HOST = config.get('metrics_host', os.getenv('METRICS_HOST', '0.0.0.0'))
+METRICS_PORT = int(config.get('metrics_port', os.getenv('METRICS_PORT', 0)))
+PROGRESS_INTERVAL = float(config.get('progress_interval', os.getenv('PROGRESS_INTERVAL', 5)))
+
+# 缩图状态缓存：条目上限、已有缩图的 TTL、缺少缩图的 TTL（秒）
+THUMB_CACHE_SIZE = int(config.get('thumb_cache_size', os.getenv('THUMB_CACHE_SIZE', 50000)))
+THUMB_CACHE_TTL = int(config.get('thumb_cache_ttl', os.getenv('THUMB_CACHE_TTL', 3600)))
+THUMB_CACHE_MISSING_TTL = int(config.get('thumb_cache_missing_ttl', os.getenv('THUMB_CACHE_MISSING_TTL', 300)))
+
+# 没有 BOT_TOKEN 时不建立 Bot / TelegramClient：backfill 等离线命令只需要数据库
+bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML)) if BOT_TOKEN else None
 
 db = MySQLManager({
     "host": config.get("db_host", os.getenv("MYSQL_DB_HOST", "localhost")),
@@ -55,28 +194,111 @@ db = MySQLManager({
     "user": config.get('db_user', os.getenv('MYSQL_DB_USER')),
     "password": config.get('db_password', os.getenv('MYSQL_DB_PASSWORD')),
     "db": config.get('db_name', os.getenv('MYSQL_DB_NAME')),
-    "autocommit": True
+    "autocommit": True,
+    # 连线池大小、启动时预热、每条语句的逾时（秒，0 = 不限）
+    "minsize": int(config.get('db_pool_min', os.getenv('MYSQL_POOL_MIN', 1))),
+    "maxsize": int(config.get('db_pool_max', os.getenv('MYSQL_POOL_MAX', 10))),
+    "pool_recycle": int(config.get('db_pool_recycle', os.getenv('MYSQL_POOL_RECYCLE', 3600))),
+    "connect_timeout": float(config.get('db_connect_timeout', os.getenv('MYSQL_CONNECT_TIMEOUT', 10))),
+    "prewarm": config_flag('db_prewarm', 'MYSQL_PREWARM', False),
+    "query_timeout": float(config.get('db_query_timeout', os.getenv('MYSQL_QUERY_TIMEOUT', 30)))
 })
 
+metrics = grid_metrics.Metrics(json_path=METRICS_JSON or None)
+
+
+def observe_query(query: str, seconds: float, ok: bool):
+    metrics.observe("db_query_seconds", seconds, {"statement": grid_metrics.sql_label(query)}, ok=ok)
+
+
+db.observer = observe_query
+
+# Telethon 会话：存到 MySQL 或文件，下次启动直接沿用授权（memory = 不保存）
+if TELETHON_SESSION_STORE == 'file':
+    session_store = FileSessionStore(TELETHON_SESSION_FILE)
+elif TELETHON_SESSION_STORE == 'mysql':
+    session_store = MySQLSessionStore(db)
+else:
+    session_store = None
+tele_client = (
+    PersistentTelegramClient(session_store, session_name(API_ID, BOT_TOKEN), API_ID, API_HASH)
+    if BOT_TOKEN else None
+)
+telethon_ready = False
+telethon_lock = asyncio.Lock()
+
+# 同时入库的 chat 数（同一 chat 内依序处理）
+DISPATCH_CONCURRENCY = int(config.get('dispatch_concurrency', os.getenv('DISPATCH_CONCURRENCY', db.config['maxsize'])))
+
 
 
-DOWNLOAD_DIR = Path("downloads")
-DOWNLOAD_DIR.mkdir(exist_ok=True)
+scratch = grid_scratch.ScratchSpace(
+    SCRATCH_DIR,
+    budget=SCRATCH_BUDGET_MB * 1024 * 1024,
+    min_free=SCRATCH_MIN_FREE_MB * 1024 * 1024,
+    stale_after=SCRATCH_STALE_HOURS * 3600
+)
+job_leases = grid_scheduler.JobLeases(db, JOB_LEASE_SECONDS)
+last_reclaim = 0.0
 shutdown_event = asyncio.Event()
+thumb_cache = grid_cache.ThumbnailCache(THUMB_CACHE_SIZE, THUMB_CACHE_TTL, THUMB_CACHE_MISSING_TTL)
+dedup_index = grid_dedup.DuplicateIndex(DEDUP_MAX_DISTANCE, DEDUP_DURATION_TOLERANCE)
+dedup_loaded = False   # 第一次查重时才载入（ensure_dedup_index）
+dedup_load_lock = asyncio.Lock()
+render_pool: Optional[RecyclingProcessPool] = None   # 第一次渲染时才建立（get_render_pool）
+metrics_runner = None
 BOT_NAME = None
 BOT_ID = None
 
 
+@dataclass
+class GridJob:
+    """一个 grid_jobs 任务及其在各阶段之间传递的产物"""
+    id: int
+    file_id: str
+    file_unique_id: str
+    chat_id: int
+    message_id: int
+    file_size: Optional[int] = None   # video.file_size（认领时用来预留暂存空间）
+    retry_count: int = 0   # 之前失败过几次（决定下次重试的等待时间）
+    claim_token: Optional[str] = None   # 认领时写入的 token，失败重排只改这次认领的行
+    grid_file_id: Optional[str] = None   # 网格已入库、只差 ZIP 归档的任务（归档上传失败后的重试）
+    finished: bool = False   # 已是 done 或不再重试的 failed：release_job 才删除暂存文件
+    video_path: Optional[str] = None
+    preview_path: Optional[str] = None
+    phash: Optional[str] = None
+    frame_hashes: Optional[list[str]] = None   # 每格的 pHash
+    partial: bool = False   # video_path 只有网格需要的分块
+    download_backend: Optional[str] = None   # 实际完成下载的后端（botapi / mtproto）
+    timings: dict = field(default_factory=dict)   # 各阶段耗时（秒），任务结束时写入 stage_timings
+    artifacts: list[str] = field(default_factory=list)   # 雪碧图、索引、动画等额外预览文件
+
+
 async def start_telethon():
-    if not tele_client.is_connected():
-        await tele_client.connect()
-    try:
-        await tele_client.start(bot_token=BOT_TOKEN)
-    except FloodWaitError as e:
-        print(f"⚠️ 导入 Bot 授权被限流 {e.seconds}s，跳过",flush=True)
-        await asyncio.sleep(min(e.seconds, 60))
-    except Exception as e:
-        print(f"❌ 导入 Bot 授权失败：{e}",flush=True)
+    """
+    第一次调用：载入保存的会话、连线、授权并保存会话。
+    之后只要仍然连线就直接返回（每次下载/上传前都会调用）。
+    """
+    global telethon_ready
+    if telethon_ready and tele_client.is_connected():
+        return
+    async with telethon_lock:
+        if telethon_ready and tele_client.is_connected():
+            return
+        with metrics.stage("telethon_start"):
+            await tele_client.restore()
+            if not tele_client.is_connected():
+                await tele_client.connect()
+            try:
+                # 会话已授权时 start 只做一次 get_me，不会再导入 bot 授权
+                await tele_client.start(bot_token=BOT_TOKEN)
+                telethon_ready = True
+            except FloodWaitError as e:
+                print(f"⚠️ 导入 Bot 授权被限流 {e.seconds}s，跳过",flush=True)
+                await asyncio.sleep(min(e.seconds, 60))
+            except Exception as e:
+                print(f"❌ 导入 Bot 授权失败：{e}",flush=True)
+            await tele_client.persist()
 
         
 
@@ -107,12 +329,12 @@ async def download_from_file_id3(
             file=f,
             offset=start,
             limit=(total - start) if total else None,
-            progress_callback=prog
+            progress_callback=grid_metrics.throttle(prog, PROGRESS_INTERVAL)
         )
     print(f"\n✔️ 下载完成：{save_path}",flush=True)
 
 
-async def safe_download(msg, save_path, try_resume: bool = False):
+async def safe_download(msg, save_path, try_resume: bool = True):
     doc = getattr(msg.media, 'document', None)
     
     if not doc or not getattr(doc, 'file_reference', None):
@@ -125,126 +347,216 @@ async def safe_download(msg, save_path, try_resume: bool = False):
         await msg.download_media(file=save_path)
         return
 
-    # 尝试 resume 模式
+    # 尝试 resume 模式（FileMigrateError 已在分块层面处理）
     try:
         await download_with_resume(msg, save_path)
-    except FileMigrateError as e:
-        print(f"🌐 DC迁移提示: 文件在 DC{e.new_dc}，尝试切换…",flush=True)
-        await tele_client._switch_dc(e.new_dc)
-        await download_with_resume(msg, save_path)
     except Exception as e:
         print(f"⚠️ resume下载失败，尝试 fallback download_media: {e}",flush=True)
+        discard_part_state(save_path)
         await msg.download_media(file=save_path)
 
 
-async def download_from_file_id(file_id, save_path, chat_id, message_id):
+async def fetch_source_message(chat_id, message_id):
     await start_telethon()
     msg = await tele_client.get_messages(chat_id, ids=message_id)
     if not msg or not msg.media:
         raise RuntimeError(f"❌ 获取消息失败: {chat_id}/{message_id}")
+    return msg
+
+
+async def download_from_file_id(file_id, save_path, chat_id, message_id):
+    msg = await fetch_source_message(chat_id, message_id)
     # Delegate to your chunked downloader:
     await safe_download(msg, save_path)
     return True
 
-async def download_with_resume(msg, save_path, chunk_size: int = 128 * 1024):
-    """
-    用 MTProto 分块下载并支持续传。
-    chunk_size 必须满足：
-      - 可被 4096 整除
-      - 1048576 (1 MiB) 可被 chunk_size 整除
-    128 KiB = 131072 bytes 符合要求（1 MiB / 128 KiB = 8）。
-    """
+
+def make_part_downloader(
+    msg,
+    save_path,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    parallel: int = DOWNLOAD_PARALLEL,
+    progress=None
+) -> PartDownloader:
     doc = msg.media.document
-    total = doc.size
 
     # 构造文件位置
     location = InputDocumentFileLocation(
         id=doc.id,
         access_hash=doc.access_hash,
         file_reference=doc.file_reference,
-        thumb_size=b""      # 原始文件
+        thumb_size=""      # 原始文件
     )
 
-    # 计算已下载字节
-    start = os.path.getsize(save_path) if os.path.exists(save_path) else 0
-    mode = 'ab' if start else 'wb'
-    print(f"⏯️ 从 {start}/{total} 处续传…", flush=True)
+    async def refresh_location():
+        # file_reference 过期：重新取消息拿新的 reference
+        fresh = await tele_client.get_messages(msg.chat_id, ids=msg.id)
+        location.file_reference = fresh.media.document.file_reference
+        return location
+
+    return PartDownloader(
+        tele_client,
+        location,
+        doc.size,
+        save_path,
+        part_size=part_size,
+        parallel=parallel,
+        dc_id=doc.dc_id,
+        progress=progress,
+        refresh_location=refresh_location
+    )
 
-    with open(save_path, mode) as f:
-        offset = start
-        while offset < total:
-            # 始终使用固定 chunk_size
-            resp = await tele_client(GetFileRequest(
-                location=location,
-                offset=offset,
-                limit=chunk_size
-            ))
-            data = resp.bytes
-            if not data:
-                break  # 没数据就结束
-            f.write(data)
-            offset += len(data)
 
-            # 打印进度
-            pct = offset / total * 100
-            print(f"\r📥 {offset}/{total} bytes ({pct:.1f}%)", end="", flush=True)
+async def download_keyframe_parts(msg, save_path, layouts) -> bool:
+    """
+    部分下载：以区间请求读出 moov，把所有预览版面（layouts）的采样时间点映射到关键帧样本，
+    只下载这些样本（及相邻关键帧）与文件头所在的分块，其余保持为稀疏空洞。
+    已下载的分块记在 sidecar 里，之后 download_with_resume 只补剩下的部分。
+    容器不支持时回传 False，由调用方改为完整下载。
+    """
+    doc = getattr(msg.media, 'document', None)
+    if not doc or not getattr(doc, 'file_reference', None) or doc.size < PARTIAL_FETCH_MIN_SIZE:
+        return False
+
+    from grid_mp4 import UnsupportedContainer, VideoTrackIndex, read_moov
+    from grid_render import timeline_times
+
+    downloader = make_part_downloader(msg, save_path)
+    try:
+        moov = await read_moov(downloader.read_range, doc.size)
+        index = VideoTrackIndex(moov)
+        samples = index.keyframe_samples(timeline_times(index.duration, layouts))
+        parts = set()
+        for offset, size in index.sample_ranges(samples):
+            parts.update(downloader.parts_for_range(offset, size))
+        await downloader.download(parts)
+    except UnsupportedContainer as e:
+        print(f"⚠️ 不支持部分下载，改为完整下载：{e}", flush=True)
+        return False
+    finally:
+        await downloader.close()
+
+    print(f"✔️ 部分下载完成：{len(downloader.done)}/{downloader.part_count} 个分块", flush=True)
+    return True
+
+async def download_with_resume(
+    msg,
+    save_path,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    parallel: int = DOWNLOAD_PARALLEL
+):
+    """
+    用 MTProto 分块并行下载并支持续传。
+    part_size 必须满足：
+      - 可被 4096 整除
+      - 1048576 (1 MiB) 可被 part_size 整除
+    同时有 parallel 个 GetFileRequest 在途，分块写入预分配文件的对应偏移，
+    已完成分块记录在 <save_path>.parts，崩溃后只补缺的分块。
+    """
+    def prog(cur, tot):
+        pct = cur / tot * 100 if tot else 0
+        print(f"\r📥 {cur}/{tot} bytes ({pct:.1f}%)", end="", flush=True)
+
+    downloader = make_part_downloader(
+        msg, save_path, part_size, parallel, progress=grid_metrics.throttle(prog, PROGRESS_INTERVAL)
+    )
+    print(f"⏯️ 下载 {downloader.total} bytes，{downloader.part_count} 个分块，{parallel} 路并行…", flush=True)
+    try:
+        await downloader.download()
+    finally:
+        await downloader.close()
 
     print(f"\n✔️ 下载完成: {save_path}", flush=True)
 
 
 
+def artifact_specs():
+    """额外预览的设定：(SpriteSpec 或 None, AnimationSpec 或 None)"""
+    from grid_render import AnimationSpec, SpriteSpec
+
+    sprite = SpriteSpec(SPRITE_ROWS, SPRITE_COLS, SPRITE_TILE_WIDTH, SPRITE_JPEG_QUALITY) if RENDER_SPRITE else None
+    animation = AnimationSpec(
+        ANIMATION_FRAMES, ANIMATION_WIDTH, ANIMATION_FRAME_MS, ANIMATION_FORMAT, ANIMATION_QUALITY
+    ) if RENDER_ANIMATION else None
+    return sprite, animation
+
+
+def render_layouts(rows: int = 3, cols: int = 3):
+    """网格与额外预览的版面（部分下载据此决定要取哪些关键帧）"""
+    from grid_render import artifact_layouts
+
+    return artifact_layouts(rows, cols, FRAME_WIDTH, GRID_CANVAS_WIDTH, *artifact_specs())
+
+
 async def make_keyframe_grid(
     video_path: str,
     preview_basename: str,
     rows: int = 3,
-    cols: int = 3
-) -> str:
+    cols: int = 3,
+    backend: str = FRAME_BACKEND,
+    frame_width: Optional[int] = FRAME_WIDTH,
+    canvas_width: Optional[int] = GRID_CANVAS_WIDTH,
+    jpeg_quality: int = GRID_JPEG_QUALITY,
+    fallback: bool = True,
+    sprite_path: Optional[str] = None,
+    animation_path: Optional[str] = None
+) -> "RenderedGrid":
+    """sprite_path / animation_path 不为空且对应设定开启时，雪碧图与动画与网格共用同一次抽帧"""
+    from grid_render import render_keyframe_grid
+
+    sprite, animation = artifact_specs()
+
     print(f"👉 Generated keyframe grid starting", flush=True)
-    # 1. 抽帧并拼成网格
-    clip = VideoFileClip(video_path)
-    n = rows * cols
-    times = [(i + 1) * clip.duration / (n + 1) for i in range(n)]
-    imgs = [Image.fromarray(clip.get_frame(t)) for t in times]
-
-    w, h = imgs[0].size
-    grid_img = Image.new('RGB', (w * cols, h * rows))
-    for idx, img in enumerate(imgs):
-        x = (idx % cols) * w
-        y = (idx // cols) * h
-        grid_img.paste(img, (x, y))
-
-    # 2. 添加文字浮水印
-    draw = ImageDraw.Draw(grid_img)
-    # 确保 Roboto_Condensed-Regular.ttf 在你的项目 fonts/ 目录下
-    font_path = "fonts/Roboto_Condensed-Regular.ttf"
-    font_size = int(h * 0.05)
-    font = ImageFont.truetype(font_path, size=font_size)
-    # text = 移置 preview_basename 中的 temp/preview_ 前缀
+    # 浮水印文字 = 移除 preview_basename 中的 temp/preview_ 前缀
     text = Path(preview_basename).name  # 获取文件名
     if text.startswith("preview_"):
         text = text[len("preview_"):]
-    
-    # 兼容不同 Pillow 版本计算尺寸
-    try:
-        text_width, text_height = font.getsize(text)
-    except AttributeError:
-        # Pillow >= 8.0 推荐用 textbbox
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
 
-    # 放在右下角，留 10px 边距
-    x = grid_img.width - text_width - 10
-    y = grid_img.height - text_height - 10
+    # 抽帧、拼成网格、加浮水印并保存（在渲染进程池里执行，RENDER_WORKERS=0 时用线程）
+    # 确保 Roboto_Condensed-Regular.ttf 在你的项目 fonts/ 目录下
+    grid = await run_render(
+        render_keyframe_grid,
+        video_path,
+        f"{preview_basename}.jpg",
+        rows=rows,
+        cols=cols,
+        frame_width=frame_width,
+        canvas_width=canvas_width,
+        jpeg_quality=jpeg_quality,
+        backend=backend,
+        fallback=fallback,
+        watermark=text,
+        font_path=FONT_PATH,
+        sprite=sprite,
+        sprite_path=sprite_path,
+        animation=animation,
+        animation_path=animation_path
+    )
+    print(f"✔️ Generated keyframe grid with watermark: {grid.path}", flush=True)
+    return grid
+
+
+def get_render_pool() -> Optional[RecyclingProcessPool]:
+    """第一次渲染时才建立进程池（RENDER_WORKERS=0 时回传 None，用线程渲染）"""
+    global render_pool
+    if render_pool is None and RENDER_WORKERS > 0:
+        from grid_render import init_render_worker
+
+        render_pool = RecyclingProcessPool(
+            RENDER_WORKERS,
+            RENDER_JOBS_PER_WORKER,
+            initializer=init_render_worker,
+            initargs=(FONT_PATH,),
+            main_module="grid_render"
+        )
+    return render_pool
 
-    # 半透明白字
-    draw.text((x, y), text, fill=(255, 255, 255, 128), font=font)
 
-    # 3. 保存并返回路径
-    output_path = f"{preview_basename}.jpg"
-    grid_img.save(output_path)
-    print(f"✔️ Generated keyframe grid with watermark: {output_path}", flush=True)
-    return output_path
+async def run_render(fn, *args, **kwargs):
+    pool = get_render_pool()
+    if pool is None:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return await pool.run(fn, *args, **kwargs)
 
 
 def fast_zip_with_password(file_paths: list[str], dest_zip: str, password: str):
@@ -268,6 +580,166 @@ def fast_zip_with_password(file_paths: list[str], dest_zip: str, password: str):
     cmd = ["zip", "-0", "-P", password, dest_zip] + file_paths
     subprocess.run(cmd, check=True)
 
+async def thumbnail_states(cur, unique_ids: list[str]) -> dict[str, grid_cache.ThumbState]:
+    """
+    视频 file_unique_id → 缩图状态。先查缓存，未命中的一次用 IN (...) 查 bid_thumbnail
+    与缩图的 file_extension，查到的结果写回缓存。
+    """
+    unique_ids = list(dict.fromkeys(unique_ids))
+    states = thumb_cache.get_many(unique_ids)
+    pending = [uid for uid in unique_ids if uid not in states]
+    if not pending:
+        return states
+
+    await cur.execute(f"""
+        SELECT file_unique_id, thumb_file_unique_id FROM bid_thumbnail
+        WHERE file_unique_id IN ({in_clause(pending)})
+    """, pending)
+    thumbs = {row[0]: row[1] for row in await cur.fetchall() if row[1]}
+    thumb_files = {}
+    if thumbs:
+        thumb_ids = list(set(thumbs.values()))
+        await cur.execute(f"""
+            SELECT file_unique_id, file_id, bot FROM file_extension
+            WHERE file_unique_id IN ({in_clause(thumb_ids)})
+        """, thumb_ids)
+        for thumb_id, thumb_file_id, bot_name in await cur.fetchall():
+            # 本 BOT 的 file_id 优先（只有它能直接回传）
+            if thumb_id not in thumb_files or bot_name == BOT_NAME:
+                thumb_files[thumb_id] = (thumb_file_id, bot_name)
+
+    for uid in pending:
+        thumb_id = thumbs.get(uid)
+        if not thumb_id:
+            state = grid_cache.ThumbState(grid_cache.MISSING)
+        elif thumb_id not in thumb_files and thumb_id.startswith(grid_backfill.PHOTO_PREFIX):
+            state = grid_cache.ThumbState(grid_cache.HASHED)
+        elif thumb_id not in thumb_files:
+            state = grid_cache.ThumbState(grid_cache.ORPHAN)
+        else:
+            thumb_file_id, bot_name = thumb_files[thumb_id]
+            status = grid_cache.SELF if bot_name == BOT_NAME else grid_cache.OTHER
+            state = grid_cache.ThumbState(status, thumb_file_id)
+        thumb_cache.put(uid, state)
+        states[uid] = state
+    return states
+
+
+async def hash_video_thumbnails(messages: list[Message]) -> dict[str, str]:
+    """下载视频消息附带的缩图（通常只有几十 KB）并计算 pHash：file_unique_id → hash"""
+    from PIL import Image
+
+    hashes = {}
+    limit = asyncio.Semaphore(8)
+
+    async def one(message: Message):
+        thumb = message.video.thumbnail
+        if not thumb:
+            return
+        async with limit:
+            try:
+                data = await bot.download(thumb.file_id)
+                with Image.open(data) as image:
+                    hashes[message.video.file_unique_id] = grid_dedup.thumb_phash(image)
+            except Exception as e:
+                print(f"⚠️ 缩图哈希失败 {message.video.file_unique_id}: {e}", flush=True)
+
+    await asyncio.gather(*(one(m) for m in messages))
+    return hashes
+
+
+async def ensure_dedup_index(chunk: int = 5000):
+    """
+    第一次需要查重时才载入所有已有网格、且记录了缩图哈希的视频（没有新视频的运行不查这张表），
+    按 file_unique_id 分页取回，不一次拉整张表
+    """
+    global dedup_loaded
+    async with dedup_load_lock:
+        if dedup_loaded:
+            return
+        last = ""
+        while True:
+            rows = await db.fetchall("""
+                SELECT v.file_unique_id, v.thumb_hash, v.duration, v.width, v.height
+                FROM video v
+                WHERE v.thumb_hash IS NOT NULL AND v.file_unique_id > %s
+                  AND EXISTS (SELECT 1 FROM bid_thumbnail b WHERE b.file_unique_id = v.file_unique_id)
+                ORDER BY v.file_unique_id
+                LIMIT %s
+            """, (last, chunk))
+            for row in rows:
+                dedup_index.add(*row)
+            if len(rows) < chunk:
+                break
+            last = rows[-1][0]
+        dedup_loaded = True
+    print(f"🔁 近似重复索引已载入 {len(dedup_index)} 个视频", flush=True)
+
+
+async def find_duplicates(messages: list[Message]) -> tuple[dict[str, str], dict[str, str]]:
+    """还没有网格的视频：缩图 pHash（file_unique_id → hash），以及近似重复的已处理视频（file_unique_id → 来源）"""
+    await ensure_dedup_index()
+    thumb_hashes = await hash_video_thumbnails(messages)
+    matches = {}
+    for m in messages:
+        v = m.video
+        if v.file_unique_id not in thumb_hashes:
+            continue
+        match = dedup_index.query(thumb_hashes[v.file_unique_id], v.duration, v.width, v.height)
+        if match and match[1].file_unique_id != v.file_unique_id:
+            print(f"-- 🔁 {v.file_unique_id} 与 {match[1].file_unique_id} 近似（距离 {match[0]}）", flush=True)
+            matches[v.file_unique_id] = match[1].file_unique_id
+    return thumb_hashes, matches
+
+
+async def link_duplicates(cur, matches: dict[str, str]) -> dict[str, grid_cache.ThumbState]:
+    """
+    近似重复：直接沿用来源视频的 bid_thumbnail，不再下载、生成网格。回传实际连上的视频 → 缩图状态。
+    先 SELECT 来源行再多行 INSERT（同一张表上的 INSERT ... SELECT ... ON DUPLICATE KEY UPDATE 会锁住来源行）
+    """
+    sources = await thumbnail_states(cur, list(set(matches.values())))
+    matches = {uid: source for uid, source in matches.items()
+               if sources[source].status in (grid_cache.SELF, grid_cache.OTHER)}
+    if not matches:
+        return {}
+    source_ids = list(set(matches.values()))
+    await cur.execute(f"""
+        SELECT file_unique_id, thumb_file_unique_id, bot_name, file_id, confirm_status, uploader_id, status
+        FROM bid_thumbnail
+        WHERE file_unique_id IN ({in_clause(source_ids)})
+    """, source_ids)
+    rows = {}
+    for row in await cur.fetchall():
+        rows.setdefault(row[0], row[1:])
+    matches = {uid: source for uid, source in matches.items() if source in rows}
+    if not matches:
+        return {}
+    sql, args = values_rows("(%s, %s, %s, %s, %s, %s, %s, 1)", [
+        (uid, *rows[source]) for uid, source in matches.items()
+    ])
+    await cur.execute(f"""
+        INSERT INTO bid_thumbnail (
+            file_unique_id, thumb_file_unique_id, bot_name, file_id,
+            confirm_status, uploader_id, status, t_update
+        )
+        VALUES {sql}
+        ON DUPLICATE KEY UPDATE
+            thumb_file_unique_id = VALUES(thumb_file_unique_id),
+            file_id              = VALUES(file_id),
+            t_update             = 1
+    """, args)
+    return {uid: sources[source] for uid, source in matches.items()}
+
+
+def report_thumb_cache():
+    stats = thumb_cache.stats()
+    print(
+        f"🗃️ 缩图缓存 size={stats['size']} hits={stats['hits']} misses={stats['misses']} "
+        f"hit_rate={stats['hit_rate']:.1%} expired={stats['expired']} evicted={stats['evicted']}",
+        flush=True
+    )
+
+
 async def handle_video(message: Message):
     print("Starting to handle video", flush=True)
     video = message.video
@@ -295,31 +767,31 @@ async def handle_video(message: Message):
     """, (file_unique_id, file_id, BOT_NAME))
 
     print("- create/update bid_thumbnail", flush=True)
-    thumb_row = await db.fetchone("""
-        SELECT thumb_file_unique_id FROM bid_thumbnail WHERE file_unique_id=%s
-    """, (file_unique_id,))
-    if thumb_row and thumb_row[0]:
-        thumb_file_unique_id = thumb_row[0]
-
-        
-
-        rows = await db.fetchall("""
-            SELECT file_id, bot FROM file_extension WHERE file_unique_id=%s
-        """, (thumb_file_unique_id,))
-        if rows:
-            for file_id_result, bot_name in rows:
-                if bot_name == BOT_NAME:
-                    print("-- ✅ 縮圖已存在",flush=True)
-                    await message.answer_photo(file_id_result, caption="✅ 縮圖已存在")
-                    return
-                else:
-                    print("-- ✅ 縮圖已存在,但是在别的BOT,不用生成",flush=True)
-                    # await bypass(file_id_result, bot_name, BOT_NAME)
-                    return
-        else:
-            print("-- No existing thumbnail found, will create a new one")
-            pass
-            #await db.execute("DELETE FROM bid_thumbnail WHERE thumb_file_unique_id=%s", (thumb_file_unique_id,))
+    async with db.connection() as cur:
+        state = (await thumbnail_states(cur, [file_unique_id]))[file_unique_id]
+    if state.status == grid_cache.MISSING and DEDUP_ENABLED:
+        # 与批量入库相同：先用 Telegram 附带的缩图找近似重复的已处理视频
+        thumb_hashes, matches = await find_duplicates([message])
+        if file_unique_id in thumb_hashes:
+            async with db.transaction() as cur:
+                await cur.execute("UPDATE video SET thumb_hash=%s WHERE file_unique_id=%s",
+                                  (thumb_hashes[file_unique_id], file_unique_id))
+                linked = await link_duplicates(cur, matches) if matches else {}
+            if linked:
+                state = linked[file_unique_id]
+                thumb_cache.put(file_unique_id, state)
+                dedup_index.add(file_unique_id, thumb_hashes[file_unique_id], video.duration, video.width, video.height)
+    if state.status == grid_cache.SELF:
+        print("-- ✅ 縮圖已存在",flush=True)
+        await message.answer_photo(state.file_id, caption="✅ 縮圖已存在")
+        return
+    elif state.status == grid_cache.OTHER:
+        print("-- ✅ 縮圖已存在,但是在别的BOT,不用生成",flush=True)
+        # await bypass(state.file_id, bot_name, BOT_NAME)
+        return
+    elif state.status == grid_cache.ORPHAN:
+        print("-- No existing thumbnail found, will create a new one")
+        #await db.execute("DELETE FROM bid_thumbnail WHERE thumb_file_unique_id=%s", (thumb_file_unique_id,))
     else:
         print("- Create grid_jobs", flush=True)
         # 在 handle_video 或者你插入 grid_jobs 的地方，把 message.chat.id、message.message_id 也传进去
@@ -333,21 +805,28 @@ async def handle_video(message: Message):
                 scheduled_at,
                 retry_count,
                 source_chat_id,
-                source_message_id
+                source_message_id,
+                file_size,
+                priority
             )
-            VALUES (%s, %s, 'video', %s, 'pending', NOW(), 0, %s, %s)
+            VALUES (%s, %s, 'video', %s, 'pending', NOW(), 0, %s, %s, %s, %s)
             ON DUPLICATE KEY UPDATE
                 job_state      = 'pending',
                 scheduled_at   = NOW(),
-                retry_count    = retry_count + 1,
+                retry_count    = 0,
+                grid_file_id   = NULL,
                 source_chat_id = VALUES(source_chat_id),
-                source_message_id = VALUES(source_message_id)
+                source_message_id = VALUES(source_message_id),
+                file_size      = VALUES(file_size),
+                priority       = VALUES(priority)
         """, (
             file_id,
             file_unique_id,
             BOT_NAME,
             message.chat.id,
-            message.message_id
+            message.message_id,
+            message.video.file_size,
+            JOB_PRIORITY
         ))
 
     await message.answer("🌀 已加入關鍵幀任務排程",reply_to_message_id=message.message_id)
@@ -406,6 +885,180 @@ async def handle_document(message: Message):
     except Exception as e:
         print(f"[Error] handle_document: {e}",flush=True)
 
+async def ingest_updates(updates: list[Update]):
+    """
+    整页 update 批量入库：每张表一条多行 INSERT ... ON DUPLICATE KEY UPDATE，
+    缩图是否存在用一条 IN (...) 查询，全部放在同一个事务里。
+    回复用户在提交之后进行（scrap_progress 由 ProgressCheckpoint 批量写入）。
+    """
+    videos = [u.message for u in updates if u.message and u.message.video]
+    documents = [u.message for u in updates if u.message and not u.message.video and u.message.document]
+    print(f"📥 Ingesting {len(updates)} updates: {len(videos)} videos, {len(documents)} documents", flush=True)
+
+    await db.init()
+    replies = []
+    states = {}
+    thumb_hashes = {}
+    matches = {}
+    linked = {}
+    if videos:
+        # 缓存未命中的视频：一次查出 bid_thumbnail 与缩图的 file_extension
+        async with db.connection() as cur:
+            states = await thumbnail_states(cur, [m.video.file_unique_id for m in videos])
+        if DEDUP_ENABLED:
+            # 还没有网格的视频：用 Telegram 附带的缩图找近似重复的已处理视频（在事务之外下载）
+            fresh = [m for m in videos if states[m.video.file_unique_id].status == grid_cache.MISSING]
+            if fresh:
+                thumb_hashes, matches = await find_duplicates(fresh)
+
+    async with db.transaction() as cur:
+        if videos:
+            sql, args = values_rows("(%s, %s, %s, %s, %s, %s, %s, NOW(), NOW())", [
+                (v.file_unique_id, v.file_size, v.duration, v.width, v.height, v.mime_type,
+                 thumb_hashes.get(v.file_unique_id))
+                for v in (m.video for m in videos)
+            ])
+            await cur.execute(f"""
+                INSERT INTO video (file_unique_id, file_size, duration, width, height, mime_type, thumb_hash, create_time, update_time)
+                VALUES {sql}
+                ON DUPLICATE KEY UPDATE
+                    file_size=VALUES(file_size),
+                    duration=VALUES(duration),
+                    width=VALUES(width),
+                    height=VALUES(height),
+                    mime_type=VALUES(mime_type),
+                    thumb_hash=COALESCE(VALUES(thumb_hash), thumb_hash),
+                    update_time=NOW()
+            """, args)
+
+            sql, args = values_rows("('video', %s, %s, %s, NOW())", [
+                (m.video.file_unique_id, m.video.file_id, BOT_NAME) for m in videos
+            ])
+            await cur.execute(f"""
+                INSERT IGNORE INTO file_extension (file_type, file_unique_id, file_id, bot, create_time)
+                VALUES {sql}
+            """, args)
+
+            if matches:
+                linked = await link_duplicates(cur, matches)
+                states.update(linked)
+
+            jobs = []
+            for m in videos:
+                state = states[m.video.file_unique_id]
+                if state.status == grid_cache.SELF:
+                    print("-- ✅ 縮圖已存在", flush=True)
+                    replies.append(m.answer_photo(state.file_id, caption="✅ 縮圖已存在"))
+                    continue
+                if state.status == grid_cache.OTHER:
+                    print("-- ✅ 縮圖已存在,但是在别的BOT,不用生成", flush=True)
+                    continue
+                if state.status == grid_cache.ORPHAN:
+                    print("-- No existing thumbnail found, will create a new one")
+                else:
+                    jobs.append((m.video.file_id, m.video.file_unique_id, BOT_NAME, m.chat.id, m.message_id,
+                                 m.video.file_size, JOB_PRIORITY))
+                replies.append(m.answer("🌀 已加入關鍵幀任務排程", reply_to_message_id=m.message_id))
+
+            if jobs:
+                sql, args = values_rows("(%s, %s, 'video', %s, 'pending', NOW(), 0, %s, %s, %s, %s)", jobs)
+                await cur.execute(f"""
+                    INSERT INTO grid_jobs (
+                        file_id,
+                        file_unique_id,
+                        file_type,
+                        bot_name,
+                        job_state,
+                        scheduled_at,
+                        retry_count,
+                        source_chat_id,
+                        source_message_id,
+                        file_size,
+                        priority
+                    )
+                    VALUES {sql}
+                    ON DUPLICATE KEY UPDATE
+                        job_state      = 'pending',
+                        scheduled_at   = NOW(),
+                        retry_count    = 0,
+                        grid_file_id   = NULL,
+                        source_chat_id = VALUES(source_chat_id),
+                        source_message_id = VALUES(source_message_id),
+                        file_size      = VALUES(file_size),
+                        priority       = VALUES(priority)
+                """, args)
+
+        if documents:
+            sql, args = values_rows("(%s, %s, %s, %s, %s, NOW())", [
+                (m.document.file_unique_id, m.document.file_size, m.document.file_name,
+                 m.document.mime_type, m.caption or None)
+                for m in documents
+            ])
+            await cur.execute(f"""
+                INSERT INTO document (
+                    file_unique_id,
+                    file_size,
+                    file_name,
+                    mime_type,
+                    caption,
+                    create_time
+                )
+                VALUES {sql}
+                ON DUPLICATE KEY UPDATE
+                    file_size = VALUES(file_size),
+                    file_name = VALUES(file_name),
+                    mime_type = VALUES(mime_type),
+                    caption = VALUES(caption),
+                    create_time = NOW()
+            """, args)
+
+            sql, args = values_rows("('document', %s, %s, %s, NOW())", [
+                (m.document.file_unique_id, m.document.file_id, BOT_NAME) for m in documents
+            ])
+            await cur.execute(f"""
+                INSERT INTO file_extension (
+                    file_type,
+                    file_unique_id,
+                    file_id,
+                    bot,
+                    create_time
+                )
+                VALUES {sql}
+                ON DUPLICATE KEY UPDATE
+                    file_id      = VALUES(file_id),
+                    bot          = VALUES(bot),
+                    create_time  = NOW()
+            """, args)
+            replies.extend(m.reply("✅ 文档已入库") for m in documents)
+
+    for m in videos:
+        v = m.video
+        if v.file_unique_id in linked:
+            thumb_cache.put(v.file_unique_id, states[v.file_unique_id])
+            dedup_index.add(v.file_unique_id, thumb_hashes[v.file_unique_id], v.duration, v.width, v.height)
+
+    for reply in replies:
+        try:
+            await reply
+        except Exception as e:
+            print(f"[Error] reply: {e}", flush=True)
+
+
+async def ingest_updates_one_by_one(updates: list[Update]):
+    """逐条入库（批量事务失败时的退路，单条出错不影响其它 update）"""
+    for update in updates:
+        print(f"📬 Received update: {update.update_id}")
+        if update.message and update.message.video:
+            try:
+                await handle_video(update.message)
+            except Exception as e:
+                print(f"[Error] handle_video: {e}")
+
+        # 改为调用封装好的 handle_document
+        elif update.message and update.message.document:
+            await handle_document(update.message)
+
+
 async def get_last_update_id() -> int:
     await db.init()
     row = await db.fetchone("SELECT message_id FROM scrap_progress WHERE api_id=%s AND chat_id=0", (API_ID,))
@@ -425,158 +1078,493 @@ async def update_scrap_progress(new_update_id: int):
 
 
 
+async def handle_updates(updates: list[Update]):
+    """dispatcher 交来的同一 chat 的一批 update：先整批入库，失败再逐条处理"""
+    try:
+        await ingest_updates(updates)
+    except Exception as e:
+        print(f"⚠️ 批量入库失败，改为逐条处理：{e}", flush=True)
+        await ingest_updates_one_by_one(updates)
+    report_thumb_cache()
+
+
 async def limited_polling():
-    last_update_id = await get_last_update_id()
-    print(f"📥 Polling from offset={last_update_id + 1}",flush=True)
+    checkpoint = grid_intake.ProgressCheckpoint(
+        update_scrap_progress,
+        last_saved=await get_last_update_id(),
+        interval=PROGRESS_CHECKPOINT_INTERVAL,
+        every=PROGRESS_CHECKPOINT_UPDATES
+    )
+    # 不同 chat 的 update 并发入库（同一 chat 依序），并发数默认与连线池大小一致
+    dispatcher = grid_intake.UpdateDispatcher(handle_updates, checkpoint, concurrency=DISPATCH_CONCURRENCY)
 
-    while not shutdown_event.is_set():
-        try:
-            updates: list[Update] = await bot(GetUpdates(
-                offset=last_update_id + 1,
-                limit=100,
-                timeout=5
-            ))
-        except TelegramConflictError:
-            # 一旦捕获 Conflict，就把当前正在处理的 job 标记为失败
-            if 'job_id' in locals():  # 确保 job_id 在作用域内
-                await db.execute("""
-                    UPDATE grid_jobs
-                    SET job_state='failed',
-                        error_message='Conflict'
-                    WHERE id=%s
-                """, (current_job_id,))
-            # 跳出轮询或做其他善后处理
-            print("❌ 轮询被中断，Conflict 错误已写入数据库", flush=True)
-            shutdown_event.set()
-            break
-
-        if not updates:
-            await asyncio.sleep(600)
-            continue
+    try:
+        if UPDATE_MODE == 'webhook':
+            await grid_intake.serve_webhook(
+                bot, dispatcher, shutdown_event,
+                url=WEBHOOK_URL,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH,
+                secret=WEBHOOK_SECRET,
+                batch_window=WEBHOOK_BATCH_WINDOW
+            )
+        else:
+            await grid_intake.long_poll(
+                bot, dispatcher, shutdown_event,
+                timeout=POLL_TIMEOUT
+            )
+    except TelegramConflictError:
+        # 另一个实例在轮询，或者这个 BOT 设置了 webhook
+        print("❌ 轮询被中断，Conflict", flush=True)
+        shutdown_event.set()
 
-        max_update_id = last_update_id
-        for update in updates:
-            print(f"📬 Received update: {update.update_id}")
-            max_update_id = max(max_update_id, update.update_id)
-            if update.message and update.message.video:
-                try:
-                    await handle_video(update.message)
-                except Exception as e:
-                    print(f"[Error] handle_video: {e}")
+    print("🛑 Polling stopped",flush=True)
 
-            # 改为调用封装好的 handle_document
-            elif update.message and update.message.document:
-                await handle_document(update.message)
 
-        if max_update_id != last_update_id:
-            await update_scrap_progress(max_update_id)
-            last_update_id = max_update_id
 
-        await asyncio.sleep(600)
+def job_scratch_bytes(file_size: Optional[int]) -> int:
+    """任务最多占用的暂存空间：视频 + （zip -0 落盘时）同样大小的 ZIP + 预览图等"""
+    copies = 2 if ARCHIVE_ENABLED and not ARCHIVE_STREAM else 1
+    return (file_size or 0) * copies + SCRATCH_JOB_OVERHEAD_MB * 1024 * 1024
 
-    print("🛑 Polling stopped",flush=True)
 
+def max_admissible_size(available: int) -> int:
+    """job_scratch_bytes 的反函数：剩余空间还放得下多大的视频"""
+    copies = 2 if ARCHIVE_ENABLED and not ARCHIVE_STREAM else 1
+    return (available - SCRATCH_JOB_OVERHEAD_MB * 1024 * 1024) // copies
 
 
-async def process_one_grid_job():
-    global current_job_id  # 声明这里要用到模块级的全局变量
+async def reclaim_expired_jobs():
+    """每 JOB_HEARTBEAT_INTERVAL 秒最多一次：收回租约过期的任务（崩溃或卡住的 worker 留下的）"""
+    global last_reclaim
+    if time.monotonic() - last_reclaim < JOB_HEARTBEAT_INTERVAL:
+        return
+    last_reclaim = time.monotonic()
+    reclaimed = await job_leases.reclaim(BOT_NAME, JOB_MAX_ATTEMPTS)
+    if reclaimed:
+        print(f"♻️ 已收回 {reclaimed} 个租约过期的任务", flush=True)
+
+
+async def claim_grid_job():
+    """
+    原子认领一个 pending 任务：
+    单条 UPDATE ... LIMIT 1 写入随机 claim_token 与租约，再按 token 取回该行。
+    多个进程/主机同时认领时，同一行只会被其中一个 UPDATE 命中。
+    认领顺序依 JOB_POLICY；scheduled_at 还没到（退避中）的任务不认领。
+    只认领 file_size 放得进剩余暂存空间的任务（大小未知的不限），认领后立即预留空间。
+    """
+    await reclaim_expired_jobs()
+    claim_token = uuid.uuid4().hex
+    timings = {}
+    async with scratch.admission:
+        available = scratch.available()
+        max_size = max_admissible_size(available)
+        if max_size < 0:
+            print(f"💾 暂存空间不足（可用 {available} bytes），暂不认领任务", flush=True)
+            return None
+
+        with metrics.stage("claim", timings):
+            claimed = await db.execute(f"""
+                UPDATE grid_jobs
+                SET job_state='processing',
+                    claim_token=%s,
+                    started_at=NOW(),
+                    lease_until=NOW() + INTERVAL %s SECOND
+                WHERE bot_name=%s AND job_state='pending'
+                  AND scheduled_at<=NOW()
+                  AND (file_size IS NULL OR file_size<=%s)
+                ORDER BY {JOB_ORDER}
+                LIMIT 1
+            """, (claim_token, JOB_LEASE_SECONDS, BOT_NAME, max_size))
+            if not claimed:
+                return None
+
+            row = await db.fetchone("""
+                SELECT id, file_id, file_unique_id, source_chat_id, source_message_id, file_size, retry_count,
+                       grid_file_id
+                FROM grid_jobs
+                WHERE claim_token=%s
+            """, (claim_token,))
+        if not row:
+            return None
+        job = GridJob(*row[:7], claim_token=claim_token, grid_file_id=row[7])
+        scratch.reserve(job.id, job_scratch_bytes(job.file_size))
+        job_leases.add(job.id, claim_token)
+    job.timings.update(timings)
+    return job
+
+
+def release_job(job: GridJob):
+    """
+    任务离开流水线：不再续约。done 或最终 failed 时删除它的视频、预览图、ZIP 与 sidecar；
+    放回 pending 等重试、被取消或租约被收回时保留，重试时从 .parts / .upload 续传而不是从零下载
+    """
+    job_leases.discard(job.id, job.claim_token)
+    if job.finished:
+        freed = scratch.release(job.id)
+        if freed:
+            print(f"🧹 Job ID={job.id} 暂存文件已清理（{freed} bytes）", flush=True)
+    else:
+        kept = scratch.detach(job.id)
+        if kept:
+            print(f"📦 Job ID={job.id} 暂存文件保留给重试（{kept} bytes）", flush=True)
+
 
-    job = await db.fetchone("""
-        SELECT id, file_id, file_unique_id, source_chat_id, source_message_id
-        FROM grid_jobs
-        WHERE job_state='pending' AND bot_name=%s
-        ORDER BY scheduled_at ASC
-        LIMIT 1
-    """, (BOT_NAME,))
+async def lease_heartbeat():
+    """为处理中的任务续约（所有任务一条 UPDATE）；没有续约成功的任务已被别的 worker 收回"""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        held = len(job_leases.tokens)
+        try:
+            renewed = await job_leases.renew()
+        except Exception as e:
+            print(f"⚠️ 任务续约失败: {e}", flush=True)
+            continue
+        if renewed < held:
+            print(f"⚠️ {held - renewed} 个任务的租约已失效（已被收回）", flush=True)
+
+
+async def process_one_grid_job():
+    """单次模式：认领并处理一个任务后结束（cron 每次启动跑一个）"""
+    job = await claim_grid_job()
 
     if not job:
         print("📭 No Pending Job Found")
-        await asyncio.sleep(60)
+        # 没有任务时仍让轮询入库 ONCE_IDLE_WAIT 秒（0 = 立即结束）；轮询先停止时提早结束
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=ONCE_IDLE_WAIT)
+        except asyncio.TimeoutError:
+            pass
         shutdown_event.set()
         return
 
-    job_id, file_id, file_unique_id, chat_id, message_id = job
-    print(f"🔧 Processing job ID={job_id}",flush=True)
-    current_job_id = job_id  # 更新全局变量
+    try:
+        await run_grid_job(job)
+    finally:
+        shutdown_event.set()
+
 
-    await db.execute("""
+async def grid_worker():
+    """
+    常驻模式：download → render → upload 三段流水线。
+    阶段之间用有界 asyncio.Queue 衔接，第 N+1 个任务下载的同时第 N 个在渲染、第 N-1 个在上传；
+    下游阻塞时上游的 put 会等待，因此同时认领的任务数有上限。
+    """
+    render_q: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    upload_q: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    busy = {"download": 0, "render": 0, "upload": 0}
+
+    async def run_stage(stage: str, stage_fn, job: GridJob) -> bool:
+        busy[stage] += 1
+        try:
+            return await stage_fn(job)
+        except Exception as e:
+            print(f"❌ [{stage}] Job ID={job.id} 异常: {e}", flush=True)
+            await mark_grid_job_failed(job, str(e)[:255])
+            return False
+        finally:
+            busy[stage] -= 1
+
+    async def download_worker():
+        while not shutdown_event.is_set():
+            job = await claim_grid_job()
+            if not job:
+                # 队列已空，等一会再认领（收到 shutdown 立即结束）
+                try:
+                    await asyncio.wait_for(shutdown_event.wait(), timeout=GRID_IDLE_SLEEP)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if await run_stage("download", download_stage, job):
+                await render_q.put(job)
+            else:
+                release_job(job)
+
+    async def render_worker():
+        while True:
+            job = await render_q.get()
+            try:
+                if await run_stage("render", render_stage, job):
+                    await upload_q.put(job)
+                else:
+                    release_job(job)
+            finally:
+                render_q.task_done()
+
+    async def upload_worker():
+        while True:
+            job = await upload_q.get()
+            try:
+                await run_stage("upload", upload_stage, job)
+            finally:
+                release_job(job)
+                upload_q.task_done()
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(PIPELINE_REPORT_INTERVAL)
+            print(
+                f"📊 pipeline download={busy['download']}/{PIPELINE_DOWNLOADS} "
+                f"render_q={render_q.qsize()} render={busy['render']}/{PIPELINE_RENDERS} "
+                f"upload_q={upload_q.qsize()} upload={busy['upload']}/{PIPELINE_UPLOADS}",
+                flush=True
+            )
+
+    print(
+        f"👷 Grid pipeline started: download={PIPELINE_DOWNLOADS} "
+        f"render={PIPELINE_RENDERS} upload={PIPELINE_UPLOADS} queue={PIPELINE_QUEUE_SIZE}",
+        flush=True
+    )
+    consumers = [asyncio.create_task(render_worker()) for _ in range(PIPELINE_RENDERS)]
+    consumers += [asyncio.create_task(upload_worker()) for _ in range(PIPELINE_UPLOADS)]
+    consumers.append(asyncio.create_task(reporter()))
+    try:
+        await asyncio.gather(*(download_worker() for _ in range(PIPELINE_DOWNLOADS)))
+        # 不再认领新任务后，把已认领的任务跑完
+        await render_q.join()
+        await upload_q.join()
+    finally:
+        for t in consumers:
+            t.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+    print("🛑 Grid pipeline stopped", flush=True)
+
+
+async def mark_grid_job_failed(job: GridJob, error_message: str, retry: bool = True):
+    """
+    失败：还有重试次数（retry_count + 1 < JOB_MAX_ATTEMPTS）时放回 pending，
+    scheduled_at 往后推 retry_delay 秒；否则（或 retry=False）标为 failed。
+    只更新这次认领的行（claim_token），租约过期被收回后迟到的失败不会覆盖新的认领
+    """
+    job_leases.discard(job.id, job.claim_token)
+    if retry and job.retry_count + 1 < JOB_MAX_ATTEMPTS:
+        delay = grid_scheduler.retry_delay(job.retry_count, JOB_RETRY_BASE, JOB_RETRY_MAX)
+        updated = await db.execute("""
+            UPDATE grid_jobs
+            SET job_state='pending',error_message=%s,stage_timings=%s,
+                retry_count=retry_count + 1,
+                scheduled_at=NOW() + INTERVAL %s SECOND,
+                claim_token=NULL,lease_until=NULL
+            WHERE id=%s AND claim_token=%s
+        """, (error_message, json.dumps(job.timings), delay, job.id, job.claim_token))
+        state = 'retry'
+    else:
+        updated = await db.execute("""
+            UPDATE grid_jobs
+            SET job_state='failed',error_message=%s,stage_timings=%s,
+                retry_count=retry_count + 1,lease_until=NULL
+            WHERE id=%s AND claim_token=%s
+        """, (error_message, json.dumps(job.timings), job.id, job.claim_token))
+        state = 'failed'
+    if not updated:
+        print(f"⚠️ Job ID={job.id} 的租约已被收回，不再记录这次失败: {error_message}", flush=True)
+        return
+    job.finished = state == 'failed'
+    if state == 'retry':
+        print(f"🔁 Job ID={job.id} 第 {job.retry_count + 1} 次失败，{delay} 秒后重试", flush=True)
+    record_job(job, state, error_message)
+
+
+async def complete_grid_job(job: GridJob):
+    """
+    任务完成：网格已入库，开启归档时 ZIP 也已发出。标为 done、写回各阶段耗时并放掉租约。
+    归档上传期间任务仍是 processing 并持续续约，上传失败照常重排，重试时只补 ZIP
+    """
+    updated = await db.execute("""
         UPDATE grid_jobs
-        SET job_state='processing',started_at=NOW() 
-        WHERE id=%s
-    """, (job_id))
+        SET job_state='done',finished_at=NOW(),stage_timings=%s,lease_until=NULL
+        WHERE id=%s AND claim_token=%s
+    """, (json.dumps(job.timings), job.id, job.claim_token))
+    job_leases.discard(job.id, job.claim_token)
+    if not updated:
+        # 租约已被收回、任务由别的 worker 接手：暂存文件留给它，也不记成 done
+        print(f"⚠️ Job ID={job.id} 的租约已被收回，不再标记完成", flush=True)
+        return
+    job.finished = True
+    record_job(job, 'done')
+    print(f"✅ Job ID={job.id} completed", flush=True)
 
-   
-    photo_file_id = None
-    photo_unique_id = None
+
+def record_job(job: GridJob, state: str, error: Optional[str] = None):
+    metrics.inc("jobs_total", labels={"state": state})
+    metrics.event("job", job_id=job.id, file_unique_id=job.file_unique_id, state=state, error=error,
+                  timings=job.timings)
 
 
-    # 1) 准备临时目录
-    temp_dir = Path("temp")
-    temp_dir.mkdir(exist_ok=True)
+async def run_grid_job(job: GridJob):
+    """依序执行三个阶段（单次模式使用）"""
+    try:
+        if await download_stage(job) and await render_stage(job):
+            await upload_stage(job)
+    finally:
+        release_job(job)
 
 
-    # 2) 下载视频
+async def download_stage(job: GridJob) -> bool:
+    global current_job_id  # 声明这里要用到模块级的全局变量
+
+    print(f"🔧 Processing job ID={job.id}",flush=True)
+    current_job_id = job.id  # 更新全局变量
+
+    # 2) 下载视频：依 video.file_size 选择后端，失败时换下一个；文件登记在任务的暂存空间下
+    job.video_path = scratch.path(job.id, f"{job.file_unique_id}.mp4")
+    backends = grid_download.select_backends(job.file_size, DOWNLOAD_BACKENDS, BOT_API_FILE_LIMIT)
     try:
-        video_path = str(temp_dir / f"{file_unique_id}.mp4")
-        print(f"📥 开始下载视频: {video_path}", flush=True)
-        await download_from_file_id(file_id, video_path, chat_id, message_id)
+        if not backends:
+            raise RuntimeError(f"没有可用的下载后端（file_size={job.file_size}）")
+        for i, backend in enumerate(backends):
+            try:
+                with metrics.stage("download", job.timings, job_id=job.id, backend=backend):
+                    await DOWNLOADERS[backend](job)
+                job.download_backend = backend
+                break
+            except Exception as e:
+                if i + 1 == len(backends):
+                    raise
+                print(f"⚠️ {backend} 下载失败，改用 {backends[i + 1]}：{e}", flush=True)
     except Exception as e:
-        print(f"❌ 下载视频失败471: {e} {file_unique_id} ({file_id})", flush=True)
-        # 抛出错误
-        await db.execute("""
-            UPDATE grid_jobs
-            SET job_state='failed',error_message='下载视频失败'
-            WHERE id=%s
-        """, (job_id))
-        shutdown_event.set()
+        print(f"❌ 下载视频失败471: {e} {job.file_unique_id} ({job.file_id})", flush=True)
+        await mark_grid_job_failed(job, '下载视频失败')
+        return False
+    return True
+
+
+async def download_via_botapi(job: GridJob):
+    """Bot API getFile：小文件不必登录 MTProto、取消息或切换 DC"""
+    # PartDownloader 先把文件预留成完整长度，分块没补齐前 sidecar 还在：有 sidecar 就不算下载完
+    if (job.file_size and os.path.exists(job.video_path) and os.path.getsize(job.video_path) == job.file_size
+            and not os.path.exists(sidecar_path(job.video_path))):
+        print(f"✔️ 沿用上次下载的视频: {job.video_path}", flush=True)
         return
-        
-    # 让主循环继续等待下一个任务
-    # 这里可以选择等待一段时间再重试
-    
+    print(f"📥 Bot API 下载视频: {job.video_path}", flush=True)
+    await grid_download.bot_api_download(bot, job.file_id, job.video_path, BOT_API_FILE_LIMIT,
+                                         timeout=BOT_API_DOWNLOAD_TIMEOUT)
+    discard_part_state(job.video_path)   # 整个文件重新下载过，之前 MTProto 留下的分块记录已经作废
+
+
+async def download_via_mtproto(job: GridJob):
+    """Telethon 分块下载（可部分下载时先只取网格需要的分块）"""
+    msg = await fetch_source_message(job.chat_id, job.message_id)
+    if PARTIAL_FETCH and not job.grid_file_id:
+        print(f"📥 开始部分下载视频: {job.video_path}", flush=True)
+        job.partial = await download_keyframe_parts(msg, job.video_path, render_layouts())
+    if not job.partial:
+        print(f"📥 开始下载视频: {job.video_path}", flush=True)
+        await safe_download(msg, job.video_path)
+
+
+DOWNLOADERS = {
+    "botapi": download_via_botapi,
+    "mtproto": download_via_mtproto,
+}
+
+
+async def render_stage(job: GridJob) -> bool:
+    if job.grid_file_id:
+        # 只差 ZIP：预览图优先用暂存里上次渲染的，没有再按 grid_file_id 从 Bot API 取回
+        job.preview_path = scratch.path(job.id, f"preview_{job.file_unique_id}.jpg")
+        if not os.path.exists(job.preview_path):
+            with metrics.stage("download_grid", job.timings, job_id=job.id):
+                await grid_download.bot_api_download(bot, job.grid_file_id, job.preview_path, BOT_API_FILE_LIMIT,
+                                                     timeout=BOT_API_DOWNLOAD_TIMEOUT)
+        return True
+
     # 3) 生成预览图
+    preview_basename = str(Path(scratch.path(job.id, f"preview_{job.file_unique_id}.jpg")).with_suffix(""))
+    artifact_paths = {}
+    if RENDER_SPRITE:
+        artifact_paths["sprite_path"] = scratch.path(job.id, f"sprite_{job.file_unique_id}.jpg")
+        scratch.path(job.id, f"sprite_{job.file_unique_id}.vtt")
+    if RENDER_ANIMATION:
+        artifact_paths["animation_path"] = scratch.path(
+            job.id, f"animation_{job.file_unique_id}.{ANIMATION_FORMAT.lower()}"
+        )
+    grid = None
+    if job.partial:
+        try:
+            # 稀疏文件只能走关键帧 seek，不能退回 moviepy 顺序解码
+            with metrics.stage("render", job.timings, job_id=job.id):
+                grid = await make_keyframe_grid(job.video_path, preview_basename, fallback=False, **artifact_paths)
+        except Exception as e:
+            print(f"⚠️ 部分下载的视频无法生成预览图，补齐完整视频：{e}", flush=True)
+            await ensure_full_video(job)
+
     try:
-        preview_basename = str(temp_dir / f"preview_{file_unique_id}")
-        preview_path = await make_keyframe_grid(video_path, preview_basename)
+        if not grid:
+            with metrics.stage("render", job.timings, job_id=job.id):
+                grid = await make_keyframe_grid(job.video_path, preview_basename, **artifact_paths)
     except Exception as e:
-        await db.execute("""
-            UPDATE grid_jobs
-            SET job_state='failed',error_message='生成预览图失败'
-            WHERE id=%s
-        """, (job_id))
-        shutdown_event.set()
+        from grid_render import DecodeError
+
+        print(f"❌ 生成预览图失败: {e}", flush=True)
+        # 视频本身解不出来，重试也一样，直接标为 failed；
+        # 进程池崩溃（BrokenProcessPool）、OSError 等与这次执行有关的失败照常退避重试
+        await mark_grid_job_failed(job, '生成预览图失败', retry=not isinstance(e, DecodeError))
+        return False
+
+    # 渲染进程里各子阶段的耗时（decode / compose / encode / hash）
+    for name, seconds in grid.timings.items():
+        metrics.record_stage(name, seconds, job.timings, job_id=job.id)
+
+    # 4) pHash 已在内存中的画布上算好（整张网格 + 每格）
+    job.preview_path = grid.path
+    job.phash = grid.phash
+    job.frame_hashes = grid.frame_hashes
+    job.artifacts = [p for p in (grid.sprite_path, grid.sprite_index, grid.animation_path) if p]
+    return True
+
+
+async def ensure_full_video(job: GridJob):
+    """部分下载的任务：按 sidecar 只补齐缺少的分块"""
+    if not job.partial:
         return
+    with metrics.stage("download_rest", job.timings, job_id=job.id):
+        msg = await fetch_source_message(job.chat_id, job.message_id)
+        print(f"📥 补齐完整视频: {job.video_path}", flush=True)
+        await safe_download(msg, job.video_path)
+    job.partial = False
 
-    # 4) 之后再计算 pHash、上传、更新数据库……
-    try:
-        phash_str = None
-        with Image.open(preview_path) as img:
-            phash_str = str(imagehash.phash(img))
 
-        input_file = FSInputFile(preview_path)
+async def upload_stage(job: GridJob) -> bool:
+    if job.grid_file_id:
+        print(f"🔁 Job ID={job.id} 网格已入库，只重传 ZIP", flush=True)
+        return await upload_archive(job)
 
+    file_unique_id = job.file_unique_id
+    chat_id, message_id = job.chat_id, job.message_id
+    video_path, preview_path = job.video_path, job.preview_path
+
+    photo_file_id = None
+    photo_unique_id = None
+
+    # 5) 上传预览图、更新数据库……
+    input_file = FSInputFile(preview_path)
+    try:
         # 9)  备份:
-        sent2 = await bot.send_photo(
-            chat_id=TELEGROUP_RELY_BOT,
-            photo=input_file,
-            caption=f"|_forward_|-100{TELEGROUP_THUMB}",
-        )
+        with metrics.stage("send_photo_rely", job.timings, job_id=job.id):
+            sent2 = await bot.send_photo(
+                chat_id=TELEGROUP_RELY_BOT,
+                photo=input_file,
+                caption=f"|_forward_|-100{TELEGROUP_THUMB}",
+            )
         photo_file_id = sent2.photo[-1].file_id
         photo_unique_id = sent2.photo[-1].file_unique_id
         photo_file_size = sent2.photo[-1].file_size
         photo_width = sent2.photo[-1].width
         photo_height= sent2.photo[-1].height
-        print(f"✔️ 透过RELY发送预览图到分镜图群成功: {e}", flush=True)
+        print(f"✔️ 透过RELY发送预览图到分镜图群成功: {photo_file_id}", flush=True)
 
     except Exception as e:
         print(f"❌ 透过RELY发送预览图到分镜图群失败: {e} {TELEGROUP_RELY_BOT} {TELEGROUP_THUMB}", flush=True)
         
     try:
-        sent = await bot.send_photo(
-            chat_id=chat_id,
-            photo=input_file,
-            reply_to_message_id=message_id
-        )
+        with metrics.stage("send_photo_reply", job.timings, job_id=job.id):
+            sent = await bot.send_photo(
+                chat_id=chat_id,
+                photo=input_file,
+                reply_to_message_id=message_id
+            )
 
         photo_file_id = sent.photo[-1].file_id
         photo_unique_id = sent.photo[-1].file_unique_id
@@ -587,113 +1575,173 @@ async def process_one_grid_job():
         print(f"✔️ 回覆预览图成功: {photo_file_id} {photo_unique_id}", flush=True)
     except Exception as e:
         print(f"❌ 回覆预览图失败: {e}", flush=True)
-        await db.execute("""
-            UPDATE grid_jobs
-            SET job_state='failed',error_message='回覆预览图失败'
-            WHERE id=%s
-        """, (job_id))
+        if photo_file_id is None:
+            await mark_grid_job_failed(job, '回覆预览图失败')
+            return False
+        # RELY 已经送出网格：不回覆也照常入库，不能把任务放回 pending 之后又继续完成它
 
     if photo_file_id is None:
-        shutdown_event.set()
-        
-    await db.execute("""
-        INSERT INTO photo (
-            file_unique_id, file_size, width, height, file_name,
-            caption, root_unique_id, create_time, files_drive,
-            hash, same_fuid
+        return False
+
+    # photo / file_extension / bid_thumbnail / sora_content / grid_jobs 同一个事务、只提交一次
+    with metrics.stage("db_write", job.timings, job_id=job.id):
+        async with db.transaction() as cur:
+            await cur.execute("""
+                INSERT INTO photo (
+                    file_unique_id, file_size, width, height, file_name,
+                    caption, root_unique_id, create_time, files_drive,
+                    hash, frame_hashes, same_fuid
+                )
+                VALUES (%s, %s, %s, %s, NULL, NULL, NULL, NOW(), NULL, %s, %s, NULL)
+                ON DUPLICATE KEY UPDATE
+                    file_size=VALUES(file_size),
+                    width=VALUES(width),
+                    height=VALUES(height),
+                    create_time=NOW(),
+                    hash=VALUES(hash),
+                    frame_hashes=VALUES(frame_hashes)
+            """, (
+                photo_unique_id,
+                photo_file_size,
+                photo_width,
+                photo_height,
+                job.phash,
+                ','.join(job.frame_hashes) if job.frame_hashes else None
+            ))
+
+            await cur.execute("""
+                INSERT INTO file_extension (file_type, file_unique_id, file_id, bot, create_time)
+                VALUES ('photo', %s, %s, %s, NOW())
+                ON DUPLICATE KEY UPDATE
+                    file_id=VALUES(file_id),
+                    bot=VALUES(bot),
+                    create_time=NOW()
+            """, (photo_unique_id, photo_file_id, BOT_NAME))
+
+            await cur.execute(
+                """
+                INSERT INTO bid_thumbnail (
+                    file_unique_id,
+                    thumb_file_unique_id,
+                    bot_name,
+                    file_id,
+                    confirm_status,
+                    uploader_id,
+                    status,
+                    t_update
+                )
+                VALUES (%s, %s, %s, %s, 0, 0, 1, 1)
+                ON DUPLICATE KEY UPDATE
+                    thumb_file_unique_id = VALUES(thumb_file_unique_id),
+                    bot_name         = VALUES(bot_name),
+                    file_id          = VALUES(file_id),
+                    confirm_status   = VALUES(confirm_status),
+                    uploader_id      = VALUES(uploader_id),
+                    status           = VALUES(status),
+                    t_update         = 1
+                """,
+                (
+                    file_unique_id,
+                    photo_unique_id,
+                    BOT_NAME,
+                    photo_file_id,       # 这里加上 photo_file_id
+                )
+            )
+
+            await cur.execute(
+                """
+                INSERT INTO sora_content (source_id, thumb_file_unique_id, stage)
+                VALUES (%s, %s, 'pending')
+                ON DUPLICATE KEY UPDATE
+                    thumb_file_unique_id = VALUES(thumb_file_unique_id),
+                    stage = 'pending'
+                """,
+                (
+                    file_unique_id,
+                    photo_unique_id
+                )
+            )
+
+            # 6) 记下网格；done 要等 ZIP 发出之后（complete_grid_job），之前失败的重试只补 ZIP
+            await cur.execute("""
+                UPDATE grid_jobs
+                SET grid_file_id=%s
+                WHERE id=%s
+            """, (photo_file_id, job.id))
+    job.grid_file_id = photo_file_id
+
+    # 新写入的 bid_thumbnail：缓存里旧的“缺少”状态作废，直接换成本 BOT 的缩图
+    thumb_cache.put(file_unique_id, grid_cache.ThumbState(grid_cache.SELF, photo_file_id))
+    if DEDUP_ENABLED:
+        row = await db.fetchone(
+            "SELECT file_unique_id, thumb_hash, duration, width, height FROM video WHERE file_unique_id=%s",
+            (file_unique_id,)
         )
-        VALUES (%s, %s, %s, %s, NULL, NULL, NULL, NOW(), NULL, %s, NULL)
-        ON DUPLICATE KEY UPDATE
-            file_size=VALUES(file_size),
-            width=VALUES(width),
-            height=VALUES(height),
-            create_time=NOW(),
-            hash=VALUES(hash)         
-    """, (
-        photo_unique_id,
-        photo_file_size,
-        photo_width,
-        photo_height,
-        phash_str
-    ))
+        if row:
+            dedup_index.add(*row)
+    print(f"✔️ 预览图已入库: {photo_file_id} {photo_unique_id}", flush=True)
 
+    await send_preview_artifacts(job)
 
 
+    if not ARCHIVE_ENABLED:
+        await complete_grid_job(job)
+        return True
 
-    await db.execute("""
-        INSERT INTO file_extension (file_type, file_unique_id, file_id, bot, create_time)
-        VALUES ('photo', %s, %s, %s, NOW())
-        ON DUPLICATE KEY UPDATE
-            file_id=VALUES(file_id),
-            bot=VALUES(bot),
-            create_time=NOW()
-    """, (photo_unique_id, photo_file_id, BOT_NAME))
+    return await upload_archive(job)
 
-    await db.execute(
-        """
-        INSERT INTO bid_thumbnail (
-            file_unique_id,
-            thumb_file_unique_id,
-            bot_name,
-            file_id,
-            confirm_status,
-            uploader_id,
-            status,
-            t_update
-        )
-        VALUES (%s, %s, %s, %s, 0, 0, 1, 1)
-        ON DUPLICATE KEY UPDATE
-            file_id          = VALUES(file_id),
-            confirm_status   = VALUES(confirm_status),
-            uploader_id      = VALUES(uploader_id),
-            status           = VALUES(status),
-            t_update         = 1
-        """,
-        (
-            file_unique_id,
-            photo_unique_id,
-            BOT_NAME,
-            photo_file_id,       # 这里加上 photo_file_id
-        )
-    )
 
-    await db.execute(
-        """
-        INSERT INTO sora_content (source_id, thumb_file_unique_id, stage)
-        VALUES (%s, %s, 'pending')
-        ON DUPLICATE KEY UPDATE
-            thumb_file_unique_id = VALUES(thumb_file_unique_id),
-            stage = 'pending'
-        """,
-        (
-            file_unique_id,
-            photo_unique_id
-        )
-    )
+async def upload_archive(job: GridJob) -> bool:
+    # 7)  —— 新增：打包 ZIP ——
+    import grid_zip
 
-    print(f"✔️ 预览图已入库: {photo_file_id} {photo_unique_id}", flush=True)
+    file_unique_id = job.file_unique_id
+    chat_id, message_id = job.chat_id, job.message_id
+    video_path, preview_path = job.video_path, job.preview_path
 
-    # 6) 更新任务状态
-    await db.execute("""
-        UPDATE grid_jobs
-        SET job_state='done',
-            finished_at=NOW(),
-            grid_file_id=%s
-        WHERE id=%s
-    """, (photo_file_id, job_id))
-
-
-    # 7)  —— 新增：打包 ZIP —— 
-
-    zip_path = str(temp_dir / f"{file_unique_id}.zip")
-    # 把下载的视频和生成的预览图，一次性传给 fast_zip_with_password
-    await asyncio.to_thread(
-        fast_zip_with_password,
-        [video_path, preview_path],
-        zip_path,
-        file_unique_id
-    )
-    print(f"✔️ Created ZIP archive: {zip_path}")
+    await ensure_full_video(job)
+
+    zip_name = f"{file_unique_id}.zip"
+    zip_path = scratch.path(job.id, zip_name)
+    caption = f"🔒 已打包并加密：{zip_name}"
+    upload_state = upload_sidecar_path(zip_path)
+    # 续传条件：两个输入文件的大小与修改时间都没变（修改时间也写进 ZIP 的文件头）
+    inputs = [[os.path.getsize(p), os.path.getmtime(p)] for p in (video_path, preview_path)]
+    last_meta = (PartUploader.load_state(upload_state) or {}).get("meta", {})
+    if last_meta.get("inputs") != inputs:
+        last_meta = {}
+    stream = None
+    if ARCHIVE_STREAM and grid_zip.available():
+        # 边读边加密边上传，ZIP 不落盘；续传时沿用上次的 salt，产出的字节才会一样
+        salts = last_meta.get("salts")
+        try:
+            stream = grid_zip.EncryptedZipStream(
+                [video_path, preview_path],
+                file_unique_id,
+                salts=[bytes.fromhex(x) for x in salts] if salts else None
+            )
+        except Exception as e:
+            print(f"⚠️ 无法建立流式 ZIP，改用 zip 命令：{e}", flush=True)
+    if stream:
+        upload_meta = {"inputs": inputs, "salts": [x.hex() for x in stream.salts]}
+        archive_size = stream.size
+        print(f"✔️ Streaming ZIP archive: {zip_name} ({stream.size} bytes)", flush=True)
+    else:
+        # zip -P 每次的加密头都是随机的：输入没变、上次打好的 ZIP 也还在时直接沿用才能续传
+        zip_stat = [os.path.getsize(zip_path), os.path.getmtime(zip_path)] if os.path.exists(zip_path) else None
+        if not zip_stat or last_meta.get("zip") != zip_stat:
+            # 把下载的视频和生成的预览图，一次性传给 fast_zip_with_password
+            with metrics.stage("zip", job.timings, job_id=job.id):
+                await asyncio.to_thread(
+                    fast_zip_with_password,
+                    [video_path, preview_path],
+                    zip_path,
+                    file_unique_id
+                )
+            zip_stat = [os.path.getsize(zip_path), os.path.getmtime(zip_path)]
+            print(f"✔️ Created ZIP archive: {zip_path}")
+        upload_meta = {"inputs": inputs, "zip": zip_stat}
+        archive_size = zip_stat[0]
 
     # 8)  备份:上传 ZIP 到指定 chat_id（优先环境变量，否则原 chat），并显示上传进度
     await start_telethon()
@@ -704,43 +1752,97 @@ async def process_one_grid_job():
     # 1) 构造完整 ID
     CHANNEL_ID = int(f"-100{TELEGROUP_ARCHIVE}")
 
-
+    uploader = PartUploader(
+        tele_client,
+        archive_size,
+        zip_name,
+        part_size=UPLOAD_PART_SIZE,
+        parallel=UPLOAD_PARALLEL,
+        state_path=upload_state,
+        meta=upload_meta,
+        progress=grid_metrics.throttle(
+            lambda cur, tot: telethon_upload_progress(cur, tot, zip_name), PROGRESS_INTERVAL
+        )
+    )
 
     try:
         # 2) 获取实体
         chat_entity = await tele_client.get_entity(CHANNEL_ID)
         
-        # 3) 发送文件
-        await tele_client.send_file(
-            chat_entity,
-            file=zip_path,
-            caption=f"🔒 已打包并加密：{file_unique_id}.zip",
-            force_document=True,
-            progress_callback=lambda cur, tot: telethon_upload_progress(cur, tot, zip_path)
-        )
+        # 3) 分块并行上传后发送；失败时以同一个 file_id 续传，只补缺的分块
+        for attempt in range(1, ARCHIVE_UPLOAD_ATTEMPTS + 1):
+            parts = stream.iter_parts(UPLOAD_PART_SIZE) if stream else iter_file_parts(zip_path, UPLOAD_PART_SIZE)
+            try:
+                # 流式 ZIP 的加密在 upload 里边读边做，计入 archive_upload
+                with metrics.stage("archive_upload", job.timings, job_id=job.id, attempt=attempt):
+                    uploaded = await uploader.upload(parts)
+                with metrics.stage("archive_send", job.timings, job_id=job.id):
+                    await tele_client.send_file(chat_entity, file=uploaded, caption=caption, force_document=True)
+                break
+            except FilePartMissingError:
+                # 服务器已丢弃之前的分块
+                print(f"\n⚠️ 分块已过期，重新上传 {zip_name}", flush=True)
+                uploader.reset()
+                if attempt == ARCHIVE_UPLOAD_ATTEMPTS:
+                    raise
+            except Exception as e:
+                if attempt == ARCHIVE_UPLOAD_ATTEMPTS:
+                    raise
+                print(f"\n⚠️ 上传 ZIP 中断（第 {attempt} 次），续传：{e}", flush=True)
+                await asyncio.sleep(2 ** attempt)
+        uploader.finish()
 
     except Exception as e:
-        await bot.send_document(
-            chat_id=TELEGROUP_ARCHIVE,
-            document=FSInputFile(zip_path),
-            caption=f"🔒 已打包并加密：{file_unique_id}.zip",
-            reply_to_message_id=message_id
-        )
+        print(f"⚠️ Telethon 上传 ZIP 失败，改用 Bot API：{e}", flush=True)
+        with metrics.stage("archive_bot_api", job.timings, job_id=job.id):
+            await bot.send_document(
+                chat_id=TELEGROUP_ARCHIVE,
+                document=ZipStreamInputFile(stream, zip_name) if stream else FSInputFile(zip_path),
+                caption=caption,
+                reply_to_message_id=message_id
+            )
+        uploader.finish()
+    print()
+    print(f"✅ ZIP 已发送到 chat_id={chat_id}",flush=True)
 
+    await complete_grid_job(job)
+    return True
 
+        
+        
+        
 
-    print()
-    print(f"✅ ZIP 已发送到 chat_id={chat_id}",flush=True)
 
+async def send_preview_artifacts(job: GridJob):
+    """雪碧图、WebVTT 索引、动画预览作为一组文件发到 TELEGROUP_PREVIEW；失败只记录，不影响任务"""
+    if not job.artifacts or not TELEGROUP_PREVIEW:
+        return
+    caption = f"🎞️ {job.file_unique_id}"
+    try:
+        with metrics.stage("send_artifacts", job.timings, job_id=job.id):
+            if len(job.artifacts) == 1:
+                await bot.send_document(chat_id=TELEGROUP_PREVIEW, document=FSInputFile(job.artifacts[0]),
+                                        caption=caption)
+            else:
+                media = [InputMediaDocument(media=FSInputFile(p)) for p in job.artifacts]
+                media[-1].caption = caption
+                await bot.send_media_group(chat_id=TELEGROUP_PREVIEW, media=media)
+        print(f"✔️ 额外预览已发送: {', '.join(Path(p).name for p in job.artifacts)}", flush=True)
+    except Exception as e:
+        print(f"⚠️ 额外预览发送失败: {e}", flush=True)
 
 
+class ZipStreamInputFile(InputFile):
+    """Bot API 退路：同一个流式 ZIP 重新产出一遍，直接作为 multipart 上传内容"""
 
-    print(f"✅ Job ID={job_id} completed",flush=True)
-    shutdown_event.set()
+    def __init__(self, stream: "grid_zip.EncryptedZipStream", filename: str):
+        super().__init__(filename=filename)
+        self.stream = stream
 
-        
-        
-        
+    async def read(self, bot: Bot):
+        parts = self.stream.iter_parts(self.chunk_size)
+        while (chunk := await asyncio.to_thread(next, parts, None)) is not None:
+            yield chunk
 
 
 # 进度回调
@@ -751,28 +1853,59 @@ def telethon_upload_progress(current: int, total: int, zip_path: str):
 async def shutdown():
     # 1) 关闭 aiogram 内部的 HTTP session
     await bot.session.close()
-    # 2) 关闭你的 MySQL 连接池
+    # 2) 被取消的任务放回 pending，再关闭你的 MySQL 连接池
+    try:
+        released = await job_leases.release_all()
+        if released:
+            print(f"↩️ {released} 个未完成的任务已放回队列", flush=True)
+    except Exception as e:
+        print(f"⚠️ 放回未完成的任务失败（租约过期后会被收回）: {e}", flush=True)
     await db.close()
     await tele_client.disconnect()
-
-async def main():
-    global BOT_NAME, BOT_ID, API_ID
-    me = await bot.get_me()
+    # 被取消、还留在流水线队列里的任务已放回 pending：暂存文件留给下次认领续传
+    scratch.detach_all()
+    if render_pool is not None:
+        await asyncio.to_thread(render_pool.shutdown)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+async def startup():
+    """
+    Bot 身份与数据库连线池（MYSQL_PREWARM 时顺便预热）并行；回传时两者都已就绪，可以马上认领任务
+    （取代原本固定 sleep 10 秒）。Telethon 在第一次需要 MTProto 时才连线授权：
+    Bot API 下载得了的小文件、不打包 ZIP 时完全不必登录 MTProto
+    """
+    global BOT_NAME, BOT_ID
+    t0 = time.perf_counter()
+    me, _ = await asyncio.gather(bot.get_me(), db.init())
     BOT_NAME = me.username
     BOT_ID = me.id
     print(f"🤖 Logged in as @{BOT_NAME} (BOT_ID={BOT_ID}, API_ID={API_ID})")
+    metrics.record_stage("startup", time.perf_counter() - t0)
 
-    await start_telethon()
-    
 
-   
+async def main():
+    global metrics_runner
+    if bot is None or not API_ID or not API_HASH:
+        raise SystemExit("❌ 缺少 BOT_TOKEN / API_ID / API_HASH（CONFIGURATION 或环境变量）")
+    if METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+
+    stale = scratch.sweep()
+    if stale:
+        print(f"🧹 已清理 {stale} 个残留的暂存文件", flush=True)
+    await startup()
+
+    # 就绪后立即开始处理任务；去重索引在第一个需要查重的视频到达时才载入
+    if WORKER_MODE == 'loop':
+        task1 = asyncio.create_task(grid_worker())
+    else:
+        task1 = asyncio.create_task(process_one_grid_job())
     task2 = asyncio.create_task(limited_polling())
-
-     # 并行启动，两者谁先结束，就取消另一个
-    await asyncio.sleep(10)  # 等待 5 秒，确保 Telethon 完全连接
-    task1 = asyncio.create_task(process_one_grid_job())
+    heartbeat = asyncio.create_task(lease_heartbeat())
 
     try:
+        # 两者谁先结束，就取消另一个
         done, pending = await asyncio.wait(
             [task1, task2],
             return_when=asyncio.FIRST_COMPLETED
@@ -781,9 +1914,205 @@ async def main():
         for t in pending:
             t.cancel()
     finally:
+        heartbeat.cancel()
         # 不管如何，都优雅地关掉 session 和连接池
         await shutdown()
 
 
+async def existing_thumbnails(cur, unique_ids: list[str], chunk: int = 1000) -> set[str]:
+    """已经有可用缩图（bid_thumbnail 指向的缩图有 file_extension）的视频，回填时不必再渲染；ORPHAN 的照样回填"""
+    found = set()
+    for i in range(0, len(unique_ids), chunk):
+        ids = unique_ids[i:i + chunk]
+        await cur.execute(f"""
+            SELECT DISTINCT b.file_unique_id
+            FROM bid_thumbnail b
+            JOIN file_extension f ON f.file_unique_id = b.thumb_file_unique_id
+            WHERE b.file_unique_id IN ({in_clause(ids)})
+        """, ids)
+        found.update(row[0] for row in await cur.fetchall())
+    return found
+
+
+async def write_backfill_batch(results: list[tuple["grid_backfill.VideoFile", "RenderedGrid"]]):
+    """
+    一批回填结果：photo 与 bid_thumbnail 各一条多列 INSERT，同一个事务。
+    bid_thumbnail 指向 local_ 网格，thumbnail_states 判为 HASHED（收到视频时照常排任务，上传后改指真正的缩图）；
+    已经有可用缩图的视频（--force 重做时）保留原本的记录
+    """
+    photos = [
+        (grid_backfill.PHOTO_PREFIX + video.file_unique_id, os.path.getsize(grid.path), grid.width, grid.height,
+         os.path.basename(grid.path), os.path.abspath(grid.path), grid.phash, ','.join(grid.frame_hashes))
+        for video, grid in results
+    ]
+    async with db.transaction() as cur:
+        sql, args = values_rows("(%s, %s, %s, %s, %s, NULL, NULL, NOW(), %s, %s, %s, NULL)", photos)
+        await cur.execute(f"""
+            INSERT INTO photo (
+                file_unique_id, file_size, width, height, file_name,
+                caption, root_unique_id, create_time, files_drive,
+                hash, frame_hashes, same_fuid
+            )
+            VALUES {sql}
+            ON DUPLICATE KEY UPDATE
+                file_size=VALUES(file_size),
+                width=VALUES(width),
+                height=VALUES(height),
+                file_name=VALUES(file_name),
+                create_time=NOW(),
+                files_drive=VALUES(files_drive),
+                hash=VALUES(hash),
+                frame_hashes=VALUES(frame_hashes)
+        """, args)
+        existing = await existing_thumbnails(cur, [video.file_unique_id for video, _ in results])
+        links = [
+            (video.file_unique_id, grid_backfill.PHOTO_PREFIX + video.file_unique_id)
+            for video, _ in results if video.file_unique_id not in existing
+        ]
+        if links:
+            sql, args = values_rows("(%s, %s, NULL, NULL, 0, 0, 1, 1)", links)
+            await cur.execute(f"""
+                INSERT INTO bid_thumbnail (
+                    file_unique_id, thumb_file_unique_id, bot_name, file_id,
+                    confirm_status, uploader_id, status, t_update
+                )
+                VALUES {sql}
+                ON DUPLICATE KEY UPDATE
+                    thumb_file_unique_id = VALUES(thumb_file_unique_id),
+                    bot_name             = VALUES(bot_name),
+                    file_id              = VALUES(file_id),
+                    t_update             = 1
+            """, args)
+
+
+async def backfill(argv: list[str]):
+    """
+    python grid_main.py backfill <dir>：离线回填本地视频目录（见 grid_backfill）。
+    workers * 2 个协程轮流把视频送进渲染进程池（每个进程手上多排一个，不必等主进程），
+    结果经队列交给单一的写入协程，满 batch 个或每 flush_interval 秒写一次数据库，再追加 manifest
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="grid_main.py backfill", description="离线回填本地视频的网格与 pHash")
+    parser.add_argument("dir", help="视频目录（递归扫描）")
+    parser.add_argument("--out", default="backfill", help="网格 JPEG 输出目录")
+    parser.add_argument("--manifest", help="进度记录（默认 <out>/manifest.jsonl）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="渲染进程数")
+    parser.add_argument("--batch", type=int, default=200, help="每次写入数据库的视频数")
+    parser.add_argument("--flush-interval", type=float, default=30, help="最久多少秒写一次数据库")
+    parser.add_argument("--report-interval", type=float, default=10, help="进度汇报间隔（秒）")
+    parser.add_argument("--extensions", default=",".join(grid_backfill.VIDEO_EXTENSIONS))
+    parser.add_argument("--retry-failed", action="store_true", help="重做 manifest 里失败的文件")
+    parser.add_argument("--force", action="store_true", help="已经有缩图的视频也重新生成")
+    args = parser.parse_args(argv)
+
+    global render_pool
+    from grid_render import init_render_worker
+
+    os.makedirs(args.out, exist_ok=True)
+    manifest = grid_backfill.Manifest(args.manifest or os.path.join(args.out, "manifest.jsonl"))
+    videos, seen = [], set()
+    for video in grid_backfill.scan(args.dir, [e.strip() for e in args.extensions.split(",") if e.strip()]):
+        if video.file_unique_id in seen:
+            print(f"⚠️ file_unique_id 重复，跳过: {video.rel}", flush=True)
+            continue
+        seen.add(video.file_unique_id)
+        if not manifest.done(video, args.retry_failed):
+            videos.append(video)
+
+    await db.init()
+    if videos and not args.force:
+        async with db.connection() as cur:
+            existing = await existing_thumbnails(cur, [v.file_unique_id for v in videos])
+        if existing:
+            print(f"⏭️ {len(existing)} 个视频已经有缩图，跳过", flush=True)
+            videos = [v for v in videos if v.file_unique_id not in existing]
+    print(f"🗂️ backfill {args.dir}: 共 {len(seen)} 个视频，待处理 {len(videos)} 个，workers={args.workers}", flush=True)
+
+    render_pool = RecyclingProcessPool(
+        args.workers,
+        RENDER_JOBS_PER_WORKER,
+        initializer=init_render_worker,
+        initargs=(FONT_PATH,),
+        main_module="grid_render"
+    )
+    progress = grid_backfill.Progress(len(videos), args.report_interval)
+    results: asyncio.Queue = asyncio.Queue(maxsize=args.batch * 2)
+    todo = iter(videos)
+
+    async def render_worker():
+        for video in todo:
+            try:
+                grid = await make_keyframe_grid(
+                    video.path, os.path.join(args.out, f"preview_{video.file_unique_id}")
+                )
+                await results.put((video, grid, None))
+            except Exception as e:
+                print(f"❌ 回填失败 {video.rel}: {e}", flush=True)
+                await results.put((video, None, str(e)[:255]))
+
+    async def flush(batch: list) -> list:
+        rendered = [(video, grid) for video, grid, _ in batch if grid]
+        if rendered:
+            await write_backfill_batch(rendered)
+        # 数据库提交之后才记入 manifest：中断时这批会整批重做，不会漏写
+        manifest.append([
+            grid_backfill.manifest_entry(video, grid_backfill.PHOTO_PREFIX + video.file_unique_id, grid.phash)
+            if grid else grid_backfill.manifest_entry(video, error=error)
+            for video, grid, error in batch
+        ])
+        for video, grid, _ in batch:
+            progress.add(grid is not None, video.size)
+        return []
+
+    async def writer():
+        batch, deadline = [], 0.0
+        while True:
+            try:
+                item = await asyncio.wait_for(
+                    results.get(), max(0.0, deadline - time.monotonic()) if batch else None
+                )
+            except asyncio.TimeoutError:
+                batch = await flush(batch)
+                continue
+            if item is None:
+                await flush(batch)
+                return
+            if not batch:
+                deadline = time.monotonic() + args.flush_interval
+            batch.append(item)
+            if len(batch) >= args.batch:
+                batch = await flush(batch)
+
+    write_task = asyncio.create_task(writer())
+    workers = [asyncio.create_task(render_worker()) for _ in range(max(1, args.workers) * 2)]
+    try:
+        # 写入协程出错时渲染协程会卡在 results.put：一起等，写入先结束就取消渲染
+        pending = set(workers)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending | {write_task}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if write_task in done:
+                write_task.result()
+                raise RuntimeError("写入协程提前结束")
+            pending.discard(write_task)
+            for task in done:
+                task.result()
+        await results.put(None)
+        await write_task
+    finally:
+        for task in workers:
+            task.cancel()
+        write_task.cancel()
+        await asyncio.to_thread(render_pool.shutdown)
+        await db.close()
+    progress.report()
+    print(f"✅ backfill 完成：{progress.done - progress.failed} 成功，{progress.failed} 失败", flush=True)
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.argv[1:2] == ["backfill"]:
+        asyncio.run(backfill(sys.argv[2:]))
+    else:
+        asyncio.run(main())
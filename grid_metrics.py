@@ -0,0 +1,159 @@
+"""
+结构化指标
+
+- stage(name, timings, **fields)：计时区块，结束时记入 grid_stage_seconds 直方图；
+  timings 不为空时把耗时累加进去（任务结束时写入 grid_jobs.stage_timings）
+- record_stage：记一次已知耗时的阶段（渲染进程回传的子阶段）
+- observe(metric, seconds, labels, **fields)：直接记一次耗时（数据库语句）
+- event(kind, **fields)：只写 JSON 行的事件（例如任务完成时的整份 stage_timings）
+- 设定 json_path 时每次记录追加一行 JSON（"-" 表示 stdout）；serve() 提供 Prometheus 文本格式的 /metrics
+- labels 只放取值有限的维度（阶段名、语句种类），job_id 之类放在 fields，只出现在 JSON 行里
+- throttle：进度回调限频，避免每个分块都 flush 一次 stdout
+"""
+import json
+import re
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_SQL_LABEL = re.compile(
+    r"^\s*(?:(SELECT|DELETE)\b.*?\bFROM|(INSERT)(?:\s+IGNORE)?\s+INTO|(UPDATE))\s+`?(\w+)", re.I | re.S
+)
+
+
+def sql_label(query: str) -> str:
+    """语句种类 + 第一个表名，例如 "insert video"；其它语句只取第一个词（"commit"）"""
+    match = _SQL_LABEL.match(query)
+    if not match:
+        words = query.split(None, 1)
+        return words[0].lower() if words else "other"
+    *verbs, table = match.groups()
+    verb = next(v for v in verbs if v)
+    return f"{verb.lower()} {table}"
+
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    def __init__(self, prefix: str = "grid", json_path: Optional[str] = None):
+        self.prefix = prefix
+        self.json_path = json_path
+        self._json = None
+        self._histograms: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+
+    def _write(self, record: dict):
+        if not self.json_path:
+            return
+        if self._json is None:
+            self._json = sys.stdout if self.json_path == "-" else open(self.json_path, "a", buffering=1)
+        self._json.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def observe(self, metric: str, seconds: float, labels: Optional[Dict[str, str]] = None, **fields):
+        key = tuple(sorted((labels or {}).items()))
+        self._histograms.setdefault(metric, {}).setdefault(key, _Histogram()).observe(seconds)
+        self._write({"ts": round(time.time(), 3), "metric": metric, **(labels or {}),
+                     "seconds": round(seconds, 4), **fields})
+
+    def inc(self, metric: str, value: float = 1, labels: Optional[Dict[str, str]] = None):
+        key = tuple(sorted((labels or {}).items()))
+        counters = self._counters.setdefault(metric, {})
+        counters[key] = counters.get(key, 0) + value
+
+    def event(self, kind: str, **fields):
+        self._write({"ts": round(time.time(), 3), "event": kind, **fields})
+
+    def record_stage(self, name: str, seconds: float, timings: Optional[Dict[str, float]] = None,
+                     ok: bool = True, **fields):
+        if timings is not None:
+            timings[name] = round(timings.get(name, 0) + seconds, 3)
+        self.observe("stage_seconds", seconds, {"stage": name}, ok=ok, **fields)
+
+    @contextmanager
+    def stage(self, name: str, timings: Optional[Dict[str, float]] = None, **fields):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record_stage(name, time.perf_counter() - t0, timings, ok, **fields)
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric, series in self._histograms.items():
+            name = f"{self.prefix}_{metric}"
+            lines.append(f"# TYPE {name} histogram")
+            for key, hist in series.items():
+                for bound, count in zip(BUCKETS, hist.buckets):
+                    lines.append(f"{name}_bucket{_labels(key, le=bound)} {count}")
+                lines.append(f"{name}_bucket{_labels(key, le='+Inf')} {hist.count}")
+                lines.append(f"{name}_sum{_labels(key)} {hist.sum:.6f}")
+                lines.append(f"{name}_count{_labels(key)} {hist.count}")
+        for metric, series in self._counters.items():
+            name = f"{self.prefix}_{metric}"
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int):
+        """在 host:port/metrics 提供 Prometheus 抓取；回传 aiohttp AppRunner（关闭时 cleanup）"""
+        from aiohttp import web
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        print(f"📈 Metrics on http://{host}:{port}/metrics", flush=True)
+        return runner
+
+
+def _labels(key: LabelKey, **extra) -> str:
+    items = list(key) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def throttle(callback: Callable[[int, int], None], interval: float) -> Callable[[int, int], None]:
+    """callback(current, total) 每 interval 秒最多调用一次；完成（current >= total）时一定调用"""
+    last = 0.0
+
+    def call(current: int, total: Optional[int]):
+        nonlocal last
+        now = time.monotonic()
+        if now - last < interval and not (total and current >= total):
+            return
+        last = now
+        callback(current, total)
+
+    return call
@@ -0,0 +1,194 @@
+"""
+MP4 / MOV 索引解析（只读 moov，不需要整个文件）
+
+通过 read(offset, length) 以区间方式读取顶层 box，找到 moov 后解析视频轨的
+stts / stss / stsc / stsz / stco(co64)，把采样时间点映射到关键帧样本的字节区间。
+"""
+import struct
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+ReadRange = Callable[[int, int], Awaitable[bytes]]
+
+MAX_MOOV_SIZE = 256 * 1024 * 1024
+
+
+class UnsupportedContainer(Exception):
+    """不是可解析的 MP4/MOV（或是分片 MP4），调用方应退回完整下载"""
+
+
+def _box_header(data: bytes, pos: int, end: int) -> Tuple[int, bytes, int]:
+    """回传 (box 总长度, 类型, header 长度)"""
+    if pos + 8 > end:
+        raise UnsupportedContainer("box header 被截断")
+    size, box_type = struct.unpack_from(">I4s", data, pos)
+    header = 8
+    if size == 1:
+        if pos + 16 > end:
+            raise UnsupportedContainer("largesize 被截断")
+        size = struct.unpack_from(">Q", data, pos + 8)[0]
+        header = 16
+    elif size == 0:
+        size = end - pos
+    if size < header:
+        raise UnsupportedContainer(f"box {box_type!r} 长度异常: {size}")
+    return size, box_type, header
+
+
+async def read_moov(read: ReadRange, total: int) -> bytes:
+    """逐个读取顶层 box header 直到找到 moov，回传整个 moov box"""
+    pos = 0
+    first = True
+    while pos < total:
+        head = await read(pos, min(16, total - pos))
+        size, box_type, header = _box_header(head, 0, len(head))
+        if first and box_type not in (b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pnot"):
+            raise UnsupportedContainer(f"不是 MP4/MOV: {box_type!r}")
+        first = False
+        if box_type == b"moof":
+            raise UnsupportedContainer("分片 MP4")
+        if box_type == b"moov":
+            if size > MAX_MOOV_SIZE:
+                raise UnsupportedContainer(f"moov 过大: {size}")
+            return await read(pos, size)
+        pos += size
+    raise UnsupportedContainer("找不到 moov")
+
+
+def _children(data: bytes, start: int, end: int):
+    pos = start
+    while pos + 8 <= end:
+        size, box_type, header = _box_header(data, pos, end)
+        yield box_type, pos + header, min(pos + size, end)
+        pos += size
+
+
+def _find(data: bytes, start: int, end: int, box_type: bytes) -> Optional[Tuple[int, int]]:
+    for child_type, body_start, body_end in _children(data, start, end):
+        if child_type == box_type:
+            return body_start, body_end
+    return None
+
+
+def _table(data: bytes, start: int, count: int, columns: int, dtype: str = ">u4") -> np.ndarray:
+    try:
+        arr = np.frombuffer(data, dtype=dtype, count=count * columns, offset=start)
+    except ValueError:
+        raise UnsupportedContainer("样本表被截断")
+    return arr.astype(np.int64).reshape(count, columns) if columns > 1 else arr.astype(np.int64)
+
+
+def _timescale_duration(data: bytes, start: int) -> Tuple[int, int]:
+    """mvhd / mdhd：回传 (timescale, duration)"""
+    version = data[start]
+    if version == 1:
+        return struct.unpack_from(">IQ", data, start + 4 + 16)
+    return struct.unpack_from(">II", data, start + 4 + 8)
+
+
+class VideoTrackIndex:
+    """视频轨的样本索引：解码时间、关键帧、每个样本的字节偏移与大小"""
+
+    def __init__(self, moov: bytes):
+        size, box_type, header = _box_header(moov, 0, len(moov))
+        if box_type != b"moov":
+            raise UnsupportedContainer("不是 moov box")
+        start, end = header, len(moov)
+
+        mvhd = _find(moov, start, end, b"mvhd")
+        if not mvhd:
+            raise UnsupportedContainer("缺少 mvhd")
+        movie_timescale, movie_duration = _timescale_duration(moov, mvhd[0])
+        self.duration = movie_duration / movie_timescale if movie_timescale else 0.0
+
+        stbl = None
+        for child_type, trak_start, trak_end in _children(moov, start, end):
+            if child_type != b"trak":
+                continue
+            mdia = _find(moov, trak_start, trak_end, b"mdia")
+            hdlr = mdia and _find(moov, mdia[0], mdia[1], b"hdlr")
+            if not hdlr or moov[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+                continue
+            mdhd = _find(moov, mdia[0], mdia[1], b"mdhd")
+            minf = _find(moov, mdia[0], mdia[1], b"minf")
+            stbl = minf and _find(moov, minf[0], minf[1], b"stbl")
+            if mdhd and stbl:
+                self.timescale, _ = _timescale_duration(moov, mdhd[0])
+                break
+            stbl = None
+        if not stbl:
+            raise UnsupportedContainer("找不到视频轨")
+
+        boxes = {t: (s, e) for t, s, e in _children(moov, stbl[0], stbl[1])}
+        for required in (b"stts", b"stsc", b"stsz"):
+            if required not in boxes:
+                raise UnsupportedContainer(f"缺少 {required.decode()}")
+        if b"stco" not in boxes and b"co64" not in boxes:
+            raise UnsupportedContainer("缺少 stco/co64")
+
+        # stts → 每个样本的解码时间
+        s = boxes[b"stts"][0]
+        stts = _table(moov, s + 8, struct.unpack_from(">I", moov, s + 4)[0], 2)
+        deltas = np.repeat(stts[:, 1], stts[:, 0])
+        self.sample_count = len(deltas)
+        if not self.sample_count:
+            raise UnsupportedContainer("视频轨没有样本（分片 MP4？）")
+        self.dts = np.concatenate(([0], np.cumsum(deltas)[:-1]))
+
+        # stsz → 每个样本的大小
+        s = boxes[b"stsz"][0]
+        fixed_size, count = struct.unpack_from(">II", moov, s + 4)
+        sizes = np.full(count, fixed_size, dtype=np.int64) if fixed_size else _table(moov, s + 12, count, 1)
+        if count != self.sample_count:
+            raise UnsupportedContainer("stsz 与 stts 样本数不一致")
+        self.sizes = sizes
+
+        # stco / co64 + stsc → 每个样本的文件偏移
+        if b"co64" in boxes:
+            s = boxes[b"co64"][0]
+            chunk_offsets = _table(moov, s + 8, struct.unpack_from(">I", moov, s + 4)[0], 1, ">u8")
+        else:
+            s = boxes[b"stco"][0]
+            chunk_offsets = _table(moov, s + 8, struct.unpack_from(">I", moov, s + 4)[0], 1)
+        s = boxes[b"stsc"][0]
+        stsc = _table(moov, s + 8, struct.unpack_from(">I", moov, s + 4)[0], 3)
+        if not len(stsc):
+            raise UnsupportedContainer("stsc 为空")
+        first_chunks = np.append(stsc[:, 0] - 1, len(chunk_offsets))
+        per_chunk = np.repeat(stsc[:, 1], np.clip(np.diff(first_chunks), 0, None))
+        chunk_first_sample = np.concatenate(([0], np.cumsum(per_chunk)[:-1]))
+        size_csum = np.concatenate(([0], np.cumsum(sizes)))
+        sample_chunk = np.searchsorted(chunk_first_sample, np.arange(self.sample_count), side="right") - 1
+        self.offsets = (
+            chunk_offsets[sample_chunk]
+            + size_csum[:self.sample_count]
+            - size_csum[chunk_first_sample[sample_chunk]]
+        )
+
+        # stss → 关键帧（没有 stss 表示每个样本都是关键帧）
+        if b"stss" in boxes:
+            s = boxes[b"stss"][0]
+            self.sync = np.sort(_table(moov, s + 8, struct.unpack_from(">I", moov, s + 4)[0], 1) - 1)
+        else:
+            self.sync = np.arange(self.sample_count)
+
+    def keyframe_samples(self, times: List[float], neighbours: int = 1) -> List[int]:
+        """
+        每个时间点之前最近的关键帧，以及前后各 neighbours 个关键帧
+        （ffmpeg 按 pts 而不是 dts seek，加上解码器的帧重排延迟，多取相邻关键帧比较稳妥）
+        """
+        ticks = np.asarray(times) * self.timescale
+        samples = np.searchsorted(self.dts, ticks, side="right") - 1
+        keys = np.searchsorted(self.sync, np.clip(samples, 0, None), side="right") - 1
+        picked = set()
+        for k in keys:
+            for j in range(k - neighbours, k + neighbours + 1):
+                if 0 <= j < len(self.sync):
+                    picked.add(int(self.sync[j]))
+        return sorted(picked)
+
+    def sample_ranges(self, samples: List[int]) -> List[Tuple[int, int]]:
+        """样本 → (offset, size)"""
+        return [(int(self.offsets[i]), int(self.sizes[i])) for i in samples]
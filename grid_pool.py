@@ -0,0 +1,98 @@
+"""
+渲染进程池
+
+抽帧、拼图、JPEG 编码、哈希都是 CPU 密集的工作，放到独立进程里跑，事件循环（轮询、Telethon 心跳、
+数据库连线）不受 GIL 影响。
+
+- spawn 启动：子进程不继承父进程的事件循环、连线与 Telethon 状态
+- main_module：spawn 子进程启动时会重新执行父进程的主脚本（grid_main 的模块层级会建立 Bot、
+  Telethon 客户端、MySQL 连线池与暂存目录）；指定后子进程改为只载入这个模块
+- initializer：每个 worker 启动时载入一次字体与编解码器
+- 回收：Python 3.10 没有 max_tasks_per_child，提交满 workers * jobs_per_worker 个任务后
+  换一个新的进程池，旧池在手上的任务完成后自行退出，限制长期运行的内存增长
+"""
+import asyncio
+import contextlib
+import functools
+import importlib.util
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Tuple
+
+
+class RecyclingProcessPool:
+    def __init__(
+        self,
+        workers: int,
+        jobs_per_worker: int = 20,
+        initializer: Optional[Callable] = None,
+        initargs: Tuple = (),
+        main_module: Optional[str] = None
+    ):
+        self.workers = max(1, workers)
+        self.jobs_per_worker = jobs_per_worker
+        self.initializer = initializer
+        self.initargs = initargs
+        self.main_module = main_module
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._submitted = 0
+        self.generation = 0
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        self.generation += 1
+        self._submitted = 0
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=self.initializer,
+            initargs=self.initargs
+        )
+
+    def _executor_for_job(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = self._new_executor()
+        elif self.jobs_per_worker and self._submitted >= self.workers * self.jobs_per_worker:
+            old, self._executor = self._executor, self._new_executor()
+            # 不等待：旧池处理完已提交的任务后自行结束
+            old.shutdown(wait=False)
+            print(f"♻️ 渲染进程池已回收（第 {self.generation} 代）", flush=True)
+        self._submitted += 1
+        return self._executor
+
+    @contextlib.contextmanager
+    def _spawn_main(self):
+        """
+        提交任务时 ProcessPoolExecutor 可能同步启动 worker：这段时间把 __main__.__spec__ 换成 main_module，
+        multiprocessing 的 spawn 准备数据就只会让子进程载入 main_module，而不是重新执行主脚本
+        """
+        if not self.main_module:
+            yield
+            return
+        main = sys.modules["__main__"]
+        spec = getattr(main, "__spec__", None)
+        main.__spec__ = importlib.util.find_spec(self.main_module)
+        try:
+            yield
+        finally:
+            main.__spec__ = spec
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        executor = self._executor_for_job()
+        loop = asyncio.get_running_loop()
+        try:
+            with self._spawn_main():
+                future = loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+            return await future
+        except BrokenProcessPool:
+            # worker 崩溃（例如被 OOM kill）：丢弃整个池，下一个任务重新建立
+            if self._executor is executor:
+                self._executor = None
+            executor.shutdown(wait=False)
+            raise
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
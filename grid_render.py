@@ -0,0 +1,593 @@
+"""
+关键帧抽取后端
+
+- ffmpeg：对每个采样时间点做输入端快速 seek（-ss 放在 -i 之前 + -noaccurate_seek），
+  只解码该时间点之前最近的关键帧，可直接在解码端缩放。
+- moviepy：原来的 VideoFileClip.get_frame 方式，作为 fallback。
+
+网格合成时每帧在解码端就缩放到目标格子大小，直接写进预先分配好的整张画布，
+不产生逐帧的中间图片，JPEG 只编码一次。
+
+感知哈希也直接在内存里的画布上计算：每格一个 64 位 pHash（所有格子一次批量 DCT），
+整张网格的 pHash 与原来的 photo.hash 相同算法，不必再从磁盘解码 JPEG。
+
+多种预览（网格、拖动预览雪碧图 + WebVTT 索引、动画 WebP/GIF）各是一个版面（SheetLayout）：
+所有版面的取样时间点合并后每个时间点只解码一次，再缩放进各自的画布，新增一种预览只多花编码时间。
+"""
+import functools
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import imagehash
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+FRAME_BACKENDS = ("ffmpeg", "moviepy")
+
+HASH_SIZE = 8
+HASH_IMG_SIZE = HASH_SIZE * 4
+# ITU-R 601-2 luma，与 PIL 的 convert("L") 相同
+LUMA = np.array([0.299, 0.587, 0.114])
+
+_ffmpeg_bin = None
+
+
+class DecodeError(RuntimeError):
+    """视频本身无法解析或解码：同一个文件重试结果也一样"""
+
+
+def ffmpeg_exe() -> str:
+    """优先使用 PATH 中的 ffmpeg，否则用 moviepy 依赖的 imageio-ffmpeg 自带的二进制"""
+    global _ffmpeg_bin
+    if _ffmpeg_bin is None:
+        _ffmpeg_bin = os.getenv("FFMPEG_BINARY") or shutil.which("ffmpeg")
+        if not _ffmpeg_bin:
+            import imageio_ffmpeg
+            _ffmpeg_bin = imageio_ffmpeg.get_ffmpeg_exe()
+    return _ffmpeg_bin
+
+
+@functools.lru_cache(maxsize=32)
+def load_font(font_path: str, size: int) -> ImageFont.FreeTypeFont:
+    """同一进程内重复使用已载入的字体"""
+    return ImageFont.truetype(font_path, size=size)
+
+
+def init_render_worker(font_path: str = "fonts/Roboto_Condensed-Regular.ttf", preload_moviepy: bool = True):
+    """
+    渲染进程池的 initializer：每个 worker 启动时执行一次。
+    找好 ffmpeg、载入字体、预先 import moviepy（fallback 用，import 本身要将近一秒）。
+    """
+    ffmpeg_exe()
+    try:
+        load_font(font_path, 12)
+    except OSError as e:
+        print(f"⚠️ 无法载入字体 {font_path}: {e}", flush=True)
+    if preload_moviepy:
+        try:
+            import moviepy  # noqa: F401
+        except ImportError:
+            pass
+
+
+def probe_video(video_path: str) -> Tuple[float, int, int]:
+    """
+    用 ffmpeg -i 读取容器头，回传 (duration 秒, 显示宽, 显示高)。
+    只解析头部信息，不解码任何帧。
+    """
+    proc = subprocess.run(
+        [ffmpeg_exe(), "-hide_banner", "-nostdin", "-i", video_path],
+        capture_output=True, text=True, errors="replace"
+    )
+    info = proc.stderr
+
+    m = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", info)
+    s = re.search(r"Stream #\S+.*?: Video: .*?\b(\d{2,5})x(\d{2,5})\b", info)
+    if not m or not s:
+        raise DecodeError(f"无法解析视频信息: {video_path}")
+
+    duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    width, height = int(s.group(1)), int(s.group(2))
+
+    # 手机直拍的视频常带旋转信息，ffmpeg 解码时会自动转正
+    r = re.search(r"rotation of (-?\d+(?:\.\d+)?) degrees", info) or re.search(r"rotate\s*:\s*(-?\d+)", info)
+    if r and round(abs(float(r.group(1)))) % 180 == 90:
+        width, height = height, width
+    return duration, width, height
+
+
+def sample_times(duration: float, n: int) -> List[float]:
+    """均匀取 n 个时间点（避开首尾）"""
+    return [(i + 1) * duration / (n + 1) for i in range(n)]
+
+
+def scaled_size(width: int, height: int, frame_width: Optional[int]) -> Tuple[int, int]:
+    """按宽度等比缩放；frame_width 为空或大于原宽时保持原尺寸"""
+    if not frame_width or frame_width >= width:
+        return width, height
+    return frame_width, max(1, round(height * frame_width / width))
+
+
+def ffmpeg_frame(
+    video_path: str,
+    t: float,
+    width: int,
+    height: int,
+    out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    跳到 t 之前最近的关键帧并只解码这一帧，缩放成 width x height 的 RGB 数组。
+    out 不为空时直接读进该缓冲区（(height, width, 3) uint8，可以是画布上的切片）。
+    -copyts：关键帧早于 t 时时间戳会变成负数，rawvideo 输出会把这一帧丢掉
+    """
+    cmd = [
+        ffmpeg_exe(), "-nostdin", "-loglevel", "error",
+        "-skip_frame", "nokey", "-noaccurate_seek", "-ss", f"{t:.3f}", "-copyts",
+        "-i", video_path,
+        "-map", "0:v:0", "-frames:v", "1",
+        "-vf", f"scale={width}:{height}",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1"
+    ]
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    # 画布切片不连续，但每一行是连续的，逐行读入即可
+    bufs = [memoryview(out).cast("B")] if out.flags.c_contiguous else [memoryview(row).cast("B") for row in out]
+
+    # stderr 写到临时文件：损坏/稀疏的输入可能输出大量错误，用管道会塞满而卡住
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        complete = True
+        for buf in bufs:
+            got = 0
+            while got < len(buf):
+                n = proc.stdout.readinto(buf[got:])
+                if not n:
+                    break
+                got += n
+            if got < len(buf):
+                complete = False
+                break
+        proc.stdout.close()
+        proc.wait()
+        if not complete:
+            err.seek(0)
+            message = err.read()[-2000:].decode(errors="replace").strip()
+            raise DecodeError(f"ffmpeg 抽帧失败 t={t:.3f}: {message}")
+    return out
+
+
+def extract_keyframes_ffmpeg(
+    video_path: str,
+    n: int,
+    frame_width: Optional[int] = None
+) -> List[np.ndarray]:
+    duration, width, height = probe_video(video_path)
+    w, h = scaled_size(width, height, frame_width)
+    return [ffmpeg_frame(video_path, t, w, h) for t in sample_times(duration, n)]
+
+
+def extract_keyframes_moviepy(
+    video_path: str,
+    n: int,
+    frame_width: Optional[int] = None
+) -> List[np.ndarray]:
+    from moviepy import VideoFileClip
+
+    clip = VideoFileClip(
+        video_path,
+        audio=False,
+        target_resolution=(frame_width, None) if frame_width else None
+    )
+    try:
+        return [clip.get_frame(t) for t in sample_times(clip.duration, n)]
+    finally:
+        clip.close()
+
+
+def extract_keyframes(
+    video_path: str,
+    n: int,
+    frame_width: Optional[int] = None,
+    backend: str = "ffmpeg"
+) -> List[np.ndarray]:
+    """
+    抽取 n 张均匀分布的帧（RGB ndarray）。
+    backend="ffmpeg" 失败时自动退回 moviepy。
+    """
+    if backend not in FRAME_BACKENDS:
+        raise ValueError(f"未知的抽帧后端: {backend}")
+
+    if backend == "ffmpeg":
+        try:
+            return extract_keyframes_ffmpeg(video_path, n, frame_width)
+        except Exception as e:
+            print(f"⚠️ ffmpeg 抽帧失败，改用 moviepy：{e}", flush=True)
+    return extract_keyframes_moviepy(video_path, n, frame_width)
+
+
+def grid_tile_size(
+    width: int,
+    height: int,
+    cols: int,
+    frame_width: Optional[int] = None,
+    canvas_width: Optional[int] = None
+) -> Tuple[int, int]:
+    """目标格子尺寸：canvas_width 优先（整张画布宽度），其次 frame_width（单格宽度）"""
+    if canvas_width:
+        frame_width = max(1, canvas_width // cols)
+    return scaled_size(width, height, frame_width)
+
+
+@dataclass(frozen=True)
+class SheetLayout:
+    """
+    时间轴上的一组取样帧排成 rows x cols 的画布（动画：rows = 帧数、cols = 1）。
+    reuse=True 时不新增取样点，从其它版面的时间点中均匀挑选，只多花缩放与编码的时间。
+    """
+    rows: int
+    cols: int
+    frame_width: Optional[int] = None
+    canvas_width: Optional[int] = None
+    reuse: bool = False
+
+
+@dataclass(frozen=True)
+class SpriteSpec:
+    """拖动预览用的雪碧图（JPEG）与 WebVTT 时间索引（#xywh= 指向雪碧图上的格子）"""
+    rows: int = 5
+    cols: int = 5
+    tile_width: int = 160
+    jpeg_quality: int = 70
+
+    def layout(self) -> SheetLayout:
+        return SheetLayout(self.rows, self.cols, frame_width=self.tile_width)
+
+
+@dataclass(frozen=True)
+class AnimationSpec:
+    """短动画预览：frames 帧、宽 width、每帧 frame_ms 毫秒，format 为 webp 或 gif"""
+    frames: int = 10
+    width: int = 320
+    frame_ms: int = 400
+    format: str = "webp"
+    quality: int = 60
+
+    def layout(self) -> SheetLayout:
+        return SheetLayout(self.frames, 1, frame_width=self.width, reuse=True)
+
+
+def artifact_layouts(
+    rows: int,
+    cols: int,
+    frame_width: Optional[int] = None,
+    canvas_width: Optional[int] = None,
+    sprite: Optional[SpriteSpec] = None,
+    animation: Optional[AnimationSpec] = None
+) -> List[SheetLayout]:
+    """网格固定是第一个版面，其后依序是雪碧图、动画"""
+    layouts = [SheetLayout(rows, cols, frame_width, canvas_width)]
+    if sprite:
+        layouts.append(sprite.layout())
+    if animation:
+        layouts.append(animation.layout())
+    return layouts
+
+
+def timeline_times(duration: float, layouts: List[SheetLayout]) -> List[float]:
+    """所有版面要解码的时间点（去重、排序）；部分下载只需要这些时间点所在的分块"""
+    return sorted({
+        round(t, 3)
+        for layout in layouts if not layout.reuse
+        for t in sample_times(duration, layout.rows * layout.cols)
+    })
+
+
+class Sheet:
+    """一个版面的取样时间与预先分配的画布，第 idx 格是画布上的一个切片"""
+
+    def __init__(self, layout: SheetLayout, times: List[float], size: Tuple[int, int], duration: float):
+        self.layout = layout
+        self.times = times
+        self.size = size
+        self.duration = duration
+        w, h = size
+        self.canvas = np.zeros((h * layout.rows, w * layout.cols, 3), dtype=np.uint8)
+
+    def tile(self, idx: int) -> np.ndarray:
+        w, h = self.size
+        y, x = (idx // self.layout.cols) * h, (idx % self.layout.cols) * w
+        return self.canvas[y:y + h, x:x + w]
+
+
+def plan_sheets(duration: float, width: int, height: int, layouts: List[SheetLayout]) -> List[Sheet]:
+    timeline = timeline_times(duration, layouts)
+    sheets = []
+    for layout in layouts:
+        n = layout.rows * layout.cols
+        if layout.reuse and timeline:
+            times = [timeline[round(i * (len(timeline) - 1) / max(1, n - 1))] for i in range(n)]
+        else:
+            times = sample_times(duration, n)
+        size = grid_tile_size(width, height, layout.cols, layout.frame_width, layout.canvas_width)
+        sheets.append(Sheet(layout, times, size, duration))
+    return sheets
+
+
+def fill_sheets(sheets: List[Sheet], read: Callable[[float, np.ndarray], None]):
+    """
+    每个时间点只解码一次：read(t, out) 解码进用到该时间点的最大一格，
+    其余版面的同一时间点从这一格缩小，不再解码
+    """
+    slots: Dict[float, Tuple[float, List[np.ndarray]]] = {}
+    for sheet in sheets:
+        for idx, t in enumerate(sheet.times):
+            slots.setdefault(round(t, 3), (t, []))[1].append(sheet.tile(idx))
+    for key in sorted(slots):
+        t, tiles = slots[key]
+        tiles.sort(key=lambda tile: tile.shape[1], reverse=True)
+        read(t, tiles[0])
+        if len(tiles) > 1:
+            source = Image.fromarray(tiles[0])
+            for tile in tiles[1:]:
+                tile[:] = np.asarray(source.resize((tile.shape[1], tile.shape[0]), Image.BILINEAR))
+
+
+def compose_sheets_ffmpeg(video_path: str, layouts: List[SheetLayout]) -> List[Sheet]:
+    duration, width, height = probe_video(video_path)
+    sheets = plan_sheets(duration, width, height, layouts)
+    fill_sheets(sheets, lambda t, out: ffmpeg_frame(video_path, t, out.shape[1], out.shape[0], out=out))
+    return sheets
+
+
+def compose_sheets_moviepy(video_path: str, layouts: List[SheetLayout]) -> List[Sheet]:
+    from moviepy import VideoFileClip
+
+    clip = VideoFileClip(video_path, audio=False)
+    try:
+        sheets = plan_sheets(clip.duration, clip.w, clip.h, layouts)
+        w, h = max((sheet.size for sheet in sheets), key=lambda size: size[0])
+        if (w, h) != (clip.w, clip.h):
+            # 让 moviepy 的 ffmpeg reader 直接输出最大一格的尺寸
+            clip.close()
+            clip = VideoFileClip(video_path, audio=False, target_resolution=(w, h))
+
+        def read(t: float, out: np.ndarray):
+            frame = clip.get_frame(t)
+            if frame.shape[:2] != out.shape[:2]:
+                frame = np.asarray(Image.fromarray(frame).resize((out.shape[1], out.shape[0]), Image.BILINEAR))
+            out[:] = frame
+
+        fill_sheets(sheets, read)
+        return sheets
+    finally:
+        clip.close()
+
+
+def compose_sheets(
+    video_path: str,
+    layouts: List[SheetLayout],
+    backend: str = "ffmpeg",
+    fallback: bool = True
+) -> List[Sheet]:
+    """
+    所有版面共用一次抽帧，直接写入各自预分配的 RGB 画布。
+    backend="ffmpeg" 失败时自动退回 moviepy（fallback=False 时直接抛出）；
+    ffmpeg 解不出来、moviepy 也失败时抛 DecodeError。
+    """
+    if backend not in FRAME_BACKENDS:
+        raise ValueError(f"未知的抽帧后端: {backend}")
+
+    decode_error = None
+    if backend == "ffmpeg":
+        try:
+            return compose_sheets_ffmpeg(video_path, layouts)
+        except Exception as e:
+            if not fallback:
+                raise
+            decode_error = e if isinstance(e, DecodeError) else None
+            print(f"⚠️ ffmpeg 抽帧失败，改用 moviepy：{e}", flush=True)
+    try:
+        return compose_sheets_moviepy(video_path, layouts)
+    except Exception as e:
+        if decode_error is None:
+            raise
+        raise DecodeError(f"{decode_error}；moviepy 也失败：{e}") from e
+
+
+def compose_keyframes(
+    video_path: str,
+    rows: int,
+    cols: int,
+    frame_width: Optional[int] = None,
+    canvas_width: Optional[int] = None,
+    backend: str = "ffmpeg",
+    fallback: bool = True
+) -> np.ndarray:
+    """只要网格：抽取 rows*cols 帧写入一张画布"""
+    layouts = [SheetLayout(rows, cols, frame_width, canvas_width)]
+    return compose_sheets(video_path, layouts, backend, fallback)[0].canvas
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """未正规化的 DCT-II 矩阵（与 scipy.fftpack.dct 默认相同）：dct(x) = D @ x"""
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    return 2 * np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+
+
+_DCT = _dct_matrix(HASH_IMG_SIZE)
+
+
+def tile_phashes(canvas: np.ndarray, rows: int, cols: int) -> List[str]:
+    """
+    每个格子的 pHash（16 位十六进制，与 imagehash.phash 的格式相同）。
+    所有格子一起处理：区域平均缩到 32x32 → 灰度 → 一次批量 DCT → 取左上 8x8 与中位数比较。
+    （不是逐格调用 imagehash：省掉逐格的 PIL 图片与 scipy 调用，结果与它相差几个位元）
+    """
+    h, w = canvas.shape[0] // rows, canvas.shape[1] // cols
+    # 整张画布一次 BOX（区域平均）缩放，每格正好缩成 32x32
+    small = Image.fromarray(canvas[:rows * h, :cols * w]).resize(
+        (cols * HASH_IMG_SIZE, rows * HASH_IMG_SIZE), Image.BOX
+    )
+    gray = np.asarray(small) @ LUMA
+    gray = gray.reshape(rows, HASH_IMG_SIZE, cols, HASH_IMG_SIZE).swapaxes(1, 2).reshape(-1, HASH_IMG_SIZE, HASH_IMG_SIZE)
+
+    low = (_DCT @ gray @ _DCT.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(rows * cols, -1)
+    bits = low > np.median(low, axis=1, keepdims=True)
+    return [row.tobytes().hex() for row in np.packbits(bits, axis=1)]
+
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def draw_watermark(canvas: np.ndarray, text: str, font: ImageFont.FreeTypeFont, margin: int = 10):
+    """只把右下角文字所在的小区域转成 PIL 图片来绘制，避免复制整张画布"""
+    height, width = canvas.shape[:2]
+    try:
+        text_width, text_height = font.getsize(text)
+        offset_x, offset_y = 0, 0
+    except AttributeError:
+        # Pillow >= 8.0 推荐用 getbbox
+        left, top, right, bottom = font.getbbox(text)
+        text_width, text_height = right - left, bottom - top
+        offset_x, offset_y = right - text_width, bottom - text_height
+
+    x = width - text_width - margin
+    y = height - text_height - margin
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(width, x + offset_x + text_width), min(height, y + offset_y + text_height)
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    region = Image.fromarray(canvas[y0:y1, x0:x1])
+    # 半透明白字
+    ImageDraw.Draw(region).text((x - x0, y - y0), text, fill=(255, 255, 255, 128), font=font)
+    canvas[y0:y1, x0:x1] = np.asarray(region)
+
+
+def _vtt_time(seconds: float) -> str:
+    ms = round(seconds * 1000)
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+
+def write_sprite(sheet: Sheet, path: str, index_path: str, jpeg_quality: int):
+    """
+    雪碧图 JPEG + WebVTT 索引：每格对应 [与前一格的中点, 与后一格的中点) 这段时间，
+    cue 内容是 "<雪碧图文件名>#xywh=x,y,w,h"（播放器拖动预览的通用格式）
+    """
+    Image.fromarray(sheet.canvas).save(path, format="JPEG", quality=jpeg_quality)
+    w, h = sheet.size
+    times = sheet.times
+    name = os.path.basename(path)
+    cues = ["WEBVTT", ""]
+    for idx, t in enumerate(times):
+        start = (times[idx - 1] + t) / 2 if idx else 0.0
+        end = (t + times[idx + 1]) / 2 if idx + 1 < len(times) else sheet.duration
+        x, y = (idx % sheet.layout.cols) * w, (idx // sheet.layout.cols) * h
+        cues += [f"{_vtt_time(start)} --> {_vtt_time(end)}", f"{name}#xywh={x},{y},{w},{h}", ""]
+    with open(index_path, "w") as f:
+        f.write("\n".join(cues))
+
+
+def write_animation(sheet: Sheet, path: str, spec: AnimationSpec):
+    frames = [Image.fromarray(sheet.tile(idx)) for idx in range(len(sheet.times))]
+    fmt = spec.format.lower()
+    if fmt == "webp":
+        frames[0].save(path, format="WEBP", save_all=True, append_images=frames[1:],
+                       duration=spec.frame_ms, loop=0, quality=spec.quality)
+    elif fmt == "gif":
+        frames[0].save(path, format="GIF", save_all=True, append_images=frames[1:],
+                       duration=spec.frame_ms, loop=0)
+    else:
+        raise ValueError(f"未知的动画格式: {spec.format}")
+
+
+@dataclass
+class RenderedGrid:
+    path: str
+    phash: str                # 整张网格（含浮水印）的 pHash，写入 photo.hash
+    frame_hashes: List[str]   # 每格的 pHash（浮水印之前），依网格顺序
+    # 各子阶段耗时（秒）：decode（所有版面共用的抽帧）、compose（浮水印）、encode（JPEG）、hash、
+    # encode_sprite / encode_animation（有要求时）
+    timings: Dict[str, float] = field(default_factory=dict)
+    sprite_path: Optional[str] = None
+    sprite_index: Optional[str] = None   # WebVTT
+    animation_path: Optional[str] = None
+    width: int = 0    # 网格 JPEG 的尺寸（photo.width / height）
+    height: int = 0
+
+
+def render_keyframe_grid(
+    video_path: str,
+    output_path: str,
+    rows: int = 3,
+    cols: int = 3,
+    frame_width: Optional[int] = None,
+    canvas_width: Optional[int] = None,
+    jpeg_quality: int = 75,
+    backend: str = "ffmpeg",
+    fallback: bool = True,
+    watermark: Optional[str] = None,
+    font_path: str = "fonts/Roboto_Condensed-Regular.ttf",
+    sprite: Optional[SpriteSpec] = None,
+    sprite_path: Optional[str] = None,
+    animation: Optional[AnimationSpec] = None,
+    animation_path: Optional[str] = None
+) -> RenderedGrid:
+    """
+    抽帧 → 写入画布 → 逐格哈希 → 加浮水印 → 一次性编码成 JPEG。
+    同时要求雪碧图（sprite_path，索引写在同名 .vtt）或动画（animation_path）时，
+    它们与网格共用同一次抽帧，只多花缩放与编码的时间。
+    """
+    sprite = sprite if sprite_path else None
+    animation = animation if animation_path else None
+    t0 = time.perf_counter()
+    sheets = compose_sheets(
+        video_path, artifact_layouts(rows, cols, frame_width, canvas_width, sprite, animation), backend, fallback
+    )
+    canvas = sheets[0].canvas
+    t1 = time.perf_counter()
+    frame_hashes = tile_phashes(canvas, rows, cols)
+    t2 = time.perf_counter()
+
+    if watermark:
+        tile_height = canvas.shape[0] // rows
+        font = load_font(font_path, max(1, int(tile_height * 0.05)))
+        draw_watermark(canvas, watermark, font)
+    t3 = time.perf_counter()
+
+    # fromarray 与画布共用内存，不再复制一份
+    image = Image.fromarray(canvas)
+    image.save(output_path, format="JPEG", quality=jpeg_quality)
+    t4 = time.perf_counter()
+    phash = str(imagehash.phash(image))
+    t5 = time.perf_counter()
+    grid = RenderedGrid(output_path, phash, frame_hashes, {
+        "decode": t1 - t0,
+        "compose": t3 - t2,
+        "encode": t4 - t3,
+        "hash": (t2 - t1) + (t5 - t4),
+    })
+    grid.width, grid.height = image.size
+
+    extra = iter(sheets[1:])
+    if sprite:
+        t = time.perf_counter()
+        grid.sprite_path = sprite_path
+        grid.sprite_index = os.path.splitext(sprite_path)[0] + ".vtt"
+        write_sprite(next(extra), sprite_path, grid.sprite_index, sprite.jpeg_quality)
+        grid.timings["encode_sprite"] = time.perf_counter() - t
+    if animation:
+        t = time.perf_counter()
+        write_animation(next(extra), animation_path, animation)
+        grid.animation_path = animation_path
+        grid.timings["encode_animation"] = time.perf_counter() - t
+    return grid
@@ -0,0 +1,86 @@
+"""
+grid_jobs 调度：认领顺序、租约与失败重试
+
+- POLICIES：认领顺序。fifo = scheduled_at；smallest = file_size 小的先（大小未知的排最前）；
+  priority = grid_jobs.priority 大的先（各 BOT 入队时写入自己的 priority），同级再按 scheduled_at。
+  每种顺序都有对应的复合索引（migrations/006_grid_jobs_scheduling.sql），
+  WHERE 与 ORDER BY 用到的列都在索引里，认领时只扫描索引。
+- JobLeases：认领时写入 lease_until，处理中的任务定期续约；进程崩溃或卡住时租约过期，
+  reclaim() 把任务放回 pending（计一次失败），不再永远停在 processing。
+- retry_delay：第 n 次失败后的等待时间，指数增长并设上限；重排时写进 scheduled_at，
+  scheduled_at 之前的任务不会被认领。
+"""
+from typing import Dict
+
+from grid_db import in_clause
+
+
+POLICIES = {
+    "fifo": "scheduled_at ASC",
+    "smallest": "file_size ASC, scheduled_at ASC",
+    "priority": "priority DESC, scheduled_at ASC",
+}
+
+
+def order_by(policy: str) -> str:
+    if policy not in POLICIES:
+        raise ValueError(f"未知的调度策略: {policy}（可选 {', '.join(POLICIES)}）")
+    return POLICIES[policy]
+
+
+def retry_delay(retry_count: int, base: float, cap: float) -> int:
+    """已失败 retry_count 次后的下一次重试等待秒数：base * 2^retry_count，不超过 cap"""
+    return int(min(base * 2 ** min(retry_count, 32), cap))
+
+
+class JobLeases:
+    """本进程持有的任务租约：job_id → claim_token（同一任务被收回后，旧 token 的写入都不会命中）"""
+
+    def __init__(self, db, lease_seconds: int):
+        self.db = db
+        self.lease_seconds = lease_seconds
+        self.tokens: Dict[int, str] = {}
+
+    def add(self, job_id: int, claim_token: str):
+        self.tokens[job_id] = claim_token
+
+    def discard(self, job_id: int, claim_token: str):
+        """只放掉同一次认领的租约（同一任务收回后又被本进程认领时，旧的任务物件不会放掉新的租约）"""
+        if self.tokens.get(job_id) == claim_token:
+            del self.tokens[job_id]
+
+    async def renew(self) -> int:
+        """一条 UPDATE 为所有处理中的任务续约，回传续约成功的行数（少于持有数表示有任务已被收回）"""
+        if not self.tokens:
+            return 0
+        tokens = list(self.tokens.values())
+        return await self.db.execute(f"""
+            UPDATE grid_jobs
+            SET lease_until=NOW() + INTERVAL %s SECOND
+            WHERE job_state='processing' AND claim_token IN ({in_clause(tokens)})
+        """, (self.lease_seconds, *tokens))
+
+    async def reclaim(self, bot_name: str, max_attempts: int) -> int:
+        """租约已过期的 processing 任务放回 pending（计一次失败，用完次数则标为 failed）"""
+        return await self.db.execute("""
+            UPDATE grid_jobs
+            SET job_state=CASE WHEN retry_count + 1 >= %s THEN 'failed' ELSE 'pending' END,
+                error_message=CASE WHEN retry_count + 1 >= %s THEN '租约过期' ELSE error_message END,
+                retry_count=retry_count + 1,
+                claim_token=NULL,
+                lease_until=NULL,
+                scheduled_at=NOW()
+            WHERE bot_name=%s AND job_state='processing' AND lease_until < NOW()
+        """, (max_attempts, max_attempts, bot_name))
+
+    async def release_all(self) -> int:
+        """正常关闭时把还没做完的任务直接放回 pending（不计失败），不必等租约过期"""
+        if not self.tokens:
+            return 0
+        tokens = list(self.tokens.values())
+        self.tokens.clear()
+        return await self.db.execute(f"""
+            UPDATE grid_jobs
+            SET job_state='pending', claim_token=NULL, lease_until=NULL
+            WHERE job_state='processing' AND claim_token IN ({in_clause(tokens)})
+        """, tokens)
@@ -0,0 +1,111 @@
+"""
+任务暂存空间（temp/）
+
+视频、预览图、stored 模式的 ZIP 以及续传用的 sidecar 都写在同一个目录。原本任务结束后不删除，
+常驻 worker 会把磁盘写满。ScratchSpace 按任务登记这些文件：
+
+- path(key, name)：取得暂存路径并记在任务名下；release(key) 删除这些文件及其 sidecar（name.*）
+- detach(key)：任务还会重试（或进程关闭）时只取消登记，视频与 .parts / .upload sidecar 留在磁盘上，
+  下次认领同一任务时沿用同一路径续传；一直没人沿用的由 sweep() 清理
+- reserve(key, nbytes)：认领前按 video.file_size 预估并预留空间，实际写入超出预留时以实际为准
+- available()：预算（budget，0 = 不限）与磁盘剩余（保留 min_free）两者取小，扣掉已预留未写入的部分
+- admission：认领时持有的锁，同一进程的多个下载 worker 不会在“检查空间 → 认领 → 预留”之间互相插队
+- sweep()：启动时删除超过 stale_after 秒未修改的残留文件（之前被杀掉的进程留下的）
+
+统计用 st_blocks：部分下载的稀疏文件只计入真正写入的分块。
+"""
+import asyncio
+import glob
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Hashable, List
+
+
+def _with_sidecars(path: str) -> List[str]:
+    """文件本身加上 <path>.parts / <path>.upload / *.tmp 等 sidecar"""
+    return [path, *glob.glob(glob.escape(path) + ".*")]
+
+
+def _allocated(path: str) -> int:
+    try:
+        return os.stat(path).st_blocks * 512
+    except FileNotFoundError:
+        return 0
+
+
+class ScratchSpace:
+    def __init__(self, root: str, budget: int = 0, min_free: int = 0, stale_after: float = 86400):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        self.min_free = min_free
+        self.stale_after = stale_after
+        self.admission = asyncio.Lock()
+        self._files: Dict[Hashable, List[str]] = {}
+        self._reserved: Dict[Hashable, int] = {}
+
+    def path(self, key: Hashable, name: str) -> str:
+        path = str(self.root / name)
+        files = self._files.setdefault(key, [])
+        if path not in files:
+            files.append(path)
+        return path
+
+    def reserve(self, key: Hashable, nbytes: int):
+        self._reserved[key] = self._reserved.get(key, 0) + nbytes
+
+    def used(self, key: Hashable) -> int:
+        """任务已写入的字节（含 sidecar）"""
+        return sum(_allocated(p) for path in self._files.get(key, ()) for p in _with_sidecars(path))
+
+    def available(self) -> int:
+        """还能再预留多少字节"""
+        keys = set(self._files) | set(self._reserved)
+        used = {key: self.used(key) for key in keys}
+        unwritten = sum(max(0, self._reserved.get(key, 0) - used[key]) for key in keys)
+        free = shutil.disk_usage(self.root).free - self.min_free - unwritten
+        if not self.budget:
+            return free
+        committed = sum(max(self._reserved.get(key, 0), used[key]) for key in keys)
+        return min(free, self.budget - committed)
+
+    def release(self, key: Hashable) -> int:
+        """删除任务的所有暂存文件（任务完成或不再重试时调用），回传释放的字节数"""
+        freed = 0
+        for path in self._files.pop(key, ()):
+            for p in _with_sidecars(path):
+                freed += _allocated(p)
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+        self._reserved.pop(key, None)
+        return freed
+
+    def detach(self, key: Hashable) -> int:
+        """不再登记任务的文件与预留，但不删除，回传仍占用的字节数"""
+        kept = self.used(key)
+        self._files.pop(key, None)
+        self._reserved.pop(key, None)
+        return kept
+
+    def detach_all(self) -> int:
+        return sum(self.detach(key) for key in list(set(self._files) | set(self._reserved)))
+
+    def sweep(self) -> int:
+        """删除超过 stale_after 秒未修改、也不属于本进程任务的文件，回传删除的文件数"""
+        active = {p for files in self._files.values() for p in files}
+        cutoff = time.time() - self.stale_after
+        removed = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_file(follow_symlinks=False) or entry.path in active:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
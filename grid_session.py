@@ -0,0 +1,164 @@
+"""
+Telethon 会话持久化
+
+原本每次启动都用空的 StringSession：重新做一次 DH 握手、再用 bot_token 导入授权（常被 FloodWait），
+下载其它 DC 的文件时还要再 ExportAuthorization / ImportAuthorization 一次。
+
+PersistentTelegramClient 把主 DC 的会话（StringSession 字串）与各 DC 借用 sender 的 auth key
+存到 MySQL（telethon_session 表）或 JSON 文件，下次启动时 restore() 载入：
+- 主会话已授权时 start() 只做一次 get_me，不再导入 bot 授权
+- 借用其它 DC 的 sender 时先用保存的 key，失效才重新导出授权
+
+auth key 等同登录凭证：文件以 0600 权限写入，数据库表也应限制访问。
+"""
+import json
+import os
+from typing import Dict, Optional
+
+from telethon import TelegramClient, errors
+from telethon.crypto import AuthKey
+from telethon.network import MTProtoSender
+from telethon.sessions import StringSession
+from telethon.tl import functions, types
+from telethon.tl.alltlobjects import LAYER
+
+
+def session_name(api_id: int, bot_token: str) -> str:
+    """同一个 api_id + bot 共用一份会话（bot_token 冒号前是 bot id，不保存 token 本身）"""
+    return f"{api_id}:{bot_token.split(':', 1)[0]}"
+
+
+class FileSessionStore:
+    """JSON 文件：{name: {"session": ..., "dc_keys": {...}}}"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    async def load(self, name: str) -> Optional[dict]:
+        return self._read().get(name)
+
+    async def save(self, name: str, data: dict):
+        sessions = self._read()
+        sessions[name] = data
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(sessions, f)
+        os.replace(tmp, self.path)
+
+
+class MySQLSessionStore:
+    """telethon_session 表（migrations/005_telethon_session.sql）"""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def load(self, name: str) -> Optional[dict]:
+        row = await self.db.fetchone("SELECT session, dc_keys FROM telethon_session WHERE name=%s", (name,))
+        if not row:
+            return None
+        return {"session": row[0], "dc_keys": json.loads(row[1]) if row[1] else {}}
+
+    async def save(self, name: str, data: dict):
+        await self.db.execute("""
+            INSERT INTO telethon_session (name, session, dc_keys, update_time)
+            VALUES (%s, %s, %s, NOW())
+            ON DUPLICATE KEY UPDATE
+                session=VALUES(session),
+                dc_keys=VALUES(dc_keys),
+                update_time=NOW()
+        """, (name, data["session"], json.dumps(data["dc_keys"])))
+
+
+class PersistentTelegramClient(TelegramClient):
+    def __init__(self, store, name: str, api_id: int, api_hash: str, **kwargs):
+        super().__init__(StringSession(), api_id, api_hash, **kwargs)
+        self.store = store
+        self.name = name
+        self.dc_keys: Dict[int, str] = {}   # dc_id → 借用 sender 的 auth key（hex）
+        self._restored = False
+        self._saved: Optional[dict] = None
+
+    def _snapshot(self) -> dict:
+        return {
+            "session": self.session.save(),
+            "dc_keys": {str(dc): key for dc, key in self.dc_keys.items() if dc != self.session.dc_id},
+        }
+
+    async def restore(self) -> bool:
+        """连线前调用一次：载入保存的会话；回传是否载入成功（store 为 None 时不持久化）"""
+        if self._restored or self.store is None:
+            return self._saved is not None
+        self._restored = True
+        try:
+            data = await self.store.load(self.name)
+        except Exception as e:
+            print(f"⚠️ 载入 Telethon 会话失败，改为重新授权：{e}", flush=True)
+            return False
+        if not data:
+            return False
+
+        saved = StringSession(data["session"])
+        if saved.auth_key:
+            self.session.set_dc(saved.dc_id, saved.server_address, saved.port)
+            self.session.auth_key = saved.auth_key
+            # sender 在 __init__ 时已拿着空 key 建好，直接换掉它的 key
+            self._sender.auth_key.key = saved.auth_key.key
+        self.dc_keys = {int(dc): key for dc, key in (data.get("dc_keys") or {}).items()}
+        self._saved = self._snapshot()
+        print(f"🔑 已载入 Telethon 会话（DC {saved.dc_id}，另有 {len(self.dc_keys)} 个 DC 的 key）", flush=True)
+        return True
+
+    async def persist(self):
+        """会话有变化（首次授权、切换 DC、新的借用 DC）才写回"""
+        if self.store is None or not self.session.auth_key:
+            return
+        snapshot = self._snapshot()
+        if snapshot == self._saved:
+            return
+        try:
+            await self.store.save(self.name, snapshot)
+            self._saved = snapshot
+        except Exception as e:
+            print(f"⚠️ 保存 Telethon 会话失败：{e}", flush=True)
+
+    async def _create_exported_sender(self, dc_id: int):
+        key = self.dc_keys.get(dc_id)
+        if key:
+            try:
+                return await self._connect_with_key(dc_id, bytes.fromhex(key))
+            except (errors.UnauthorizedError, errors.AuthKeyError) as e:
+                print(f"⚠️ DC {dc_id} 保存的 key 已失效，重新导出授权：{e}", flush=True)
+                self.dc_keys.pop(dc_id, None)
+
+        sender = await super()._create_exported_sender(dc_id)
+        self.dc_keys[dc_id] = sender.auth_key.key.hex()
+        await self.persist()
+        return sender
+
+    async def _connect_with_key(self, dc_id: int, key: bytes) -> MTProtoSender:
+        """用已导入过授权的 key 连线，initConnection 时顺便查一次自己，确认 key 仍有效"""
+        dc = await self._get_dc(dc_id)
+        sender = MTProtoSender(AuthKey(key), loggers=self._log)
+        await sender.connect(self._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=self._log,
+            proxy=self._proxy,
+            local_addr=self._local_addr
+        ))
+        self._init_request.query = functions.users.GetUsersRequest([types.InputUserSelf()])
+        try:
+            await sender.send(functions.InvokeWithLayerRequest(LAYER, self._init_request))
+        except BaseException:
+            await sender.disconnect()
+            raise
+        return sender
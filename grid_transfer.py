@@ -0,0 +1,483 @@
+"""
+Telegram MTProto 文件传输
+
+PartDownloader：同时保持多个 GetFileRequest 在途，每个分块写到预分配文件的对应偏移，
+已完成的分块记录在 <文件>.parts sidecar 里，崩溃后重跑只补缺的分块。
+FileMigrateError 按分块处理：借用目标 DC 的 exported sender 重发该分块，不切换整个 client。
+
+PartUploader：把依序产出的分块（例如流式 ZIP）用 SaveFilePart / SaveBigFilePart 上传，
+多个分块同时在途、单个分块失败只重试该分块；已上传的分块记录在 .upload sidecar 里，
+中断后以同一个 file_id 续传。回传可交给 send_file 的 InputFile / InputFileBig。
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Set
+
+from telethon import errors, types
+from telethon.tl.functions.upload import GetFileRequest, SaveBigFilePartRequest, SaveFilePartRequest
+
+
+ONE_MB = 1024 * 1024
+BIG_FILE_SIZE = 10 * ONE_MB
+PART_RETRIES = 5
+SIDECAR_FLUSH_INTERVAL = 1.0
+UPLOAD_RESUME_TTL = 6 * 3600  # 服务器只保留未完成上传的分块一段时间
+
+
+def check_part_size(part_size: int):
+    """GetFileRequest 限制：limit 须为 4 KiB 的倍数，且能整除 1 MiB"""
+    if part_size <= 0 or part_size % 4096 or ONE_MB % part_size:
+        raise ValueError(f"part_size 必须是 4096 的倍数且能整除 1 MiB: {part_size}")
+
+
+def check_upload_part_size(part_size: int):
+    """SaveFilePart 限制：分块须为 1 KiB 的倍数、能整除 512 KiB"""
+    if part_size <= 0 or part_size % 1024 or (512 * 1024) % part_size:
+        raise ValueError(f"上传 part_size 必须是 1024 的倍数且能整除 512 KiB: {part_size}")
+
+
+def sidecar_path(save_path: str) -> str:
+    return f"{save_path}.parts"
+
+
+def discard_part_state(save_path: str):
+    """删除 sidecar（例如改用其它方式完整下载之后）"""
+    try:
+        os.remove(sidecar_path(save_path))
+    except FileNotFoundError:
+        pass
+
+
+def _write_json(path: str, state: dict):
+    """原子替换，进程中途被杀也不会留下写了一半的 sidecar"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _to_ranges(parts: Set[int]) -> List[List[int]]:
+    """{0,1,2,5} -> [[0,3],[5,6]]，让 sidecar 保持很小"""
+    ranges = []
+    for idx in sorted(parts):
+        if ranges and ranges[-1][1] == idx:
+            ranges[-1][1] = idx + 1
+        else:
+            ranges.append([idx, idx + 1])
+    return ranges
+
+
+def _from_ranges(ranges) -> Set[int]:
+    return {idx for start, end in ranges for idx in range(start, end)}
+
+
+class PartDownloader:
+    def __init__(
+        self,
+        client,
+        location,
+        total: int,
+        save_path: str,
+        part_size: int = 512 * 1024,
+        parallel: int = 4,
+        dc_id: Optional[int] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        refresh_location: Optional[Callable] = None
+    ):
+        """
+        - location: InputDocumentFileLocation 等文件位置
+        - dc_id: 文件所在 DC（已知时直接借用该 DC 的 sender，省一次 FILE_MIGRATE）
+        - refresh_location: file_reference 过期时调用，回传新的 location
+        """
+        check_part_size(part_size)
+        self.client = client
+        self.location = location
+        self.total = total
+        self.save_path = save_path
+        self.part_size = part_size
+        self.parallel = max(1, parallel)
+        self.progress = progress
+        self.refresh_location = refresh_location
+
+        self.part_count = (total + part_size - 1) // part_size
+        self.done: Set[int] = set()
+        self._file = None
+        self._dirty = False
+        self._last_flush = 0.0
+
+        self._dc_id = dc_id
+        self._sender = None
+        self._sender_lock = asyncio.Lock()
+
+    # ---------- 本地状态 ----------
+
+    def open(self):
+        """载入 sidecar（或推断旧版顺序续传留下的前缀），并预分配文件"""
+        if self._file is not None:
+            return
+
+        state_path = sidecar_path(self.save_path)
+        exists = os.path.exists(self.save_path)
+        size = os.path.getsize(self.save_path) if exists else 0
+
+        if os.path.exists(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+                if state.get("size") == self.total and state.get("part_size") == self.part_size:
+                    self.done = _from_ranges(state.get("done", []))
+            except (OSError, ValueError) as e:
+                print(f"⚠️ sidecar 无法读取，重新下载：{e}", flush=True)
+        elif exists and size >= self.total:
+            # 没有 sidecar 且大小已足：之前已完整下载
+            self.done = set(range(self.part_count))
+        elif exists:
+            # 旧版顺序追加写入：前面完整的分块可以直接沿用
+            self.done = set(range(size // self.part_size))
+
+        if len(self.done) < self.part_count:
+            # 先写 sidecar 再预分配，保证“有文件没 sidecar”只可能是旧格式
+            self._dirty = True
+            self.flush_state(force=True)
+
+        self._file = open(self.save_path, "r+b" if exists else "w+b")
+        if size != self.total:
+            self._file.truncate(self.total)
+
+    def flush_state(self, force: bool = False):
+        """写 sidecar（原子替换），默认最多每秒一次"""
+        now = time.monotonic()
+        if not self._dirty or (not force and now - self._last_flush < SIDECAR_FLUSH_INTERVAL):
+            return
+        _write_json(sidecar_path(self.save_path), {
+            "size": self.total, "part_size": self.part_size, "done": _to_ranges(self.done)
+        })
+        self._dirty = False
+        self._last_flush = now
+
+    @property
+    def downloaded(self) -> int:
+        last = self.part_count - 1
+        full = len(self.done) - (1 if last in self.done else 0)
+        return full * self.part_size + ((self.total - last * self.part_size) if last in self.done else 0)
+
+    @property
+    def complete(self) -> bool:
+        return len(self.done) >= self.part_count
+
+    # ---------- 网络 ----------
+
+    async def _get_sender(self):
+        async with self._sender_lock:
+            if self._sender is None:
+                if self._dc_id and self._dc_id != self.client.session.dc_id:
+                    self._sender = await self.client._borrow_exported_sender(self._dc_id)
+                else:
+                    self._sender = self.client._sender
+            return self._sender
+
+    async def _switch_sender(self, failed_sender, new_dc: int):
+        """只有第一个收到 FILE_MIGRATE 的分块真正切换，其余分块直接用新的 sender 重试"""
+        async with self._sender_lock:
+            if self._sender is failed_sender:
+                print(f"🌐 分块所在 DC{new_dc}，借用该 DC 的连接", flush=True)
+                if failed_sender is not self.client._sender:
+                    await self.client._return_exported_sender(failed_sender)
+                self._sender = await self.client._borrow_exported_sender(new_dc)
+                self._dc_id = new_dc
+
+    async def fetch_part(self, idx: int) -> bytes:
+        """取回第 idx 个分块（单个分块失败只重试该分块）"""
+        offset = idx * self.part_size
+        failures = 0
+        migrations = 0
+        while True:
+            sender = await self._get_sender()
+            try:
+                result = await self.client._call(sender, GetFileRequest(
+                    location=self.location,
+                    offset=offset,
+                    limit=self.part_size
+                ))
+                return result.bytes
+            except errors.FileMigrateError as e:
+                migrations += 1
+                if migrations > 3:
+                    raise
+                await self._switch_sender(sender, e.new_dc)
+            except errors.FloodWaitError as e:
+                print(f"⚠️ 分块 {idx} 被限流 {e.seconds}s", flush=True)
+                await asyncio.sleep(e.seconds)
+            except (errors.FileReferenceExpiredError, errors.FilerefUpgradeNeededError):
+                if not self.refresh_location:
+                    raise
+                failures += 1
+                if failures >= PART_RETRIES:
+                    raise
+                self.location = await self.refresh_location()
+            except (errors.TimedOutError, errors.RpcCallFailError, ConnectionError, asyncio.TimeoutError) as e:
+                failures += 1
+                if failures >= PART_RETRIES:
+                    raise
+                print(f"⚠️ 分块 {idx} 失败，重试：{e}", flush=True)
+                await asyncio.sleep(2 ** failures)
+
+    def _write_part(self, idx: int, data: bytes):
+        self._file.seek(idx * self.part_size)
+        self._file.write(data)
+        self.done.add(idx)
+        self._dirty = True
+        self.flush_state()
+
+    async def download(self, parts: Optional[Iterable[int]] = None):
+        """
+        下载指定分块（默认全部缺少的分块），parallel 个请求同时在途。
+        全部完成后删除 sidecar。
+        """
+        self.open()
+        wanted = range(self.part_count) if parts is None else parts
+        queue = [idx for idx in sorted(set(wanted)) if idx not in self.done and 0 <= idx < self.part_count]
+        if self.done and parts is None:
+            print(f"⏯️ 已有 {len(self.done)}/{self.part_count} 个分块，续传 {len(queue)} 个", flush=True)
+
+        pending = iter(queue)
+
+        async def worker():
+            for idx in pending:
+                data = await self.fetch_part(idx)
+                expected = min(self.part_size, self.total - idx * self.part_size)
+                if len(data) != expected:
+                    raise RuntimeError(f"分块 {idx} 长度不符: {len(data)} != {expected}")
+                self._write_part(idx, data)
+                if self.progress:
+                    self.progress(self.downloaded, self.total)
+
+        tasks = [asyncio.create_task(worker()) for _ in range(min(self.parallel, len(queue)) or 1)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # 任一分块最终失败：停止其余请求，已完成的分块留在 sidecar 里下次续传
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self._file.flush()
+            self.flush_state(force=True)
+
+        if self.complete:
+            discard_part_state(self.save_path)
+
+    def parts_for_range(self, offset: int, length: int) -> range:
+        """覆盖 [offset, offset+length) 的分块编号"""
+        end = min(offset + length, self.total)
+        if length <= 0 or offset >= end:
+            return range(0)
+        return range(offset // self.part_size, (end - 1) // self.part_size + 1)
+
+    async def read_range(self, offset: int, length: int) -> bytes:
+        """区间读取：先补齐覆盖该区间的分块，再从本地文件读出"""
+        await self.download(self.parts_for_range(offset, length))
+        self._file.seek(offset)
+        return self._file.read(max(0, min(length, self.total - offset)))
+
+    async def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._sender is not None and self._sender is not self.client._sender:
+            await self.client._return_exported_sender(self._sender)
+        self._sender = None
+
+
+
+def upload_sidecar_path(name_path: str) -> str:
+    return f"{name_path}.upload"
+
+
+def iter_file_parts(path: str, part_size: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(part_size)
+            if not data:
+                break
+            yield data
+
+
+class PartUploader:
+    def __init__(
+        self,
+        client,
+        total: int,
+        name: str,
+        part_size: int = 512 * 1024,
+        parallel: int = 4,
+        state_path: Optional[str] = None,
+        meta: Optional[dict] = None,
+        progress: Optional[Callable[[int, int], None]] = None
+    ):
+        """
+        - name: 上传后的文件名（InputFile.name）
+        - state_path: 续传 sidecar；同一 file_id 下已上传的分块记录在这里
+        - meta: 与内容相关的参数（例如 ZIP 的 salt），不一致时不续传
+        """
+        check_upload_part_size(part_size)
+        self.client = client
+        self.total = total
+        self.name = name
+        self.part_size = part_size
+        self.parallel = max(1, parallel)
+        self.state_path = state_path
+        self.meta = meta or {}
+        self.progress = progress
+
+        self.part_count = (total + part_size - 1) // part_size
+        self.is_big = total > BIG_FILE_SIZE
+        self.file_id = None
+        self.done: Set[int] = set()
+        self._started = 0.0
+        self._dirty = False
+        self._last_flush = 0.0
+
+    @staticmethod
+    def load_state(state_path: Optional[str]) -> Optional[dict]:
+        if not state_path or not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 上传 sidecar 无法读取，重新上传：{e}", flush=True)
+            return None
+        if time.time() - state.get("started", 0) > UPLOAD_RESUME_TTL:
+            return None
+        return state
+
+    def open(self):
+        """沿用 sidecar 里的 file_id 与已上传分块，否则换一个新的 file_id"""
+        if self.file_id is not None:
+            return
+        state = self.load_state(self.state_path)
+        if state and all((
+            state.get("size") == self.total,
+            state.get("part_size") == self.part_size,
+            state.get("name") == self.name,
+            state.get("meta", {}) == self.meta,
+        )):
+            self.file_id = state["file_id"]
+            self.done = _from_ranges(state.get("done", []))
+            self._started = state["started"]
+        else:
+            self.reset()
+
+    def reset(self):
+        """放弃已上传的分块（例如服务器回报 FILE_PART_MISSING）"""
+        self.file_id = random.randrange(-2 ** 63, 2 ** 63)
+        self.done = set()
+        self._started = time.time()
+        self._dirty = True
+        self.flush_state(force=True)
+
+    def flush_state(self, force: bool = False):
+        now = time.monotonic()
+        if not self.state_path or not self._dirty or (not force and now - self._last_flush < SIDECAR_FLUSH_INTERVAL):
+            return
+        _write_json(self.state_path, {
+            "file_id": self.file_id, "size": self.total, "part_size": self.part_size, "name": self.name,
+            "meta": self.meta, "started": self._started, "done": _to_ranges(self.done)
+        })
+        self._dirty = False
+        self._last_flush = now
+
+    def finish(self):
+        """文件已发送成功：删除 sidecar"""
+        if self.state_path:
+            try:
+                os.remove(self.state_path)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def uploaded(self) -> int:
+        last = self.part_count - 1
+        full = len(self.done) - (1 if last in self.done else 0)
+        return full * self.part_size + ((self.total - last * self.part_size) if last in self.done else 0)
+
+    async def send_part(self, idx: int, data: bytes):
+        """上传一个分块，失败只重试该分块"""
+        if self.is_big:
+            request = SaveBigFilePartRequest(self.file_id, idx, self.part_count, data)
+        else:
+            request = SaveFilePartRequest(self.file_id, idx, data)
+        failures = 0
+        while True:
+            try:
+                if not await self.client(request):
+                    raise RuntimeError(f"上传分块 {idx} 被拒绝")
+                return
+            except errors.FloodWaitError as e:
+                print(f"⚠️ 上传分块 {idx} 被限流 {e.seconds}s", flush=True)
+                await asyncio.sleep(e.seconds)
+            except (errors.TimedOutError, errors.RpcCallFailError, ConnectionError, asyncio.TimeoutError,
+                    RuntimeError) as e:
+                failures += 1
+                if failures >= PART_RETRIES:
+                    raise
+                print(f"⚠️ 上传分块 {idx} 失败，重试：{e}", flush=True)
+                await asyncio.sleep(2 ** failures)
+
+    async def upload(self, parts: Iterator[bytes]):
+        """
+        parts 依序产出全部分块（除最后一块外都必须正好 part_size 字节），是同步迭代器，
+        在线程里取下一块，读盘/加密不阻塞事件循环。已上传过的分块照样产出但不再发送。
+        最多 parallel 个分块同时在途，回传可交给 send_file 的 InputFile / InputFileBig。
+        """
+        self.open()
+        if self.done:
+            print(f"⏯️ 已上传 {len(self.done)}/{self.part_count} 个分块，续传", flush=True)
+        md5 = None if self.is_big else hashlib.md5()
+        queue: asyncio.Queue = asyncio.Queue(self.parallel)
+
+        async def producer():
+            for idx in range(self.part_count):
+                data = await asyncio.to_thread(next, parts, None)
+                expected = min(self.part_size, self.total - idx * self.part_size)
+                if data is None or len(data) != expected:
+                    raise RuntimeError(
+                        f"上传分块 {idx} 长度不符: {0 if data is None else len(data)} != {expected}"
+                    )
+                if md5:
+                    md5.update(data)
+                if idx not in self.done:
+                    await queue.put((idx, data))
+            for _ in range(self.parallel):
+                await queue.put(None)
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                idx, data = item
+                await self.send_part(idx, data)
+                self.done.add(idx)
+                self._dirty = True
+                self.flush_state()
+                if self.progress:
+                    self.progress(self.uploaded, self.total)
+
+        tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker()) for _ in range(self.parallel)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self.flush_state(force=True)
+
+        if self.is_big:
+            return types.InputFileBig(self.file_id, self.part_count, self.name)
+        return types.InputFile(self.file_id, self.part_count, self.name, md5.hexdigest())
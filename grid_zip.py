@@ -0,0 +1,227 @@
+"""
+流式加密 ZIP（存储模式，不压缩），需要 ARCHIVE_STREAM 开启才会使用
+
+不再先用 zip -0 -P 在磁盘上写出第二份副本：边读原文件边加密，按上传分块大小产出字节，
+直接喂给分块上传，归档本身从不落盘。
+
+加密用 WinZip AES-256（AE-2）：ZipCrypto 是逐字节串行的流密码，纯 Python 太慢；
+AES-CTR 可以整块用 OpenSSL 加密。AE-2 不写 CRC（由 HMAC 校验），
+因此每个条目的大小、整个归档的大小在开始前就能算出来，本地文件头无需回填。
+超过 4 GiB 的条目与归档写 ZIP64 扩展字段与 ZIP64 结尾记录。
+
+注意：AES 加密的 ZIP 只有 7-Zip、WinZip、WinRAR、p7zip 等能解开；
+unzip -P、Python zipfile、macOS Archive Utility 都不支持，需要这些工具的环境保持默认的 zip -0 -P（ZipCrypto）。
+
+依赖可选的 cryptography 套件；未安装时 available() 为 False，调用方应退回 zip 命令。
+"""
+import hashlib
+import hmac
+import os
+import struct
+import time
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # pragma: no cover - 可选依赖
+    Cipher = None
+
+
+SALT_SIZE = 16          # AES-256 的 salt 长度
+KEY_SIZE = 32
+AUTH_SIZE = 10          # HMAC-SHA1 截断长度
+PBKDF2_ITERATIONS = 1000
+READ_CHUNK = 1024 * 1024  # 16 的倍数，保证 CTR 分块对齐
+
+AES_EXTRA = struct.pack("<HHH2sBH", 0x9901, 7, 2, b"AE", 3, 0)  # AE-2, AES-256, 原始方法 = stored
+ENTRY_OVERHEAD = SALT_SIZE + 2 + AUTH_SIZE
+LOCAL_HEADER_SIZE = 30
+CENTRAL_HEADER_SIZE = 46
+END_RECORD_SIZE = 22
+ZIP64_END_RECORD_SIZE = 56
+ZIP64_LOCATOR_SIZE = 20
+ZIP32_LIMIT = 0xFFFFFFFF   # 32 位字段的上限，等于或超过时改写 ZIP64 字段
+ZIP32_ENTRIES = 0xFFFF
+ZIP64_MARKER = 0xFFFFFFFF  # 真实值在 ZIP64 字段里时，32 位字段写的占位值
+
+
+def available() -> bool:
+    return Cipher is not None
+
+
+def _dos_datetime(ts: float):
+    t = time.localtime(ts)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+def _arcname(path: str) -> str:
+    """与 zip 命令一致：保留传入的相对路径，去掉开头的 ./ 和 /"""
+    return os.path.normpath(path).replace(os.sep, "/").lstrip("/")
+
+
+class _Entry:
+    def __init__(self, path: str, salt: bytes):
+        st = os.stat(path)
+        self.path = path
+        self.name = _arcname(path).encode("utf-8")
+        self.size = st.st_size
+        self.salt = salt
+        self.dos_time, self.dos_date = _dos_datetime(st.st_mtime)
+        self.offset = 0
+
+    @property
+    def compressed_size(self) -> int:
+        return self.size + ENTRY_OVERHEAD
+
+    @property
+    def zip64(self) -> bool:
+        return self.compressed_size >= ZIP32_LIMIT
+
+    def _fields(self) -> tuple:
+        # 版本 5.1、bit0 加密、bit11 UTF-8 文件名、方法 99 = AES、CRC 为 0（AE-2）；
+        # ZIP64 条目的两个大小写 0xFFFFFFFF，真实值放在 0x0001 扩展字段
+        if self.zip64:
+            return (51, 0x0801, 99, self.dos_time, self.dos_date, 0, ZIP64_MARKER, ZIP64_MARKER)
+        return (51, 0x0801, 99, self.dos_time, self.dos_date, 0, self.compressed_size, self.size)
+
+    def _local_extra(self) -> bytes:
+        if not self.zip64:
+            return AES_EXTRA
+        return struct.pack("<HHQQ", 0x0001, 16, self.size, self.compressed_size) + AES_EXTRA
+
+    def _central_extra(self) -> bytes:
+        # 中央目录的 ZIP64 字段只写对应 32 位字段为 0xFFFFFFFF 的那几个，顺序固定
+        values = [self.size, self.compressed_size] if self.zip64 else []
+        if self.offset >= ZIP32_LIMIT:
+            values.append(self.offset)
+        if not values:
+            return AES_EXTRA
+        return struct.pack(f"<HH{len(values)}Q", 0x0001, 8 * len(values), *values) + AES_EXTRA
+
+    @property
+    def local_header_size(self) -> int:
+        return LOCAL_HEADER_SIZE + len(self.name) + len(self._local_extra())
+
+    @property
+    def central_header_size(self) -> int:
+        return CENTRAL_HEADER_SIZE + len(self.name) + len(self._central_extra())
+
+    def local_header(self) -> bytes:
+        extra = self._local_extra()
+        return struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, *self._fields(), len(self.name), len(extra)
+        ) + self.name + extra
+
+    def central_header(self) -> bytes:
+        extra = self._central_extra()
+        return struct.pack(
+            "<IH" "HHHHHIII" "HHHHHII", 0x02014B50, (3 << 8) | 51, *self._fields(),
+            len(self.name), len(extra), 0, 0, 0, 0o100644 << 16,
+            ZIP64_MARKER if self.offset >= ZIP32_LIMIT else self.offset
+        ) + self.name + extra
+
+
+class EncryptedZipStream:
+    """
+    多个文件 → 一个 AES-256 加密的存储型 ZIP 字节流。
+    - size：整个归档的字节数（开始产出之前就已知）
+    - iter_parts(part_size)：依序产出 part_size 大小的分块（最后一块可以较短）
+    - salts：每个条目的 salt；传入同一组 salt 时产出的字节完全相同（续传用）
+    """
+
+    def __init__(self, file_paths: List[str], password: str, salts: Optional[List[bytes]] = None):
+        if not available():
+            raise RuntimeError("未安装 cryptography，无法生成 AES 加密 ZIP")
+        if salts is None:
+            salts = [os.urandom(SALT_SIZE) for _ in file_paths]
+        if len(salts) != len(file_paths):
+            raise ValueError("salts 数量与文件数不一致")
+
+        self.password = password.encode("utf-8")
+        self.entries = [_Entry(path, salt) for path, salt in zip(file_paths, salts)]
+
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset += entry.local_header_size + entry.compressed_size
+        self._central_offset = offset
+        self._central_size = sum(e.central_header_size for e in self.entries)
+        self.zip64 = (
+            self._central_offset >= ZIP32_LIMIT or self._central_size >= ZIP32_LIMIT
+            or len(self.entries) >= ZIP32_ENTRIES
+        )
+        self.size = offset + self._central_size + END_RECORD_SIZE
+        if self.zip64:
+            self.size += ZIP64_END_RECORD_SIZE + ZIP64_LOCATOR_SIZE
+
+    @property
+    def salts(self) -> List[bytes]:
+        return [e.salt for e in self.entries]
+
+    def _encrypted_entry(self, entry: _Entry) -> Iterator[bytes]:
+        derived = hashlib.pbkdf2_hmac("sha1", self.password, entry.salt, PBKDF2_ITERATIONS, 2 * KEY_SIZE + 2)
+        enc_key, auth_key, verifier = derived[:KEY_SIZE], derived[KEY_SIZE:2 * KEY_SIZE], derived[2 * KEY_SIZE:]
+        ecb = Cipher(algorithms.AES(enc_key), modes.ECB()).encryptor()
+        mac = hmac.new(auth_key, digestmod=hashlib.sha1)
+        yield entry.salt + verifier
+
+        # WinZip 的 CTR 计数器是从 1 开始的 little-endian，OpenSSL 的 CTR 模式是 big-endian，
+        # 所以自己批量生成计数器块再用 ECB 加密得到 keystream
+        block = 1
+        remaining = entry.size
+        with open(entry.path, "rb") as f:
+            while remaining > 0:
+                data = f.read(min(READ_CHUNK, remaining))
+                if not data:
+                    break
+                n = (len(data) + 15) // 16
+                counters = np.zeros((n, 2), dtype="<u8")
+                counters[:, 0] = np.arange(block, block + n, dtype=np.uint64)
+                keystream = np.frombuffer(ecb.update(counters.tobytes()), dtype=np.uint8, count=len(data))
+                encrypted = (np.frombuffer(data, dtype=np.uint8) ^ keystream).tobytes()
+                mac.update(encrypted)
+                yield encrypted
+                block += n
+                remaining -= len(data)
+        if remaining:
+            raise RuntimeError(f"打包期间文件被截断: {entry.path}")
+        yield mac.digest()[:AUTH_SIZE]
+
+    def _segments(self) -> Iterator[bytes]:
+        for entry in self.entries:
+            yield entry.local_header()
+            yield from self._encrypted_entry(entry)
+        yield b"".join(e.central_header() for e in self.entries)
+        count = len(self.entries)
+        if self.zip64:
+            # ZIP64 结尾记录 + 定位器；之后的传统结尾记录里超限的字段写成全 1
+            zip64_end_offset = self._central_offset + self._central_size
+            yield struct.pack(
+                "<IQHHIIQQQQ", 0x06064B50, ZIP64_END_RECORD_SIZE - 12, (3 << 8) | 51, 45, 0, 0,
+                count, count, self._central_size, self._central_offset
+            )
+            yield struct.pack("<IIQI", 0x07064B50, 0, zip64_end_offset, 1)
+            count = min(count, ZIP32_ENTRIES)
+            central_size, central_offset = ZIP64_MARKER, ZIP64_MARKER
+        else:
+            central_size, central_offset = self._central_size, self._central_offset
+        yield struct.pack(
+            "<IHHHHIIH", 0x06054B50, 0, 0, count, count, central_size, central_offset, 0
+        )
+
+    def iter_parts(self, part_size: int) -> Iterator[bytes]:
+        buf = bytearray()
+        for segment in self._segments():
+            buf += segment
+            while len(buf) >= part_size:
+                yield bytes(buf[:part_size])
+                del buf[:part_size]
+        if buf:
+            yield bytes(buf)
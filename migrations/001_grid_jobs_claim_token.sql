@@ -0,0 +1,5 @@
+-- grid_jobs 原子认领：认领时写入随机 claim_token，再按 token 取回
+ALTER TABLE grid_jobs
+    ADD COLUMN claim_token CHAR(32) NULL,
+    ADD INDEX idx_grid_jobs_claim_token (claim_token),
+    ADD INDEX idx_grid_jobs_pending (bot_name, job_state, scheduled_at);
@@ -0,0 +1,3 @@
+-- 每格关键帧的 pHash（16 位十六进制，逗号分隔，依网格顺序），放在整张网格的 photo.hash 旁边
+ALTER TABLE photo
+    ADD COLUMN frame_hashes VARCHAR(1024) NULL AFTER hash;
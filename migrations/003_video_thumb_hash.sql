@@ -0,0 +1,3 @@
+-- Telegram 附带的视频缩图的 pHash（16 位十六进制），用于启动时建立近似重复索引
+ALTER TABLE video
+    ADD COLUMN thumb_hash CHAR(16) NULL;
@@ -0,0 +1,3 @@
+-- 每个任务各阶段耗时（秒），例如 {"claim": 0.004, "download": 3.2, "decode": 0.8, ...}
+ALTER TABLE grid_jobs
+    ADD COLUMN stage_timings JSON NULL;
@@ -0,0 +1,7 @@
+-- Telethon 会话（StringSession 字串与各 DC 借用 sender 的 auth key），重启后沿用授权
+CREATE TABLE IF NOT EXISTS telethon_session (
+    name VARCHAR(64) NOT NULL PRIMARY KEY,
+    session TEXT NOT NULL,
+    dc_keys TEXT NULL,
+    update_time DATETIME NOT NULL
+);
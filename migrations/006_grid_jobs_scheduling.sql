@@ -0,0 +1,23 @@
+-- grid_jobs 调度：认领顺序（fifo / smallest / priority）、租约与失败重试（见 grid_scheduler.py）
+-- file_size 从 video 冗余一份到任务上：认领条件与 smallest 顺序不必再 JOIN video
+-- 三个认领索引都以 (bot_name, job_state) 开头，并包含 scheduled_at 与 file_size，认领只扫描索引
+-- priority 索引用降序键（MySQL 8.0+），ORDER BY priority DESC, scheduled_at ASC 不必排序
+ALTER TABLE grid_jobs
+    ADD COLUMN file_size BIGINT NULL,
+    ADD COLUMN priority INT NOT NULL DEFAULT 0,
+    ADD COLUMN lease_until DATETIME NULL,
+    DROP INDEX idx_grid_jobs_pending,
+    ADD INDEX idx_grid_jobs_fifo (bot_name, job_state, scheduled_at, file_size),
+    ADD INDEX idx_grid_jobs_smallest (bot_name, job_state, file_size, scheduled_at),
+    ADD INDEX idx_grid_jobs_priority (bot_name, job_state, priority DESC, scheduled_at, file_size),
+    ADD INDEX idx_grid_jobs_lease (bot_name, job_state, lease_until);
+
+UPDATE grid_jobs j
+JOIN video v ON v.file_unique_id = j.file_unique_id
+SET j.file_size = v.file_size
+WHERE j.job_state IN ('pending', 'processing');
+
+-- 升级前卡在 processing 的任务：从 started_at 起给一小时租约，过期后由 worker 收回
+UPDATE grid_jobs
+SET lease_until = DATE_ADD(COALESCE(started_at, NOW()), INTERVAL 1 HOUR)
+WHERE job_state = 'processing';